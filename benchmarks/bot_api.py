@@ -0,0 +1,72 @@
+"""A stand-in for the Bot API answering locally, so the benchmarks measure the bot itself and can run anywhere.
+
+It imports nothing from g4f, so the startup benchmark can use it without loading the providers.
+"""
+import asyncio
+import json
+import time
+from collections import Counter
+from typing import Any, Callable
+
+from telegram.request import BaseRequest, RequestData
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Hiroshi", "username": "hiroshi_benchmark_bot"}
+
+
+ApiListener = Callable[[str, dict[str, Any]], None]
+
+
+class StubBotRequest(BaseRequest):
+    """Answers the Bot API requests locally, after `latency` seconds, counting them by method. `listener` (if set) is
+    called with the method and the parameters of every request, when it's answered."""
+
+    def __init__(self, latency: float, listener: ApiListener | None = None) -> None:
+        self.latency = latency
+        self.listener = listener
+        self.calls: Counter[str] = Counter()
+        self._message_id = 0
+
+    async def initialize(self) -> None:
+        return None
+
+    async def shutdown(self) -> None:
+        return None
+
+    def _make_message(self, parameters: dict[str, Any]) -> dict[str, Any]:
+        self._message_id += 1
+        return {
+            "message_id": parameters.get("message_id") or self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(parameters.get("chat_id", 0)), "type": "private"},
+            "from": BOT_USER,
+            "text": parameters.get("text", ""),
+        }
+
+    async def do_request(
+        self, url: str, method: str, request_data: RequestData | None = None, *args: Any, **kwargs: Any
+    ) -> tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        parameters = request_data.parameters if request_data else {}
+        result: Any = True
+        if api_method == "getMe":
+            result = BOT_USER
+        elif api_method in ("sendMessage", "editMessageText", "sendDocument"):
+            result = self._make_message(parameters)
+        if self.listener:
+            self.listener(api_method, parameters)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def get_reply_to_message_id(parameters: dict[str, Any]) -> int | None:
+    """ID of the message a `sendMessage` request replies to."""
+    reply_parameters = parameters.get("reply_parameters")
+    if isinstance(reply_parameters, str):
+        reply_parameters = json.loads(reply_parameters)
+    if isinstance(reply_parameters, dict) and "message_id" in reply_parameters:
+        return int(reply_parameters["message_id"])
+    if reply_to_message_id := parameters.get("reply_to_message_id"):
+        return int(reply_to_message_id)
+    return None
@@ -0,0 +1,50 @@
+"""Compare two benchmark results files and report the regressions.
+
+A case regresses when its median (or, with `--metric`, another latency statistic) grew by more than `--threshold`
+percent. The exit code is 1 if any case regressed, so the comparison can gate a CI job.
+
+Usage:
+    python -m benchmarks.compare baseline.json candidate.json [--threshold 10] [--metric p95_ms]
+"""
+import argparse
+import sys
+
+from benchmarks.results import load_results
+
+METRICS = ("mean_ms", "median_ms", "p95_ms", "p99_ms", "max_ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline", help="Results of the reference commit")
+    parser.add_argument("candidate", help="Results of the commit checked")
+    parser.add_argument("--threshold", type=float, default=10, help="Growth (in percent) considered a regression")
+    parser.add_argument("--metric", default="median_ms", choices=METRICS, help="Latency statistic compared")
+    args = parser.parse_args()
+
+    baseline = load_results(args.baseline)
+    candidate = load_results(args.candidate)
+    common = [key for key in baseline if key in candidate]
+    if not common:
+        sys.exit("The results files have no case in common")
+
+    regressions = 0
+    key_width = max(len(key) for key in common)
+    print(f"{'case':<{key_width}}{'baseline':>14}{'candidate':>14}{'change':>10}")
+    for key in common:
+        before = getattr(baseline[key], args.metric)
+        after = getattr(candidate[key], args.metric)
+        change = (after - before) / before * 100 if before else 0.0
+        regressed = change > args.threshold
+        regressions += regressed
+        print(f"{key:<{key_width}}{before:>14.3f}{after:>14.3f}{change:>+9.1f}%{'  REGRESSION' if regressed else ''}")
+
+    for key in sorted(set(baseline) ^ set(candidate)):
+        print(f"{key}: only in the {'baseline' if key in baseline else 'candidate'}")
+    print(f"{regressions} of {len(common)} cases regressed by more than {args.threshold:g}% ({args.metric}).")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
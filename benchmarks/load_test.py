@@ -0,0 +1,324 @@
+"""Drive `HiroshiBot` offline with a stream of updates and measure how it copes.
+
+The updates go through the bot's registered handlers (access checks, the prompt scheduler, the answer) exactly as the
+ones received from Telegram do. The bot talks to a stub Bot API and its chats to a fake g4f provider: the stub one
+(with the latency, empty answers and errors asked for) or any provider class passed with `--provider`.
+
+The updates are either synthetic (messages of `--chats` private chats and `/ask` commands in `--groups` group chats,
+arriving at random at `--rate` per second) or replayed from a JSON lines file of `{"at": <seconds>, "update": {...}}`
+records (`--replay`); a synthetic stream can be recorded with `--record` to be replayed later. The reply latency is
+the time from an update's arrival to the bot's first reply to it (prompts merged into one answer all get that reply).
+
+The storage lives in a temporary directory, except Redis, which is the one set by `REDIS`. Worker processes are not
+supported: they would talk to the real Bot API.
+
+Usage:
+    python -m benchmarks.load_test --rate 20 --duration 60 --chats 200 --groups 20 --provider-latency 1500
+    python -m benchmarks.load_test --provider-latency 800 --latency-spread 0.5 --empty-rate 0.05 --error-rate 0.02
+    python -m benchmarks.load_test --replay traffic.jsonl --speed 2 --output load.json
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import random
+import resource
+import tempfile
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Iterator
+
+import g4f.debug
+from g4f.providers.base_provider import AsyncGeneratorProvider
+from loguru import logger
+from telegram import Update
+
+from benchmarks.bot_api import StubBotRequest, get_reply_to_message_id
+from benchmarks.results import Result, report
+from benchmarks.stubs import (
+    ProviderBehaviour,
+    StubProvider,
+    configure_storage,
+    prepare_chat,
+    register_provider,
+)
+from hiroshi import metrics
+from hiroshi.config import application_settings, gpt_settings, telegram_settings
+from hiroshi.services.bot import prompt_scheduler
+from hiroshi.services.providers import providers_loader
+from main import HiroshiBot
+from scripts.post_webhook_update import make_text_update
+
+BENCHMARK = "load_test"
+# How often the event loop lag is sampled, in seconds.
+LAG_PROBE_INTERVAL = 0.05
+QUESTIONS = (
+    "What's the difference between a process and a thread?",
+    "Write a haiku about the sea.",
+    "How do I reverse a list in Python?",
+    "Summarize the plot of Hamlet in two sentences.",
+    "Why is the sky blue?",
+)
+
+
+@dataclass
+class ScheduledUpdate:
+    at: float
+    update: dict[str, Any]
+
+
+def generate_traffic(
+    rate: float, duration: float, chats: int, groups: int, group_members: int, group_share: float
+) -> Iterator[ScheduledUpdate]:
+    """Updates arriving at random (a Poisson process) at `rate` per second, for `duration` seconds."""
+    message_ids: Counter[int] = Counter()
+    at = random.expovariate(rate)
+    update_id = 0
+    while at < duration:
+        update_id += 1
+        if groups and (not chats or random.random() < group_share):
+            chat_id = -1_000_000_000 - random.randrange(groups)
+            user_id = 10_000_000 + random.randrange(group_members)
+            chat_type, text = "group", f"/ask {random.choice(QUESTIONS)}"
+        else:
+            chat_id = user_id = 1_000_000 + random.randrange(chats)
+            chat_type, text = "private", random.choice(QUESTIONS)
+        message_ids[chat_id] += 1
+        update = make_text_update(update_id=update_id, chat_id=chat_id, user_id=user_id, chat_type=chat_type, text=text)
+        update["message"]["message_id"] = message_ids[chat_id]
+        yield ScheduledUpdate(at=at, update=update)
+        at += random.expovariate(rate)
+
+
+def load_traffic(path: str, rate: float) -> list[ScheduledUpdate]:
+    """Recorded updates. Bare updates (without the arrival time) are spread evenly at `rate` per second."""
+    scheduled = []
+    with open(path) as traffic_file:
+        for index, line in enumerate(line for line in traffic_file if line.strip()):
+            record = json.loads(line)
+            if "update" in record:
+                scheduled.append(ScheduledUpdate(at=float(record.get("at", index / rate)), update=record["update"]))
+            else:
+                scheduled.append(ScheduledUpdate(at=index / rate, update=record))
+    return sorted(scheduled, key=lambda scheduled_update: scheduled_update.at)
+
+
+def save_traffic(path: str, traffic: list[ScheduledUpdate]) -> None:
+    with open(path, "w") as traffic_file:
+        for scheduled in traffic:
+            traffic_file.write(json.dumps({"at": round(scheduled.at, 6), "update": scheduled.update}) + "\n")
+
+
+@dataclass
+class ReplyTracker:
+    """Matches the bot's replies with the updates they answer."""
+
+    # Arrival time of the messages not replied to yet, by chat and message ID.
+    pending: dict[int, dict[int, float]] = field(default_factory=dict)
+    latencies: list[float] = field(default_factory=list)
+    replies: int = 0
+    last_reply_at: float = 0.0
+    all_replied: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def sent(self, chat_id: int, message_id: int) -> None:
+        self.pending.setdefault(chat_id, {})[message_id] = time.perf_counter()
+        self.all_replied.clear()
+
+    def on_api_request(self, api_method: str, parameters: dict[str, Any]) -> None:
+        if api_method != "sendMessage" or (message_id := get_reply_to_message_id(parameters)) is None:
+            return
+        chat_pending = self.pending.get(int(parameters["chat_id"]), {})
+        # Prompts merged into a single answer are all replied to by the reply to the last one.
+        replied = [pending_id for pending_id in chat_pending if pending_id <= message_id]
+        if not replied:
+            return
+        self.replies += 1
+        self.last_reply_at = now = time.perf_counter()
+        for pending_id in replied:
+            self.latencies.append(now - chat_pending.pop(pending_id))
+        if not any(self.pending.values()):
+            self.all_replied.set()
+
+    @property
+    def unanswered(self) -> int:
+        return sum(len(chat_pending) for chat_pending in self.pending.values())
+
+
+async def probe_event_loop_lag(samples: list[float]) -> None:
+    while True:
+        started_at = time.perf_counter()
+        await asyncio.sleep(LAG_PROBE_INTERVAL)
+        samples.append(max(0.0, time.perf_counter() - started_at - LAG_PROBE_INTERVAL))
+
+
+def get_peak_memory_mb() -> float:
+    # Kilobytes on Linux.
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+async def run(
+    traffic: list[ScheduledUpdate], storage: str, speed: float, telegram_latency: float, drain_timeout: float
+) -> tuple[list[Result], dict[str, Any]]:
+    tracker = ReplyTracker()
+    bot_request = StubBotRequest(latency=telegram_latency, listener=tracker.on_api_request)
+    bot = HiroshiBot()
+    application = bot.build_application(request=bot_request)
+    chat_ids = {scheduled.update["message"]["chat"]["id"] for scheduled in traffic if "message" in scheduled.update}
+    memory_at_start = get_peak_memory_mb()
+
+    with tempfile.TemporaryDirectory(prefix="hiroshi-load-test-") as path:
+        configure_storage(storage, path)
+        await application.initialize()
+        await bot.post_init(application)
+        # Measured by `benchmarks.startup`, loading the providers would skew the first replies' latency.
+        await providers_loader.wait()
+        for chat_id in chat_ids:
+            await prepare_chat(chat_id=chat_id)
+        await application.start()
+
+        lag_samples: list[float] = []
+        lag_probe = asyncio.create_task(probe_event_loop_lag(lag_samples))
+        started_at = time.perf_counter()
+        try:
+            for scheduled in traffic:
+                if (delay := started_at + scheduled.at / speed - time.perf_counter()) > 0:
+                    await asyncio.sleep(delay)
+                update = Update.de_json(scheduled.update, application.bot)
+                if update is None:
+                    continue
+                if update.message:
+                    tracker.sent(update.message.chat.id, update.message.message_id)
+                await application.update_queue.put(update)
+            sent_for = time.perf_counter() - started_at
+            try:
+                await asyncio.wait_for(tracker.all_replied.wait(), timeout=drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"{tracker.unanswered} updates were not replied to in {drain_timeout} seconds.")
+            await prompt_scheduler.wait_idle(timeout=drain_timeout)
+        finally:
+            lag_probe.cancel()
+            await application.stop()
+            await bot.post_shutdown(application)
+            await application.shutdown()
+
+    replied_for = (tracker.last_reply_at or time.perf_counter()) - started_at
+    params = {"updates": len(traffic), "speed": speed, "storage": storage}
+    summary = {
+        "updates_sent": len(traffic),
+        "sending_time_s": round(sent_for, 2),
+        "updates_replied": len(tracker.latencies),
+        "updates_unanswered": tracker.unanswered,
+        "replies": tracker.replies,
+        "throughput_per_s": round(len(tracker.latencies) / replied_for, 2) if replied_for > 0 else 0.0,
+        "provider_outcomes": dict(StubProvider.outcomes),
+        "empty_answers": sum(value for *_, value in metrics.empty_answers.samples()),
+        "bot_api_calls": dict(sorted(bot_request.calls.items())),
+        "memory_peak_mb": get_peak_memory_mb(),
+        "memory_peak_growth_mb": round(get_peak_memory_mb() - memory_at_start, 1),
+    }
+    results = []
+    if tracker.latencies:
+        results.append(
+            Result.from_samples(
+                BENCHMARK, "reply_latency", params, tracker.latencies, wall_time=replied_for, extra=summary
+            )
+        )
+    if lag_samples:
+        results.append(Result.from_samples(BENCHMARK, "event_loop_lag", params, lag_samples, wall_time=replied_for))
+    return results, summary
+
+
+def load_provider(path: str) -> type[AsyncGeneratorProvider]:
+    module_name, _, class_name = path.partition(":")
+    provider: type[AsyncGeneratorProvider] = getattr(importlib.import_module(module_name), class_name)
+    return provider
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    traffic_group = parser.add_argument_group("traffic")
+    traffic_group.add_argument("--replay", help="JSON lines file of the updates to replay")
+    traffic_group.add_argument("--record", help="JSON lines file to save the synthetic updates to")
+    traffic_group.add_argument("--rate", type=float, default=10, help="Updates per second")
+    traffic_group.add_argument("--duration", type=float, default=30, help="Seconds of synthetic traffic")
+    traffic_group.add_argument("--speed", type=float, default=1, help="Replay speed factor")
+    traffic_group.add_argument("--chats", type=int, default=100, help="Private chats sending messages")
+    traffic_group.add_argument("--groups", type=int, default=10, help="Group chats sending /ask commands")
+    traffic_group.add_argument("--group-members", type=int, default=50, help="Users sending to the groups")
+    traffic_group.add_argument("--group-share", type=float, default=0.3, help="Share of updates sent to groups")
+    traffic_group.add_argument("--seed", type=int, help="Random seed, to make a run repeatable")
+
+    provider_group = parser.add_argument_group("provider")
+    provider_group.add_argument("--provider", help="Provider class to use instead of the stub one (module:Class)")
+    provider_group.add_argument("--provider-latency", type=float, default=1000, help="Median latency, in ms")
+    provider_group.add_argument("--latency-spread", type=float, default=0.3, help="Log-normal sigma of the latency")
+    provider_group.add_argument("--empty-rate", type=float, default=0, help="Share of empty answers")
+    provider_group.add_argument("--error-rate", type=float, default=0, help="Share of failed requests")
+
+    bot_group = parser.add_argument_group("bot")
+    bot_group.add_argument("--storage", default="local", choices=("local", "journal", "sqlite", "redis"))
+    bot_group.add_argument("--telegram-latency", type=float, default=50, help="Stub Bot API latency, in ms")
+    bot_group.add_argument("--stream", action="store_true", help="Stream the answers (see STREAM_ANSWERS)")
+    bot_group.add_argument("--drain-timeout", type=float, default=120, help="Seconds to wait for the last replies")
+
+    parser.add_argument("--output", help="JSON file to save the results to")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's logs")
+    args = parser.parse_args()
+
+    if application_settings.workers:
+        parser.error("Worker processes would talk to the real Bot API: unset WORKERS")
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.replay:
+        traffic = load_traffic(args.replay, args.rate)
+    else:
+        traffic = list(
+            generate_traffic(
+                rate=args.rate,
+                duration=args.duration,
+                chats=args.chats,
+                groups=args.groups,
+                group_members=args.group_members,
+                group_share=args.group_share,
+            )
+        )
+    if args.record:
+        save_traffic(args.record, traffic)
+
+    if not args.verbose:
+        logger.disable("hiroshi")
+        logger.disable("__main__")
+    # g4f checks for a newer version of itself on the first request, and the default providers are real ones: neither
+    # may be reached from here.
+    g4f.debug.version_check = False
+    gpt_settings.circuit_breaker_fallback = False
+    telegram_settings.stream_answers = args.stream
+    StubProvider.behaviour = ProviderBehaviour(
+        latency=args.provider_latency / 1000,
+        latency_spread=args.latency_spread,
+        empty_rate=args.empty_rate,
+        error_rate=args.error_rate,
+    )
+    register_provider(load_provider(args.provider) if args.provider else StubProvider)
+
+    results, summary = asyncio.run(
+        run(
+            traffic=traffic,
+            storage=args.storage,
+            speed=args.speed,
+            telegram_latency=args.telegram_latency / 1000,
+            drain_timeout=args.drain_timeout,
+        )
+    )
+    if not results:
+        raise SystemExit(f"Nothing was measured: {json.dumps(summary)}")
+    report(results, arguments=vars(args), output=args.output, as_json=args.json)
+    if not args.json:
+        for name, value in summary.items():
+            print(f"{name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Time `handle_prompt` end to end: storage, history, provider call and the Bot API requests answering the prompt.
+
+Nothing leaves the machine: the provider is a stub g4f provider answering after `--provider-latency` milliseconds,
+and the bot talks to a stub Bot API transport answering after `--telegram-latency` milliseconds. With both latencies
+at zero, what's measured is the bot's own overhead. `--chats` chats send `--prompts` prompts each; the chats are served
+concurrently, the prompts of a chat one at a time (as the prompt scheduler does). The storage lives in a temporary
+directory, except Redis, which is the one set by `REDIS` (its chats are not cleaned up).
+
+Usage:
+    python -m benchmarks.prompt_pipeline [--storage local|journal|sqlite|redis] [--chats 10] [--prompts 20]
+    python -m benchmarks.prompt_pipeline --provider-latency 200 --stream --output pipeline.json
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from typing import Any
+
+import g4f.debug
+from loguru import logger
+from telegram import Update
+from telegram.ext import Application, ApplicationBuilder, CallbackContext
+
+from benchmarks.bot_api import StubBotRequest
+from benchmarks.results import Result, Stopwatch, report
+from benchmarks.stubs import (
+    ProviderBehaviour,
+    StubProvider,
+    configure_storage,
+    prepare_chat,
+    register_provider,
+)
+from hiroshi.config import telegram_settings
+from hiroshi.services.bot import handle_prompt
+from hiroshi.services.chat import summary_scheduler
+from hiroshi.services.providers import providers_loader
+from hiroshi.storage.database import close_database
+from scripts.post_webhook_update import make_text_update
+
+BENCHMARK = "prompt_pipeline"
+
+
+async def serve_chat(
+    application: Application,  # type: ignore
+    chat_id: int,
+    prompts: int,
+    first_update_id: int,
+    stopwatch: Stopwatch,
+) -> None:
+    for index in range(prompts):
+        update = Update.de_json(
+            make_text_update(
+                update_id=first_update_id + index, chat_id=chat_id, user_id=chat_id, chat_type="private", text="Hi!"
+            ),
+            application.bot,
+        )
+        assert update
+        context: CallbackContext[Any, Any, Any, Any] = CallbackContext.from_update(update, application)
+        with stopwatch.time():
+            await handle_prompt(update=update, context=context)
+
+
+async def run(
+    storage: str, chats: int, prompts: int, history_length: int, provider_latency: float, telegram_latency: float
+) -> Result:
+    StubProvider.behaviour = ProviderBehaviour(latency=provider_latency)
+    register_provider(StubProvider)
+    bot_request = StubBotRequest(latency=telegram_latency)
+    application = ApplicationBuilder().token(telegram_settings.token).request(bot_request).updater(None).build()
+
+    with tempfile.TemporaryDirectory(prefix="hiroshi-benchmark-") as path:
+        configure_storage(storage, path)
+        await application.initialize()
+        # The bot loads the providers in the background once it's started: that's not what's measured here.
+        await providers_loader.wait()
+        # Every run gets its own chat IDs, so a Redis storage doesn't keep the previous runs' history.
+        first_chat_id = int(time.time() * 1000) * 1000
+        try:
+            for index in range(chats):
+                await prepare_chat(chat_id=first_chat_id + index, history_length=history_length)
+            bot_request.calls.clear()
+            StubProvider.outcomes.clear()
+
+            stopwatch = Stopwatch()
+            started_at = time.perf_counter()
+            await asyncio.gather(
+                *(
+                    serve_chat(application, first_chat_id + index, prompts, index * prompts, stopwatch)
+                    for index in range(chats)
+                )
+            )
+            wall_time = time.perf_counter() - started_at
+        finally:
+            await summary_scheduler.close()
+            await close_database()
+            await application.shutdown()
+
+    prompts_answered = chats * prompts
+    extra = {
+        "provider_calls": sum(StubProvider.outcomes.values()),
+        "bot_api_calls_per_prompt": {
+            method: round(count / prompts_answered, 2) for method, count in sorted(bot_request.calls.items())
+        },
+    }
+    params = {
+        "storage": storage,
+        "chats": chats,
+        "prompts": prompts,
+        "history": history_length,
+        "provider_latency_ms": round(provider_latency * 1000),
+        "telegram_latency_ms": round(telegram_latency * 1000),
+        "stream": telegram_settings.stream_answers,
+    }
+    return Result.from_samples(BENCHMARK, "handle_prompt", params, stopwatch.samples, wall_time=wall_time, extra=extra)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--storage", default="local", choices=("local", "journal", "sqlite", "redis"))
+    parser.add_argument("--chats", type=int, default=10, help="Chats sending prompts at the same time")
+    parser.add_argument("--prompts", type=int, default=20, help="Prompts sent by every chat, one after another")
+    parser.add_argument("--history", type=int, default=10, help="Messages in every chat's history at the start")
+    parser.add_argument("--provider-latency", type=float, default=0, help="Stub provider latency, in milliseconds")
+    parser.add_argument("--telegram-latency", type=float, default=0, help="Stub Bot API latency, in milliseconds")
+    parser.add_argument("--stream", action="store_true", help="Stream the answers (see STREAM_ANSWERS)")
+    parser.add_argument("--output", help="JSON file to save the results to")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    logger.disable("hiroshi")
+    # g4f checks for a newer version of itself on the first request: it's not the bot's work.
+    g4f.debug.version_check = False
+    telegram_settings.stream_answers = args.stream
+    result = asyncio.run(
+        run(
+            storage=args.storage,
+            chats=args.chats,
+            prompts=args.prompts,
+            history_length=args.history,
+            provider_latency=args.provider_latency / 1000,
+            telegram_latency=args.telegram_latency / 1000,
+        )
+    )
+    report([result], arguments=vars(args), output=args.output, as_json=args.json)
+    if not args.json:
+        print(f"Provider calls: {result.extra['provider_calls']}")
+        print(f"Bot API calls per prompt: {result.extra['bot_api_calls_per_prompt']}")
+
+
+if __name__ == "__main__":
+    main()
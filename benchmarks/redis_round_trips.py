@@ -0,0 +1,100 @@
+"""Count Redis round-trips made by each RedisStorage operation.
+
+Every standalone command (including script calls) and every pipeline execution is one round-trip to the server.
+Requires a running Redis server; the selected database is flushed before the run.
+
+Usage:
+    python -m benchmarks.redis_round_trips --redis-url redis://localhost:6379/15 [--json]
+"""
+import argparse
+import asyncio
+import json
+from typing import Any, Awaitable, Callable
+
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+
+from hiroshi.config import gpt_settings
+from hiroshi.models import Message
+from hiroshi.storage.redis import RedisStorage
+
+HISTORY_LENGTHS = (1, 10, 50)
+
+
+class RoundTripCounter:
+    def __init__(self) -> None:
+        self.count = 0
+
+    def install(self) -> None:
+        execute_command = Redis.execute_command
+        execute_pipeline = Pipeline.execute
+        counter = self
+
+        async def counted_execute_command(self: Redis, *args: Any, **options: Any) -> Any:
+            counter.count += 1
+            return await execute_command(self, *args, **options)
+
+        async def counted_execute_pipeline(self: Pipeline, raise_on_error: bool = True) -> Any:
+            counter.count += 1
+            return await execute_pipeline(self, raise_on_error)
+
+        Redis.execute_command = counted_execute_command  # type: ignore[method-assign]
+        Pipeline.execute = counted_execute_pipeline  # type: ignore[method-assign]
+
+    async def measure(self, operation: Callable[[], Awaitable[Any]]) -> int:
+        started_with = self.count
+        await operation()
+        return self.count - started_with
+
+
+async def run(redis_url: str) -> dict[str, dict[str, int]]:
+    storage = await RedisStorage.create(url=redis_url)
+    await storage.redis.flushdb()
+    counter = RoundTripCounter()
+    counter.install()
+
+    results: dict[str, dict[str, int]] = {}
+    for history_length in HISTORY_LENGTHS:
+        chat_id = history_length
+        chat = await storage.get_or_create_chat(chat_id=chat_id)
+        for index in range(history_length - 1):
+            await storage.add_message(
+                chat=chat, message=Message(role="user", content=f"message {index}"), ttl=gpt_settings.messages_ttl
+            )
+        chat = await storage.get_or_create_chat(chat_id=chat_id)
+
+        message = Message(role="user", content="one more message")
+        results[f"{history_length} messages"] = {
+            "get_or_create_chat": await counter.measure(lambda: storage.get_or_create_chat(chat_id=chat_id)),
+            "get_messages": await counter.measure(lambda: storage.get_messages(chat=chat)),
+            "add_message": await counter.measure(
+                lambda: storage.add_message(chat=chat, message=message, ttl=gpt_settings.messages_ttl)
+            ),
+            "save_chat": await counter.measure(lambda: storage.save_chat(chat)),
+            "drop_messages": await counter.measure(lambda: storage.drop_messages(chat=chat)),
+        }
+
+    await storage.redis.flushdb()
+    await storage.close()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(redis_url=args.redis_url))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    operations = list(next(iter(results.values())))
+    print(f"{'history':<14}" + "".join(f"{operation:>20}" for operation in operations))
+    for history, round_trips in results.items():
+        print(f"{history:<14}" + "".join(f"{round_trips[operation]:>20}" for operation in operations))
+
+
+if __name__ == "__main__":
+    main()
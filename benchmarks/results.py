@@ -0,0 +1,141 @@
+"""Timing statistics and the machine-readable results shared by the benchmarks.
+
+Every benchmark produces a list of results, one per measured case: the benchmark and case names, the parameters of the
+case and the latency statistics of its samples. The results are saved along with the commit they were measured at, so
+`benchmarks.compare` can tell the regressions between two runs.
+"""
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, Iterator
+
+RESULTS_FORMAT_VERSION = 1
+
+
+@dataclass
+class Result:
+    benchmark: str
+    case: str
+    params: dict[str, Any]
+    samples: int
+    mean_ms: float
+    median_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+    ops_per_second: float
+    extra: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def key(self) -> str:
+        """What identifies the case across runs."""
+        params = ",".join(f"{name}={value}" for name, value in sorted(self.params.items()))
+        return f"{self.benchmark}/{self.case}[{params}]"
+
+    @classmethod
+    def from_samples(
+        cls,
+        benchmark: str,
+        case: str,
+        params: dict[str, Any],
+        samples: list[float],
+        wall_time: float | None = None,
+        extra: dict[str, Any] | None = None,
+    ) -> "Result":
+        """Summarize the latencies measured (in seconds). The throughput is computed over `wall_time` if the samples
+        were taken concurrently, over their sum otherwise."""
+        if not samples:
+            raise ValueError(f"No samples measured for {benchmark}/{case}")
+        ordered = sorted(samples)
+        total = wall_time if wall_time is not None else sum(ordered)
+        return cls(
+            benchmark=benchmark,
+            case=case,
+            params=params,
+            samples=len(ordered),
+            mean_ms=round(statistics.fmean(ordered) * 1000, 4),
+            median_ms=round(statistics.median(ordered) * 1000, 4),
+            p95_ms=round(_percentile(ordered, 0.95) * 1000, 4),
+            p99_ms=round(_percentile(ordered, 0.99) * 1000, 4),
+            max_ms=round(ordered[-1] * 1000, 4),
+            ops_per_second=round(len(ordered) / total, 2) if total > 0 else 0.0,
+            extra=extra or {},
+        )
+
+
+def _percentile(ordered: list[float], share: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+class Stopwatch:
+    """Collects the durations of the blocks it times."""
+
+    def __init__(self) -> None:
+        self.samples: list[float] = []
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.append(time.perf_counter() - started_at)
+
+
+def _git(*args: str) -> str | None:
+    try:
+        return subprocess.run(("git", *args), capture_output=True, text=True, check=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def get_environment() -> dict[str, Any]:
+    return {
+        "commit": _git("rev-parse", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "measured_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+    }
+
+
+def dump_results(results: list[Result], arguments: dict[str, Any]) -> dict[str, Any]:
+    return {
+        "format": RESULTS_FORMAT_VERSION,
+        "environment": get_environment(),
+        "arguments": arguments,
+        "results": [asdict(result) for result in results],
+    }
+
+
+def load_results(path: str) -> dict[str, Result]:
+    with open(path) as results_file:
+        data = json.load(results_file)
+    if data.get("format") != RESULTS_FORMAT_VERSION:
+        raise ValueError(f"{path}: unsupported results format {data.get('format')}")
+    results = (Result(**result) for result in data["results"])
+    return {result.key: result for result in results}
+
+
+def report(results: list[Result], arguments: dict[str, Any], output: str | None, as_json: bool) -> None:
+    """Save the results to `output` (if set) and print them, as JSON or as a table."""
+    data = dump_results(results, arguments)
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(data, output_file, indent=2)
+    if as_json:
+        print(json.dumps(data, indent=2))
+        return
+
+    key_width = max(len(result.key) for result in results)
+    columns = ("samples", "median_ms", "p95_ms", "p99_ms", "ops_per_second")
+    print(f"{'case':<{key_width}}" + "".join(f"{column:>16}" for column in columns))
+    for result in results:
+        print(f"{result.key:<{key_width}}" + "".join(f"{getattr(result, column):>16}" for column in columns))
@@ -0,0 +1,158 @@
+"""Time the bot's startup in fresh interpreters, and fail if it's over budget.
+
+Every run starts a new Python process which imports `main`, starts the bot against a stub Bot API, sends it `/help`
+and waits for the reply, then for the GPT providers (g4f) being loaded in the background. The cases measured are:
+
+    import       `import main`
+    first_reply  from the start of the import to the reply to `/help`
+    providers    from the start of the import to the providers loaded
+    process      the whole process, the interpreter's own startup and shutdown included
+
+The exit code is 1 if the median of `import` is over `--budget` milliseconds, or if `import main` loads g4f: the
+providers must only be loaded in the background, once the bot is started. The budget depends on the machine, so CI
+jobs and slow hosts (a Raspberry Pi) should set their own.
+
+Usage:
+    python -m benchmarks.startup [--runs 5] [--budget 1000] [--output startup.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+
+from benchmarks.results import Result, report
+
+BENCHMARK = "startup"
+# Whatever could make the bot reach the network or start other processes and servers is turned off.
+CHILD_ENVIRONMENT = {
+    "REDIS": "",
+    "SQLITE": "",
+    "WORKERS": "0",
+    "METRICS_PORT": "0",
+    "MONITORING_URL": "",
+    "TRACING_FILE": "",
+    "TRACING_OTLP_ENDPOINT": "",
+    "WEBHOOK_URL": "",
+}
+
+
+def make_help_update() -> dict[str, Any]:
+    user = {"id": 1, "is_bot": False, "first_name": "Startup", "username": "startup_benchmark_user"}
+    chat = {"id": 1, "type": "private", "first_name": "Startup", "username": "startup_benchmark_user"}
+    message = {
+        "message_id": 1,
+        "date": int(time.time()),
+        "chat": chat,
+        "from": user,
+        "text": "/help",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 5}],
+    }
+    return {"update_id": 1, "message": message}
+
+
+async def serve_first_command(started_at: float) -> dict[str, float]:
+    # Imported once `main` is: they're part of what's measured otherwise.
+    from telegram import Update
+
+    from benchmarks.bot_api import StubBotRequest
+    from hiroshi.services.providers import providers_loader
+    from main import HiroshiBot
+
+    replied = asyncio.Event()
+
+    def listen(method: str, parameters: dict[str, Any]) -> None:
+        if method == "sendMessage":
+            replied.set()
+
+    bot = HiroshiBot()
+    application = bot.build_application(request=StubBotRequest(latency=0, listener=listen))
+    await application.initialize()
+    try:
+        await bot.post_init(application)
+        await application.start()
+        await application.update_queue.put(Update.de_json(make_help_update(), application.bot))
+        await replied.wait()
+        replied_at = time.perf_counter()
+        await providers_loader.wait()
+        loaded_at = time.perf_counter()
+    finally:
+        await application.stop()
+        await bot.post_shutdown(application)
+        await application.shutdown()
+    return {"first_reply": replied_at - started_at, "providers": loaded_at - started_at}
+
+
+def measure_startup() -> dict[str, Any]:
+    """Run in a fresh interpreter: time importing the bot, serving its first command and loading the providers."""
+    started_at = time.perf_counter()
+    import main  # noqa: F401
+
+    imported_at = time.perf_counter()
+    providers_at_import = "g4f" in sys.modules
+    timings = asyncio.run(serve_first_command(started_at))
+    return {"import": imported_at - started_at, "providers_at_import": providers_at_import, **timings}
+
+
+def run_child(path: str) -> dict[str, Any]:
+    """Measure a startup in a new process, its storage and its timings (the bot logs to stdout) kept in `path`."""
+    timings_path = os.path.join(path, "timings.json")
+    started_at = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup", "--child", timings_path],
+        env={**os.environ, **CHILD_ENVIRONMENT, "LOCAL_DATA_PATH": path},
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if completed.returncode:
+        raise SystemExit(f"The bot failed to start:\n{(completed.stdout + completed.stderr)[-4000:]}")
+    with open(timings_path) as file:
+        timings: dict[str, Any] = json.load(file)
+    timings["process"] = time.perf_counter() - started_at
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Processes started")
+    parser.add_argument("--budget", type=float, default=1000, help="Maximum median time (ms) of `import main`")
+    parser.add_argument("--output", help="Save the results to this JSON file")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--child", metavar="PATH", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        timings = measure_startup()
+        with open(args.child, "w") as file:
+            json.dump(timings, file)
+        return
+
+    runs = []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory(prefix="hiroshi-startup-") as path:
+            runs.append(run_child(path))
+
+    params = {"runs": args.runs}
+    cases = ("import", "first_reply", "providers", "process")
+    results = [Result.from_samples(BENCHMARK, case, params, [run[case] for run in runs]) for case in cases]
+    report(results, arguments=vars(args), output=args.output, as_json=args.json)
+
+    failures = []
+    import_time = next(result for result in results if result.case == "import").median_ms
+    if import_time > args.budget:
+        failures.append(f"`import main` took {import_time:.0f} ms (median), over the {args.budget:g} ms budget.")
+    if any(run["providers_at_import"] for run in runs):
+        failures.append("`import main` loads g4f: the providers must only be loaded in the background.")
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Measure the latency of the storage backends' chat operations at varying history lengths and chat counts.
+
+Every backend is filled with `--chats` chats of `--history` messages each (in a temporary directory for the local and
+SQLite ones), then every operation is timed `--operations` times over the chats in turn. Redis is only measured when
+`--redis-url` is passed; the selected database is flushed before and after the run.
+
+Usage:
+    python -m benchmarks.storage [--backends local,journal,sqlite] [--chats 1,100] [--history 10,100]
+    python -m benchmarks.storage --redis-url redis://localhost:6379/15 --output storage.json
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+from typing import Awaitable, Callable
+
+from loguru import logger
+
+from benchmarks.results import Result, Stopwatch, report
+from hiroshi.config import gpt_settings
+from hiroshi.models import Chat, Message
+from hiroshi.storage.abstract import Database
+from hiroshi.storage.journal import JournalStorage
+from hiroshi.storage.local import LocalStorage
+from hiroshi.storage.redis import RedisStorage
+from hiroshi.storage.sqlite import SQLiteStorage
+
+BENCHMARK = "storage"
+LOCAL_BACKENDS = ("local", "journal", "sqlite")
+# `drop_messages` empties a chat, which is filled again (untimed) before it's measured once more. Chats are dropped at
+# least this many times, or `--operations` times if it's less.
+MIN_DROP_SAMPLES = 20
+MESSAGE_CONTENT = (
+    "Could you explain how a write-ahead log keeps a database consistent after a crash, and why it's usually faster "
+    "than writing the pages in place? A short example would help."
+)
+
+
+async def create_storage(backend: str, path: str, redis_url: str | None) -> Database:
+    match backend:
+        case "local":
+            return LocalStorage(path)
+        case "journal":
+            return JournalStorage(path)
+        case "sqlite":
+            return await SQLiteStorage.create(path=os.path.join(path, "hiroshi.sqlite3"))
+        case "redis":
+            assert redis_url
+            storage = await RedisStorage.create(url=redis_url)
+            await storage.redis.flushdb()
+            return storage
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+async def close_storage(storage: Database) -> None:
+    if isinstance(storage, RedisStorage):
+        await storage.redis.flushdb()
+    await storage.close()
+
+
+def make_message(index: int) -> Message:
+    return Message(role="user" if index % 2 == 0 else "assistant", content=f"{index}. {MESSAGE_CONTENT}")
+
+
+async def fill_chat(storage: Database, chat: Chat, history_length: int) -> None:
+    for index in range(history_length):
+        await storage.add_message(chat=chat, message=make_message(index), ttl=gpt_settings.messages_ttl)
+
+
+async def measure(
+    chats: list[Chat], operations: int, operation: Callable[[Chat, int], Awaitable[object]]
+) -> list[float]:
+    stopwatch = Stopwatch()
+    for index in range(operations):
+        chat = chats[index % len(chats)]
+        with stopwatch.time():
+            await operation(chat, index)
+    return stopwatch.samples
+
+
+async def run_case(storage: Database, chat_count: int, history_length: int, operations: int) -> dict[str, list[float]]:
+    # Every case gets its own chat IDs, so the cases don't see each other's chats.
+    first_chat_id = (chat_count * 1_000_000 + history_length) * 10_000
+    chats = [await storage.get_or_create_chat(chat_id=first_chat_id + index) for index in range(chat_count)]
+    for chat in chats:
+        await fill_chat(storage, chat, history_length)
+    # Messages added during the measurement are made beforehand: counting their tokens is not the storage's work.
+    new_messages = [make_message(history_length + index) for index in range(operations)]
+
+    samples = {
+        "get_or_create_chat": await measure(chats, operations, lambda chat, _: storage.get_or_create_chat(chat.id)),
+        "get_messages": await measure(chats, operations, lambda chat, _: storage.get_messages(chat=chat)),
+        "add_message": await measure(
+            chats,
+            operations,
+            lambda chat, index: storage.add_message(
+                chat=chat, message=new_messages[index], ttl=gpt_settings.messages_ttl
+            ),
+        ),
+        "save_chat": await measure(chats, operations, lambda chat, _: storage.save_chat(chat)),
+    }
+
+    drop_stopwatch = Stopwatch()
+    for index in range(min(operations, max(chat_count, MIN_DROP_SAMPLES))):
+        chat = chats[index % chat_count]
+        if index >= chat_count:
+            await fill_chat(storage, chat, history_length)
+        with drop_stopwatch.time():
+            await storage.drop_messages(chat=chat)
+    samples["drop_messages"] = drop_stopwatch.samples
+    return samples
+
+
+async def run(
+    backends: list[str], chat_counts: list[int], history_lengths: list[int], operations: int, redis_url: str | None
+) -> list[Result]:
+    results: list[Result] = []
+    for backend in backends:
+        with tempfile.TemporaryDirectory(prefix="hiroshi-benchmark-") as path:
+            storage = await create_storage(backend, path, redis_url)
+            try:
+                for chat_count in chat_counts:
+                    for history_length in history_lengths:
+                        case_samples = await run_case(storage, chat_count, history_length, operations)
+                        params = {"backend": backend, "chats": chat_count, "history": history_length}
+                        results.extend(
+                            Result.from_samples(BENCHMARK, operation, params, samples)
+                            for operation, samples in case_samples.items()
+                        )
+            finally:
+                await close_storage(storage)
+    return results
+
+
+def parse_numbers(value: str) -> list[int]:
+    return [int(number) for number in value.split(",") if number]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", default=",".join(LOCAL_BACKENDS), help="Comma-separated backends to measure")
+    parser.add_argument("--redis-url", help="Measure RedisStorage too, using this (flushed!) database")
+    parser.add_argument("--chats", type=parse_numbers, default=[1, 100], help="Comma-separated chat counts")
+    parser.add_argument("--history", type=parse_numbers, default=[10, 100], help="Comma-separated history lengths")
+    parser.add_argument("--operations", type=int, default=200, help="Times every operation is measured per case")
+    parser.add_argument("--output", help="JSON file to save the results to")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    backends = [backend for backend in args.backends.split(",") if backend]
+    if args.redis_url and "redis" not in backends:
+        backends.append("redis")
+    if "redis" in backends and not args.redis_url:
+        parser.error("--redis-url is required to measure the Redis storage")
+
+    logger.disable("hiroshi")
+    results = asyncio.run(
+        run(
+            backends=backends,
+            chat_counts=args.chats,
+            history_lengths=args.history,
+            operations=args.operations,
+            redis_url=args.redis_url,
+        )
+    )
+    arguments = {
+        "backends": backends,
+        "chats": args.chats,
+        "history": args.history,
+        "operations": args.operations,
+    }
+    report(results, arguments=arguments, output=args.output, as_json=args.json)
+
+
+if __name__ == "__main__":
+    main()
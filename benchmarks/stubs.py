@@ -0,0 +1,101 @@
+"""Offline stand-ins for the bot's dependencies: a g4f provider and the storage location (see `benchmarks.bot_api`
+for the Bot API).
+
+Nothing they do leaves the machine, so the benchmarks measure the bot itself and can run anywhere.
+"""
+import asyncio
+import math
+import os
+import random
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any
+
+from g4f.Provider import ProviderUtils
+from g4f.providers.base_provider import AsyncGeneratorProvider
+from g4f.typing import AsyncResult, Messages
+
+from hiroshi.config import application_settings, gpt_settings
+from hiroshi.models import Message
+from hiroshi.storage.abstract import Database
+from hiroshi.storage.database import inject_database
+
+STUB_PROVIDER_NAME = "BenchmarkStubProvider"
+STUB_ANSWER = (
+    "A write-ahead log records every change before it's applied, so after a crash the database replays the log "
+    "instead of trusting half-written pages. Appending to a log is sequential I/O, which is why it's usually faster."
+)
+
+
+class StubProviderError(Exception):
+    pass
+
+
+@dataclass
+class ProviderBehaviour:
+    """How the stub provider answers: its median latency (in seconds), the spread of the latency (the sigma of a
+    log-normal distribution, `0` for a constant one) and the shares of empty answers and errors."""
+
+    latency: float = 0.0
+    latency_spread: float = 0.0
+    empty_rate: float = 0.0
+    error_rate: float = 0.0
+
+    def sample_latency(self) -> float:
+        if not self.latency_spread:
+            return self.latency
+        return self.latency * math.exp(random.gauss(0, self.latency_spread))
+
+
+class StubProvider(AsyncGeneratorProvider):  # type: ignore[misc]
+    """Answers every request with `STUB_ANSWER`, word by word, the way `behaviour` says. `outcomes` counts the
+    answers, the empty answers and the errors given."""
+
+    working = True
+    supports_stream = True
+    supports_message_history = True
+    behaviour = ProviderBehaviour()
+    outcomes: Counter[str] = Counter()
+
+    @classmethod
+    async def create_async_generator(cls, model: str, messages: Messages, **kwargs: Any) -> AsyncResult:
+        await asyncio.sleep(cls.behaviour.sample_latency())
+        roll = random.random()
+        if roll < cls.behaviour.error_rate:
+            cls.outcomes["error"] += 1
+            raise StubProviderError("The stub provider failed, as asked")
+        if roll < cls.behaviour.error_rate + cls.behaviour.empty_rate:
+            cls.outcomes["empty"] += 1
+            return
+        cls.outcomes["answer"] += 1
+        for word in STUB_ANSWER.split(" "):
+            yield f"{word} "
+
+
+def register_provider(provider: type[AsyncGeneratorProvider] = StubProvider) -> None:
+    """Make the provider selectable by the chats as `STUB_PROVIDER_NAME` (see `prepare_chat`)."""
+    ProviderUtils.convert[STUB_PROVIDER_NAME] = provider
+
+
+def configure_storage(storage: str, path: str) -> None:
+    """Point the bot's storage (created on first use) to the backend measured, in `path` unless it's Redis (the one
+    set by `REDIS` is used)."""
+    if storage == "redis":
+        if not application_settings.redis:
+            raise SystemExit("Set REDIS to measure the Redis storage")
+        return
+    application_settings.redis = None
+    application_settings.sqlite = os.path.join(path, "hiroshi.sqlite3") if storage == "sqlite" else None
+    application_settings.local_storage_engine = "journal" if storage == "journal" else "pickle"
+    application_settings.local_data_path = path
+
+
+@inject_database
+async def prepare_chat(db: Database, chat_id: int, history_length: int = 0) -> None:
+    """Make the chat talk to the stub provider, with `history_length` messages of history."""
+    chat = await db.get_or_create_chat(chat_id=chat_id)
+    chat.provider_name = STUB_PROVIDER_NAME
+    await db.save_chat(chat)
+    for index in range(history_length):
+        role, content = ("user", f"Question {index}?") if index % 2 == 0 else ("assistant", STUB_ANSWER)
+        await db.add_message(chat=chat, message=Message(role=role, content=content), ttl=gpt_settings.messages_ttl)
@@ -1,12 +1,32 @@
 from functools import lru_cache
+from typing import Any, Literal
 
-from pydantic import BaseSettings, Field
+from pydantic import BaseSettings, Field, validator
 
 
 class ApplicationSettings(BaseSettings):
     redis: str | None = Field(env="REDIS", default=None)
     redis_password: str | None = Field(env="REDIS_PASSWORD", default=None)
+    sqlite: str | None = Field(env="SQLITE", default=None)
     local_data_path: str = Field(env="LOCAL_DATA_PATH", default="/app/data")
+    local_storage_engine: Literal["pickle", "journal"] = Field(env="LOCAL_STORAGE_ENGINE", default="pickle")
+    local_storage_compact_after: int = Field(env="LOCAL_STORAGE_COMPACT_AFTER", default=50)
+    storage_cache_size: int = Field(env="STORAGE_CACHE_SIZE", default=1000)
+    storage_cache_ttl: int = Field(env="STORAGE_CACHE_TTL", default=300)
+    storage_sweep_interval: int = Field(env="STORAGE_SWEEP_INTERVAL", default=3600)
+    storage_sweep_idle_chat_days: int = Field(env="STORAGE_SWEEP_IDLE_CHAT_DAYS", default=30)
+    storage_sweep_rate: int = Field(env="STORAGE_SWEEP_RATE", default=50)
+    prompt_concurrency: int = Field(env="PROMPT_CONCURRENCY", default=16)
+    prompt_queue_size: int = Field(env="PROMPT_QUEUE_SIZE", default=100)
+    prompt_chat_queue_size: int = Field(env="PROMPT_CHAT_QUEUE_SIZE", default=5)
+    workers: int = Field(env="WORKERS", default=0)
+    provider_stats_save_interval: int = Field(env="PROVIDER_STATS_SAVE_INTERVAL", default=60)
+    metrics_listen: str = Field(env="METRICS_LISTEN", default="0.0.0.0")
+    metrics_port: int = Field(env="METRICS_PORT", default=0)
+    tracing_sample_rate: float = Field(env="TRACING_SAMPLE_RATE", default=1.0)
+    tracing_file: str | None = Field(env="TRACING_FILE", default=None)
+    tracing_otlp_endpoint: str | None = Field(env="TRACING_OTLP_ENDPOINT", default=None)
+    tracing_slow_threshold: float = Field(env="TRACING_SLOW_THRESHOLD", default=0)
     log_prompt_data: bool = Field(env="LOG_PROMPT_DATA", default=False)
     monitoring_url: str | None = Field(env="MONITORING_URL", default=None)
     monitoring_frequency_call: int = Field(env="MONITORING_FREQUENCY_CALL", default=300)
@@ -16,6 +36,16 @@ class ApplicationSettings(BaseSettings):
     class Config:
         env_file = ".env"
 
+    @validator("workers")
+    def check_workers_storage(cls, workers: int, values: dict[str, Any]) -> int:
+        if workers > 0 and not values.get("redis") and not values.get("sqlite"):
+            raise ValueError("worker processes need a storage shared between processes: set REDIS or SQLITE")
+        return workers
+
+    @property
+    def storage_sweep_idle_chat_ttl(self) -> int:
+        return self.storage_sweep_idle_chat_days * 24 * 60 * 60
+
 
 @lru_cache()
 def _get_application_settings() -> ApplicationSettings:
@@ -16,6 +16,19 @@ class GPTSettings(BaseSettings):
     proxy: str | None = Field(env="PROXY", default=None)
     timeout: int = Field(env="TIMEOUT", default=60)
     retries: int = Field(env="RETRIES", default=2)
+    circuit_breaker_threshold: int = Field(env="CIRCUIT_BREAKER_THRESHOLD", default=3)
+    circuit_breaker_backoff: float = Field(env="CIRCUIT_BREAKER_BACKOFF", default=30)
+    circuit_breaker_max_backoff: float = Field(env="CIRCUIT_BREAKER_MAX_BACKOFF", default=600)
+    circuit_breaker_fallback: bool = Field(env="CIRCUIT_BREAKER_FALLBACK", default=True)
+    hedge_requests: bool = Field(env="HEDGE_REQUESTS", default=False)
+    hedge_delay: float = Field(env="HEDGE_DELAY", default=10)
+    hedge_percentile: float = Field(env="HEDGE_PERCENTILE", default=90)
+    hedge_max_requests: int = Field(env="HEDGE_MAX_REQUESTS", default=2)
+    summarization_delay: int = Field(env="SUMMARIZATION_DELAY", default=5)
+    response_cache_size: int = Field(env="RESPONSE_CACHE_SIZE", default=0)
+    response_cache_ttl: int = Field(env="RESPONSE_CACHE_TTL", default=3600)
+    response_cache_messages: int = Field(env="RESPONSE_CACHE_MESSAGES", default=0)
+    response_cache_shared: bool = Field(env="RESPONSE_CACHE_SHARED", default=False)
 
     class Config:
         env_file = ".env"
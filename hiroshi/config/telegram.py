@@ -17,8 +17,20 @@ class TelegramSettings(BaseSettings):
         default="You're not allowed to interact with me, sorry. Contact my owner first, please.",
     )
     proxy: str | None = Field(env="PROXY", default=None)
+    rate_limit: float = Field(env="TELEGRAM_RATE_LIMIT", default=30)
+    chat_rate_limit: float = Field(env="TELEGRAM_CHAT_RATE_LIMIT", default=1)
+    group_rate_limit: float = Field(env="TELEGRAM_GROUP_RATE_LIMIT", default=20)
+    max_retries: int = Field(env="TELEGRAM_MAX_RETRIES", default=3)
     users_whitelist: list[str] | None = Field(env="USERS_WHITELIST", default=None)
     show_about: bool = Field(env="SHOW_ABOUT", default=True)
+    show_provider_latency: bool = Field(env="SHOW_PROVIDER_LATENCY", default=True)
+    stream_answers: bool = Field(env="STREAM_ANSWERS", default=False)
+    stream_edit_interval: float = Field(env="STREAM_EDIT_INTERVAL", default=1.5)
+    webhook_url: str | None = Field(env="WEBHOOK_URL", default=None)
+    webhook_path: str = Field(env="WEBHOOK_PATH", default="/telegram")
+    webhook_secret_token: str | None = Field(env="WEBHOOK_SECRET_TOKEN", default=None)
+    webhook_listen: str = Field(env="WEBHOOK_LISTEN", default="0.0.0.0")
+    webhook_port: int = Field(env="WEBHOOK_PORT", default=8080)
 
     class Config:
         env_file = ".env"
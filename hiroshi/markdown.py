@@ -0,0 +1,238 @@
+"""Answers made ready for Telegram before they're sent: Markdown fixed locally, long answers split into messages.
+
+Telegram's (legacy) Markdown has four kinds of entities: `*bold*`, `_italic_`, `` `code` `` (and ```` ``` ```` code
+blocks) and `[links](url)`. An entity lasts until the first character closing it, there is no nesting and no escaping
+inside entities, and a character that opens an entity never closed makes Telegram reject the whole message. Answers
+written in common Markdown (`**bold**`, `# headings`, `snake_case` words...) often are such messages, so they're
+converted before being sent instead of after Telegram rejects them.
+"""
+import re
+from dataclasses import dataclass
+
+from telegram import constants
+
+FENCE = "```"
+MARKDOWN_SPECIAL_CHARACTERS = "_*`["
+# Splitting is done before the Markdown is fixed, which may make the text a bit longer.
+MARKDOWN_RESERVE = 256
+
+HEADING = re.compile(r"#{1,6}[ \t]+([^\n]+)")
+LINK = re.compile(r"\[([^\]\n]+)\]\(([^)\s]+)\)")
+
+
+@dataclass
+class MessageChunk:
+    """A part of an answer small enough to be a Telegram message, in plain text and as Telegram Markdown (unless it
+    can't be expressed in it)."""
+
+    plain: str
+    markdown: str | None
+
+
+def get_message_length(text: str) -> int:
+    """Length of the text as Telegram counts it, in UTF-16 code units."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _is_word_character(character: str) -> bool:
+    return character.isalnum() or character == "_"
+
+
+def is_valid_markdown(text: str) -> bool:
+    """Whether Telegram accepts the text as Markdown: every entity opened is closed."""
+    index, size = 0, len(text)
+    while index < size:
+        character = text[index]
+        if character == "\\" and index + 1 < size and text[index + 1] in MARKDOWN_SPECIAL_CHARACTERS:
+            index += 2
+            continue
+        if character not in MARKDOWN_SPECIAL_CHARACTERS:
+            index += 1
+            continue
+        if text.startswith(FENCE, index):
+            end = text.find(FENCE, index + len(FENCE))
+            if end == -1:
+                return False
+            index = end + len(FENCE)
+            continue
+        end = text.find("]" if character == "[" else character, index + 1)
+        if end == -1:
+            return False
+        index = end + 1
+        if character == "[" and text.startswith("(", index):
+            url_end = text.find(")", index)
+            if url_end == -1:
+                return False
+            index = url_end + 1
+    return True
+
+
+def _find_closing(text: str, marker: str, start: int) -> int:
+    """Position of the `marker` closing an entity opened before `start` on the same line, or -1."""
+    line_end = text.find("\n", start)
+    end = text.find(marker, start, len(text) if line_end == -1 else line_end)
+    return end
+
+
+def to_telegram_markdown(text: str) -> str:
+    """Convert common Markdown to Telegram's: `**bold**` and headings become bold, `__text__` becomes italic, and any
+    special character which would open an entity that is never closed is escaped. Code is kept as is, an unclosed
+    code block is closed."""
+    result: list[str] = []
+    index, size = 0, len(text)
+    while index < size:
+        character = text[index]
+        at_line_start = index == 0 or text[index - 1] == "\n"
+
+        if at_line_start and character == "#" and (heading := HEADING.match(text, index)):
+            title = heading.group(1).strip().replace("*", "")
+            result.append(f"*{title}*" if title else "")
+            index = heading.end()
+            continue
+
+        if character == "\\" and index + 1 < size and text[index + 1] in MARKDOWN_SPECIAL_CHARACTERS:
+            result.append(text[index : index + 2])
+            index += 2
+            continue
+
+        if text.startswith(FENCE, index):
+            end = text.find(FENCE, index + len(FENCE))
+            if end == -1:
+                block = text[index:]
+                result.append(block + ("" if block.endswith("\n") else "\n") + FENCE)
+                break
+            result.append(text[index : end + len(FENCE)])
+            index = end + len(FENCE)
+            continue
+
+        if character == "`":
+            end = _find_closing(text, "`", index + 1)
+            if end > index + 1:
+                result.append(text[index : end + 1])
+                index = end + 1
+            else:
+                result.append("\\`")
+                index += 1
+            continue
+
+        if character == "[":
+            if link := LINK.match(text, index):
+                result.append(link.group(0))
+                index = link.end()
+            else:
+                result.append("\\[")
+                index += 1
+            continue
+
+        if character in "*_":
+            previous = text[index - 1] if index else " "
+            # The common Markdown's double markers: `**bold**` (bold for Telegram too) and `__text__` (italic).
+            if text.startswith(character * 2, index):
+                end = _find_closing(text, character * 2, index + 2)
+                inner = text[index + 2 : end]
+                if end != -1 and inner.strip() and character not in inner:
+                    result.append(f"{'*' if character == '*' else '_'}{inner}{'*' if character == '*' else '_'}")
+                    index = end + 2
+                    continue
+            # A marker opens an entity if it's not inside a word (`snake_case`, `2*3`) and not followed by a space
+            # (`* item`), and the first marker of the same kind later on the line closes it.
+            following = text[index + 1] if index + 1 < size else " "
+            end = _find_closing(text, character, index + 1)
+            if (
+                end != -1
+                and not _is_word_character(previous)
+                and not following.isspace()
+                and not text[index + 1 : end].isspace()
+                and end > index + 1
+                and (end + 1 >= size or not _is_word_character(text[end + 1]))
+            ):
+                result.append(text[index : end + 1])
+                index = end + 1
+            else:
+                result.append(f"\\{character}")
+                index += 1
+            continue
+
+        result.append(character)
+        index += 1
+    return "".join(result)
+
+
+def _split_line(line: str, limit: int) -> list[str]:
+    """Cut a line too long for a message at the spaces, or anywhere if there are none."""
+    parts = []
+    while get_message_length(line) > limit:
+        cut = limit
+        while get_message_length(line[:cut]) > limit:
+            cut -= 1
+        space = line.rfind(" ", 0, cut)
+        if space > cut // 2:
+            cut = space + 1
+        parts.append(line[:cut])
+        line = line[cut:]
+    parts.append(line)
+    return parts
+
+
+def split_text(text: str, limit: int) -> list[str]:
+    """Split the text into parts of at most `limit` characters, between paragraphs if possible, between lines
+    otherwise. A code block split is closed at the end of a part and opened again (with its language) in the next."""
+    if get_message_length(text) <= limit:
+        return [text]
+
+    parts: list[str] = []
+    lines: list[str] = []
+    length = 0
+    # Where the last paragraph outside a code block ended, in `lines`.
+    paragraph_end = 0
+    fence: str | None = None
+    fence_reserve = get_message_length(FENCE) + 1
+
+    def flush(up_to: int) -> None:
+        nonlocal lines, length, paragraph_end
+        part = "".join(lines[:up_to])
+        open_fence = fence if up_to == len(lines) else None
+        if open_fence:
+            part = part + ("" if part.endswith("\n") else "\n") + FENCE
+        if part.strip():
+            parts.append(part)
+        lines = ([f"{open_fence}\n"] if open_fence else []) + lines[up_to:]
+        length = sum(get_message_length(line) for line in lines)
+        paragraph_end = 0
+
+    for line in text.splitlines(keepends=True):
+        for piece in _split_line(line, limit - fence_reserve * 2):
+            reserve = fence_reserve if fence else 0
+            if lines and length + get_message_length(piece) + reserve > limit:
+                # Splitting between paragraphs is preferred, if it doesn't leave the part too short.
+                if paragraph_end and sum(get_message_length(line) for line in lines[:paragraph_end]) > limit // 2:
+                    flush(paragraph_end)
+                else:
+                    flush(len(lines))
+            lines.append(piece)
+            length += get_message_length(piece)
+        stripped = line.strip()
+        if stripped.startswith(FENCE):
+            fence = None if fence else stripped
+            # A line with both fences (```code```) doesn't open a block.
+            if fence and len(stripped) > len(FENCE) and stripped.endswith(FENCE):
+                fence = None
+        elif not stripped and not fence:
+            paragraph_end = len(lines)
+    if lines:
+        fence = None
+        flush(len(lines))
+    return parts
+
+
+def split_answer(text: str, limit: int = constants.MessageLimit.MAX_TEXT_LENGTH) -> list[MessageChunk]:
+    """Split the answer into messages and convert them to Telegram Markdown, as plain text if that fails."""
+    chunks = []
+    for part in split_text(text, limit - MARKDOWN_RESERVE):
+        plain = part.strip("\n")
+        if not plain.strip():
+            continue
+        markdown = to_telegram_markdown(plain)
+        valid = is_valid_markdown(markdown) and get_message_length(markdown) <= limit
+        chunks.append(MessageChunk(plain=plain, markdown=markdown if valid else None))
+    return chunks
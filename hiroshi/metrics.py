@@ -0,0 +1,252 @@
+import math
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Iterator, TypeVar
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+METRICS_PATH = "/metrics"
+
+LabelValues = tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Metric:
+    """A metric exposed in the Prometheus text format, optionally split by labels."""
+
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        # An unlabelled metric is exposed (as zero) even before anything is recorded.
+        self._exposed_from_start = not label_names
+
+    def _label_values(self, labels: dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"The {self.name} metric expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> Iterator[tuple[str, tuple[str, ...], LabelValues, float]]:
+        return iter(())
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for name, label_names, label_values, value in self.samples():
+            lines.append(f"{name}{_format_labels(label_names, label_values)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, label_names)
+        self._values: dict[LabelValues, float] = {(): 0.0} if self._exposed_from_start else {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._label_values(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterator[tuple[str, tuple[str, ...], LabelValues, float]]:
+        for key, value in self._values.items():
+            yield f"{self.name}_total", self.label_names, key, value
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, label_names)
+        self._values: dict[LabelValues, float] = {(): 0.0} if self._exposed_from_start else {}
+        self._function: Callable[[], float] | None = None
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._label_values(labels)] = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Read the (unlabelled) value from `function` on every scrape."""
+        self._values.pop((), None)
+        self._function = function
+
+    def samples(self) -> Iterator[tuple[str, tuple[str, ...], LabelValues, float]]:
+        if self._function:
+            yield self.name, (), (), self._function()
+        for key, value in self._values.items():
+            yield self.name, self.label_names, key, value
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts: dict[LabelValues, list[int]] = {}
+        self._sums: dict[LabelValues, float] = {}
+        if self._exposed_from_start:
+            self._counts[()] = [0] * len(self.buckets)
+            self._sums[()] = 0.0
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        if key not in self._counts:
+            self._counts[key] = [0] * len(self.buckets)
+            self._sums[key] = 0.0
+        counts = self._counts[key]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def samples(self) -> Iterator[tuple[str, tuple[str, ...], LabelValues, float]]:
+        bucket_label_names = self.label_names + ("le",)
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket", bucket_label_names, key + (_format_value(bound),), cumulative
+            yield f"{self.name}_sum", self.label_names, key, self._sums[key]
+            yield f"{self.name}_count", self.label_names, key, cumulative
+
+
+M = TypeVar("M", bound=Metric)
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: M) -> M:
+        if metric.name in self._metrics:
+            raise ValueError(f"The {metric.name} metric is registered already")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "".join(metric.render() for metric in self._metrics.values())
+
+
+registry = MetricsRegistry()
+
+provider_request_duration = registry.register(
+    Histogram(
+        "hiroshi_provider_request_duration_seconds",
+        "Time providers took to answer (or fail).",
+        ("model", "provider", "outcome"),
+    )
+)
+storage_operation_duration = registry.register(
+    Histogram(
+        "hiroshi_storage_operation_duration_seconds",
+        "Time storage backend operations took.",
+        ("backend", "method"),
+    )
+)
+storage_cache_requests = registry.register(
+    Counter(
+        "hiroshi_storage_cache_requests",
+        "Chats looked up in the storage cache, by outcome (hit or miss).",
+        ("outcome",),
+    )
+)
+telegram_request_duration = registry.register(
+    Histogram("hiroshi_telegram_request_duration_seconds", "Time Telegram Bot API calls took.", ("method", "status"))
+)
+prompt_duration = registry.register(
+    Histogram("hiroshi_prompt_duration_seconds", "Time taken to answer a prompt, from the start to the answer sent.")
+)
+empty_answers = registry.register(Counter("hiroshi_empty_answers", "Prompts no provider gave a non-empty answer to."))
+provider_retries = registry.register(
+    Counter("hiroshi_provider_retries", "Provider requests repeated after an empty answer.")
+)
+summarizations = registry.register(
+    Counter("hiroshi_summarizations", "Conversation history summarizations.", ("outcome",))
+)
+markdown_fallbacks = registry.register(
+    Counter("hiroshi_markdown_fallbacks", "Answers sent in plain text since Telegram couldn't parse their Markdown.")
+)
+response_cache_requests = registry.register(
+    Counter(
+        "hiroshi_response_cache_requests",
+        "Provider requests looked up in the response cache, by outcome (hit, shared_hit, coalesced or miss).",
+        ("outcome",),
+    )
+)
+background_tasks = registry.register(
+    Gauge("hiroshi_background_tasks", "Update handling tasks running in the background.")
+)
+prompts_in_flight = registry.register(Gauge("hiroshi_prompts_in_flight", "Prompts being answered."))
+prompts_queued = registry.register(Gauge("hiroshi_prompts_queued", "Prompts waiting to be answered."))
+prompt_queue_wait = registry.register(
+    Histogram("hiroshi_prompt_queue_wait_seconds", "Time prompts waited in the queue before being answered.")
+)
+telegram_requests_queued = registry.register(
+    Gauge("hiroshi_telegram_requests_queued", "Bot API requests waiting for the rate limiter.", ("priority",))
+)
+telegram_queue_wait = registry.register(
+    Histogram(
+        "hiroshi_telegram_queue_wait_seconds",
+        "Time Bot API requests waited for the rate limiter before being sent.",
+        ("priority",),
+    )
+)
+telegram_chat_actions_dropped = registry.register(
+    Counter("hiroshi_telegram_chat_actions_dropped", "Chat actions dropped by the rate limiter instead of sent late.")
+)
+telegram_flood_waits = registry.register(
+    Counter("hiroshi_telegram_flood_waits", "Bot API requests Telegram answered with a RetryAfter error.", ("method",))
+)
+
+
+async def handle_metrics(request: "web.Request") -> "web.Response":
+    from aiohttp import web
+
+    return web.Response(
+        body=registry.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+
+async def start_metrics_server(listen: str, port: int) -> "web.AppRunner":
+    # aiohttp takes a while to import and is only needed when the metrics are served.
+    from aiohttp import web
+
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host=listen, port=port).start()
+    logger.info(f"Metrics are served on {listen}:{port}{METRICS_PATH}")
+    return runner
@@ -1,11 +1,16 @@
+import math
 import time
+from typing import TYPE_CHECKING, Any, ClassVar
 
-from g4f.models import Model, ModelUtils
-from g4f.models import default as default_model
-from g4f.Provider import ProviderUtils, RetryProvider
-from g4f.providers.types import BaseProvider
 from loguru import logger
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, root_validator, validator
+
+from hiroshi.tokenizer import count_message_tokens
+
+if TYPE_CHECKING:
+    from g4f.models import Model
+    from g4f.Provider import RetryProvider
+    from g4f.providers.types import BaseProvider
 
 
 class Message(BaseModel):
@@ -13,6 +18,23 @@ class Message(BaseModel):
     role: str
     content: str
     expire_at: float | None = None
+    tokens: int = 0
+
+    @validator("tokens", always=True)
+    def count_tokens(cls, tokens: int, values: dict[str, Any]) -> int:
+        if tokens or "content" not in values:
+            return tokens
+        return count_message_tokens(values["content"])
+
+    def __setstate__(self, state: Any) -> None:
+        # Messages pickled before the token accounting was introduced have no token count stored.
+        if "tokens" not in state["__dict__"]:
+            state["__dict__"]["tokens"] = count_message_tokens(state["__dict__"]["content"])
+        super().__setstate__(state)
+
+    @property
+    def is_expired(self) -> bool:
+        return self.expire_at is not None and self.expire_at <= time.time()
 
 
 class Chat(BaseModel):
@@ -20,9 +42,39 @@ class Chat(BaseModel):
     provider_name: str | None = None
     model_name: str = "gpt_35_long"
     messages: list[Message] = Field(default_factory=list)
+    history_tokens: int = 0
+    summary_message_id: int | None = None
+
+    @root_validator(skip_on_failure=True)
+    def count_history_tokens(cls, values: dict[str, Any]) -> dict[str, Any]:
+        values["history_tokens"] = sum(message.tokens for message in values["messages"])
+        return values
+
+    def __setstate__(self, state: Any) -> None:
+        super().__setstate__(state)
+        self.history_tokens = sum(message.tokens for message in self.messages)
+
+    def append_message(self, message: Message) -> None:
+        self.messages.append(message)
+        self.history_tokens += message.tokens
+
+    def replace_messages(self, messages: list[Message]) -> None:
+        self.messages = messages
+        self.history_tokens = sum(message.tokens for message in messages)
+
+    def drop_expired_messages(self) -> int:
+        live_messages = [message for message in self.messages if not message.is_expired]
+        expired = len(self.messages) - len(live_messages)
+        if expired:
+            self.replace_messages(live_messages)
+        return expired
 
     @property
-    def provider(self) -> BaseProvider | RetryProvider:
+    def provider(self) -> "BaseProvider | RetryProvider":
+        # g4f is imported by the time a chat talks to a provider (see `hiroshi.services.providers`).
+        from g4f.models import default as default_model
+        from g4f.Provider import ProviderUtils
+
         if not self.provider_name:
             return default_model.best_provider
         if active_provider := ProviderUtils.convert.get(self.provider_name):
@@ -34,7 +86,74 @@ class Chat(BaseModel):
         return default_model.best_provider
 
     @property
-    def model(self) -> Model:
+    def model(self) -> "Model":
+        from g4f.models import ModelUtils
+        from g4f.models import default as default_model
+
         if active_model := ModelUtils.convert.get(self.model_name):
             return active_model
         return default_model
+
+
+class ProviderStats(BaseModel):
+    """Health of a provider serving a model: latency of its answers, rates of empty answers and errors.
+
+    The rates and the average latency are exponentially weighted, so the recent calls matter most. Percentiles are
+    calculated over the latencies of the last `LATENCY_SAMPLES` answers.
+    """
+
+    LATENCY_SAMPLES: ClassVar[int] = 100
+    SMOOTHING: ClassVar[float] = 0.2
+
+    model_name: str
+    provider_name: str
+    requests: int = 0
+    empty_answers: int = 0
+    errors: int = 0
+    latency_ewma: float | None = None
+    empty_answer_rate: float = 0.0
+    error_rate: float = 0.0
+    latencies: list[float] = Field(default_factory=list)
+
+    def _smooth(self, average: float, value: float) -> float:
+        return average + self.SMOOTHING * (value - average)
+
+    def record(self, latency: float, answered: bool, failed: bool = False) -> None:
+        self.requests += 1
+        self.empty_answers += not answered and not failed
+        self.errors += failed
+        self.empty_answer_rate = self._smooth(self.empty_answer_rate, not answered and not failed)
+        self.error_rate = self._smooth(self.error_rate, failed)
+        if answered:
+            self.latency_ewma = latency if self.latency_ewma is None else self._smooth(self.latency_ewma, latency)
+            self.latencies.append(latency)
+            del self.latencies[: -self.LATENCY_SAMPLES]
+
+    def get_latency_percentile(self, percentile: float) -> float | None:
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[max(math.ceil(percentile / 100 * len(latencies)) - 1, 0)]
+
+    @property
+    def score(self) -> float:
+        """Expected time to get an answer: the average latency penalized by the share of failed requests (lower is
+        better)."""
+        if self.latency_ewma is None:
+            return math.inf
+        return self.latency_ewma / max(1 - self.empty_answer_rate - self.error_rate, 0.05)
+
+
+class SweepReport(BaseModel):
+    chats_checked: int = 0
+    chats_deleted: int = 0
+    messages_deleted: int = 0
+    bytes_reclaimed: int = 0
+
+    def __add__(self, other: "SweepReport") -> "SweepReport":
+        return SweepReport(
+            chats_checked=self.chats_checked + other.chats_checked,
+            chats_deleted=self.chats_deleted + other.chats_deleted,
+            messages_deleted=self.messages_deleted + other.messages_deleted,
+            bytes_reclaimed=self.bytes_reclaimed + other.bytes_reclaimed,
+        )
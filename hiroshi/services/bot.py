@@ -1,28 +1,43 @@
-import asyncio
-
 from loguru import logger
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, constants
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes
 
-from hiroshi.config import application_settings, gpt_settings
+from hiroshi.config import application_settings, gpt_settings, telegram_settings
+from hiroshi.metrics import (
+    empty_answers,
+    prompt_duration,
+    prompts_in_flight,
+    prompts_queued,
+)
 from hiroshi.services.chat import (
-    check_history_and_summarize,
     get_gtp_chat_answer,
     reset_chat_history,
     set_active_provider,
+    summary_scheduler,
 )
-from hiroshi.services.gpt import retrieve_available_providers
+from hiroshi.services.chat_actions import chat_action_ticker
+from hiroshi.services.providers import providers_loader
+from hiroshi.services.scheduler import PromptScheduler
+from hiroshi.services.streaming import AnswerStreamer
 from hiroshi.storage.abstract import Database
 from hiroshi.storage.database import inject_database
+from hiroshi.tracing import TraceContext, tracer
 from hiroshi.utils import (
+    PERSONAL_CHAT_TYPES,
     get_prompt_with_replied_message,
     get_telegram_chat,
     get_telegram_message,
     get_telegram_user,
     handle_gpt_exceptions,
-    send_gpt_answer_message,
+    send_message,
+    user_is_group_admin,
 )
 
+# Share of the bot's attention (see `PromptScheduler`) a chat gets when it competes with group chats.
+PRIVATE_CHAT_PROMPT_WEIGHT = 3
+GROUP_ADMIN_PROMPT_WEIGHT = 3
+GROUP_CHAT_PROMPT_WEIGHT = 1
+
 
 async def handle_provider_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
@@ -42,22 +57,22 @@ async def handle_provider_selection(update: Update, context: ContextTypes.DEFAUL
 
 @handle_gpt_exceptions
 @inject_database
-async def handle_prompt(db: Database, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def handle_prompt(
+    db: Database,
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    previous_updates: list[Update] | None = None,
+) -> None:
+    """Answer the prompt along with the prompts of `previous_updates` merged into it, in reply to `update`."""
     telegram_user = get_telegram_user(update=update)
     telegram_chat = get_telegram_chat(update=update)
-    telegram_message = get_telegram_message(update=update)
-    prompt = telegram_message.text
     hiroshi_user = await db.get_or_create_chat(chat_id=telegram_chat.id)
 
+    prompts = [get_prompt(update=prompt_update) for prompt_update in [*(previous_updates or []), update]]
+    prompt = "\n".join(prompt for prompt in prompts if prompt)
     if not prompt:
         return None
 
-    if prompt.startswith("/ask"):
-        prompt = prompt.replace("/ask", "", 1).strip()
-
-    # Get replied message concatenated to the prompt.
-    prompt = get_prompt_with_replied_message(update=update, initial_prompt=prompt)
-
     prompt_to_log = prompt.replace("\r", " ").replace("\n", " ")
     logger.info(
         f"{telegram_user.name} (Telegram ID: {telegram_user.id}) sent a new message in the "
@@ -65,13 +80,18 @@ async def handle_prompt(db: Database, update: Update, context: ContextTypes.DEFA
         f"{': ' + prompt_to_log if application_settings.log_prompt_data else ''}"
     )
 
-    get_gtp_chat_answer_task = asyncio.ensure_future(get_gtp_chat_answer(chat_id=telegram_chat.id, prompt=prompt))
-
-    while not get_gtp_chat_answer_task.done():
-        await context.bot.send_chat_action(chat_id=telegram_chat.id, action=constants.ChatAction.TYPING)
-        await asyncio.sleep(2.5)
-
-    gpt_answer = await get_gtp_chat_answer_task
+    answer_streamer = AnswerStreamer(
+        update=update, context=context, edit_interval=telegram_settings.stream_edit_interval
+    )
+    # Once the answer is being shown, there is no need to tell the user the bot is typing.
+    async with chat_action_ticker.typing(
+        bot=context.bot, chat_id=telegram_chat.id, is_paused=lambda: answer_streamer.started
+    ):
+        gpt_answer = await get_gtp_chat_answer(
+            chat_id=telegram_chat.id,
+            prompt=prompt,
+            on_update=answer_streamer.update if telegram_settings.stream_answers else None,
+        )
 
     if not gpt_answer:
         logger.warning(
@@ -84,7 +104,8 @@ async def handle_prompt(db: Database, update: Update, context: ContextTypes.DEFA
             f"{gpt_settings.retries} times but didn't succeed. Please, try again a bit later or, maybe, switch "
             f"to another model/provider."
         )
-        await send_gpt_answer_message(gpt_answer=sorry_answer, update=update, context=context)
+        empty_answers.inc()
+        await answer_streamer.finish(text=sorry_answer)
         return None
 
     answer_to_log = gpt_answer.replace("\r", " ").replace("\n", " ")
@@ -96,10 +117,81 @@ async def handle_prompt(db: Database, update: Update, context: ContextTypes.DEFA
         f"({hiroshi_user.model_name.upper()}) in the {telegram_chat.type.upper()} chat {telegram_chat.id}. "
         f"{logged_answer}"
     )
-    await send_gpt_answer_message(gpt_answer=gpt_answer, update=update, context=context)
-    history_is_summarized = await check_history_and_summarize(chat_id=telegram_chat.id)
-    if history_is_summarized:
-        logger.info(f"{telegram_user.name} (Telegram ID: {telegram_user.id}) history successfully summarized.")
+    await answer_streamer.finish(text=gpt_answer)
+    summary_scheduler.request(chat_id=telegram_chat.id)
+
+
+def get_prompt(update: Update) -> str | None:
+    prompt = get_telegram_message(update=update).text
+    if not prompt:
+        return None
+
+    if prompt.startswith("/ask"):
+        prompt = prompt.replace("/ask", "", 1).strip()
+
+    # Get replied message concatenated to the prompt.
+    return get_prompt_with_replied_message(update=update, initial_prompt=prompt)
+
+
+# A queued prompt: the update, its callback context and the trace of the update (if it's traced).
+QueuedUpdate = tuple[Update, ContextTypes.DEFAULT_TYPE, TraceContext | None]
+
+
+async def handle_queued_prompts(prompts: list[QueuedUpdate]) -> None:
+    """Answer the prompts a user sent while the previous prompt of the chat was being answered, all at once."""
+    *previous_prompts, (update, context, trace_context) = prompts
+    if previous_prompts:
+        telegram_chat = get_telegram_chat(update=update)
+        logger.info(f"{len(prompts)} prompts in the chat {telegram_chat.id} merged into a single request.")
+    # The answer is traced as part of the last update's trace, the ones of the prompts merged into it are referenced.
+    merged_traces = ",".join(previous[2].trace_id for previous in previous_prompts if previous[2])
+    with tracer.continue_trace("answer_prompt", trace_context, prompts=len(prompts)), prompt_duration.time():
+        if merged_traces:
+            tracer.set_attribute("merged_traces", merged_traces)
+        await handle_prompt(
+            update=update,
+            context=context,
+            previous_updates=[prompt_update for prompt_update, _, _ in previous_prompts],
+        )
+
+
+prompt_scheduler: PromptScheduler[QueuedUpdate] = PromptScheduler(
+    handler=handle_queued_prompts,
+    max_in_flight=application_settings.prompt_concurrency,
+    max_queue_size=application_settings.prompt_queue_size,
+    max_chat_queue_size=application_settings.prompt_chat_queue_size,
+)
+prompts_in_flight.set_function(lambda: prompt_scheduler.in_flight)
+prompts_queued.set_function(lambda: prompt_scheduler.queued)
+
+
+def get_prompt_weight(update: Update) -> int:
+    telegram_chat = get_telegram_chat(update=update)
+    if telegram_chat.type in PERSONAL_CHAT_TYPES:
+        return PRIVATE_CHAT_PROMPT_WEIGHT
+    if telegram_settings.group_admins and user_is_group_admin(tg_user=get_telegram_user(update=update)):
+        return GROUP_ADMIN_PROMPT_WEIGHT
+    return GROUP_CHAT_PROMPT_WEIGHT
+
+
+def schedule_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Queue the prompt to be answered. Returns False if the bot is too busy to accept it."""
+    telegram_chat = get_telegram_chat(update=update)
+    telegram_user = get_telegram_user(update=update)
+    return prompt_scheduler.submit(
+        chat_id=telegram_chat.id,
+        payload=(update, context, tracer.get_trace_context()),
+        weight=get_prompt_weight(update=update),
+        merge_key=telegram_user.id,
+    )
+
+
+async def handle_overload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    text = (
+        "Phew, I've got too many questions at the moment 😅 Please, give me a minute and ask again. "
+        "I'll be happy to answer!"
+    )
+    await send_message(update=update, context=context, text=text)
 
 
 async def handle_reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -112,6 +204,17 @@ async def handle_reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 
 async def handle_available_providers_options() -> InlineKeyboardMarkup:
+    await providers_loader.wait()
+    from hiroshi.services.gpt import retrieve_available_providers
+
     models_available = retrieve_available_providers()
-    keyboard = [[InlineKeyboardButton(model.upper(), callback_data=model)] for model in models_available]
+    keyboard = [[InlineKeyboardButton(get_option_label(model), callback_data=model)] for model in models_available]
     return InlineKeyboardMarkup(keyboard)
+
+
+def get_option_label(option: str) -> str:
+    from hiroshi.services.gpt import get_option_latency
+
+    if telegram_settings.show_provider_latency and (latency := get_option_latency(option)) is not None:
+        return f"{option.upper()} (~{latency:.1f}s)"
+    return option.upper()
@@ -1,57 +1,127 @@
+import asyncio
+import time
+from typing import Awaitable, Callable
+from weakref import WeakValueDictionary
+
 from loguru import logger
 
 from hiroshi.config import gpt_settings
+from hiroshi.metrics import summarizations
 from hiroshi.models import Message
-from hiroshi.services.gpt import MODELS_AND_PROVIDERS, get_chat_response
+from hiroshi.services.providers import MODELS_AND_PROVIDERS, providers_loader
+from hiroshi.services.summarizer import ProviderActivity, SummaryScheduler
 from hiroshi.storage.abstract import Database
 from hiroshi.storage.database import inject_database
 
+_chat_locks: WeakValueDictionary[int, asyncio.Lock] = WeakValueDictionary()
+
+
+def get_chat_lock(chat_id: int) -> asyncio.Lock:
+    """Lock serializing the changes of the chat history, so the summary can't overwrite messages added meanwhile."""
+    if (lock := _chat_locks.get(chat_id)) is None:
+        lock = asyncio.Lock()
+        _chat_locks[chat_id] = lock
+    return lock
+
 
 @inject_database
 async def set_active_provider(db: Database, chat_id: int, provider_selected: str) -> None:
     model_name, provider_name = MODELS_AND_PROVIDERS.get(provider_selected, ("gpt_35_long", "Default"))
-    chat = await db.get_or_create_chat(chat_id=chat_id)
-    chat.provider_name = provider_name if provider_name != "Default" else None
-    chat.model_name = model_name
-    await db.save_chat(chat)
+    async with get_chat_lock(chat_id):
+        chat = await db.get_or_create_chat(chat_id=chat_id)
+        chat.provider_name = provider_name if provider_name != "Default" else None
+        chat.model_name = model_name
+        await db.save_chat(chat)
 
 
 @inject_database
 async def reset_chat_history(db: Database, chat_id: int) -> None:
-    chat = await db.get_or_create_chat(chat_id=chat_id)
-    await db.drop_messages(chat=chat)
+    async with get_chat_lock(chat_id):
+        chat = await db.get_or_create_chat(chat_id=chat_id)
+        await db.drop_messages(chat=chat)
 
 
 @inject_database
-async def summarize(db: Database, chat_id: int) -> None:
+async def summarize(db: Database, chat_id: int) -> bool:
+    """Fold the messages added since the last summary into a new one.
+
+    The provider is asked without holding the chat lock. Messages added while it answers are kept as they are, and the
+    summary is thrown away if the history was reset (or expired) in the meantime.
+    """
+    await providers_loader.wait()
+    from hiroshi.services.gpt import fetch_chat_response
+
     chat = await db.get_or_create_chat(chat_id=chat_id)
+    live_messages = [msg for msg in chat.messages if not msg.is_expired]
+    previous_summary = next((msg for msg in live_messages if msg.id == chat.summary_message_id), None)
+    new_messages = [msg for msg in live_messages if msg.role != "system" and msg is not previous_summary]
+    if not new_messages:
+        return False
 
-    chat_history = await db.get_messages(chat=chat)
+    if previous_summary:
+        instruction = (
+            f"Here is a summary of the conversation so far: {previous_summary.content}\n"
+            "Update it with the new messages of this conversation. Keep it 700 characters or less"
+        )
+    else:
+        instruction = "Summarize this conversation in 700 characters or less"
     query_messages = [
-        {
-            "role": "assistant",
-            "content": "Summarize this conversation in 700 characters or less",
-        },
-        {"role": "user", "content": str(chat_history)},
+        {"role": "assistant", "content": instruction},
+        {"role": "user", "content": str([msg.dict(include={"role", "content"}) for msg in new_messages])},
     ]
-    answer = await get_chat_response(messages=query_messages, provider=chat.provider, model=chat.model)
+    # Summaries depend on the whole history, they can't be reused: the response cache is bypassed.
+    answer = await fetch_chat_response(messages=query_messages, provider=chat.provider, model=chat.model)
     if not answer:
         logger.warning(f"Could not summarize history for chat {chat_id}: empty response received from the Provider.")
-        return None
-    answer_message = Message(role="assistant", content=answer)
-    await reset_chat_history(chat_id=chat_id)
-    await db.add_message(chat=chat, message=answer_message, ttl=gpt_settings.messages_ttl)
+        summarizations.inc(outcome="empty")
+        return False
+
+    folded_ids = {msg.id for msg in new_messages}
+    if previous_summary:
+        folded_ids.add(previous_summary.id)
+
+    async with get_chat_lock(chat_id):
+        chat = await db.get_or_create_chat(chat_id=chat_id)
+        if not folded_ids <= {msg.id for msg in chat.messages}:
+            logger.info(f"History of the chat {chat_id} changed while being summarized. The summary is discarded.")
+            summarizations.inc(outcome="discarded")
+            return False
+
+        # The summary takes the place of the last message it covers, ahead of the ones added after it was requested.
+        summary_message = Message(
+            id=new_messages[-1].id,
+            role="assistant",
+            content=answer,
+            expire_at=time.time() + gpt_settings.messages_ttl,
+        )
+        kept_messages = [msg for msg in chat.messages if msg.id not in folded_ids]
+        chat.replace_messages(sorted(kept_messages + [summary_message], key=lambda msg: msg.id))
+        chat.summary_message_id = summary_message.id
+        await db.save_chat(chat)
+    summarizations.inc(outcome="summarized")
+    return True
 
 
 @inject_database
-async def get_gtp_chat_answer(db: Database, chat_id: int, prompt: str) -> str | None:
+async def get_gtp_chat_answer(
+    db: Database, chat_id: int, prompt: str, on_update: Callable[[str], Awaitable[None]] | None = None
+) -> str | None:
+    await providers_loader.wait()
+    from hiroshi.services.gpt import get_chat_response
+
     chat = await db.get_or_create_chat(chat_id=chat_id)
     query_message = Message(role="user", content=prompt)
-    await db.add_message(chat=chat, message=query_message, ttl=gpt_settings.messages_ttl)
+    async with get_chat_lock(chat_id):
+        await db.add_message(chat=chat, message=query_message, ttl=gpt_settings.messages_ttl)
     conversation_messages = await db.get_messages(chat=chat)
-    if answer := await get_chat_response(messages=conversation_messages, provider=chat.provider, model=chat.model):
+    async with provider_activity.track():
+        answer = await get_chat_response(
+            messages=conversation_messages, provider=chat.provider, model=chat.model, on_update=on_update
+        )
+    if answer:
         answer_message = Message(role="assistant", content=answer)
-        await db.add_message(chat=chat, message=answer_message, ttl=gpt_settings.messages_ttl)
+        async with get_chat_lock(chat_id):
+            await db.add_message(chat=chat, message=answer_message, ttl=gpt_settings.messages_ttl)
         return answer
     return None
 
@@ -60,10 +130,14 @@ async def get_gtp_chat_answer(db: Database, chat_id: int, prompt: str) -> str |
 async def check_history_and_summarize(db: Database, chat_id: int) -> bool:
     chat = await db.get_or_create_chat(chat_id=chat_id)
 
-    # Roughly estimating how many tokens the current conversation history will comprise. It is possible to calculate
-    # this accurately, but the modules that can be used for this need to be separately built for armv7, which is
-    # difficult to do right now (but will be done further, I hope).
-    if len(str(chat.messages)) / 4 >= gpt_settings.max_history_tokens:
-        await summarize(chat_id=chat_id)
-        return True
+    # The token count is kept up to date on every write, so there is nothing to recount here.
+    if chat.history_tokens >= gpt_settings.max_history_tokens:
+        is_summarized: bool = await summarize(chat_id=chat_id)
+        return is_summarized
     return False
+
+
+provider_activity = ProviderActivity()
+summary_scheduler = SummaryScheduler(
+    summarize=check_history_and_summarize, activity=provider_activity, delay=gpt_settings.summarization_delay
+)
@@ -0,0 +1,110 @@
+import asyncio
+import time
+from asyncio import Task
+from contextlib import asynccontextmanager, suppress
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable
+
+from loguru import logger
+from telegram import Bot, constants
+
+# Telegram shows a chat action for 5 seconds (or until the bot's next message), so it's sent again a bit earlier.
+CHAT_ACTION_REFRESH_INTERVAL = 4.5
+# Chat actions are Bot API calls like any other: they count towards the bot's overall limit (about 30 per second).
+MAX_CHAT_ACTIONS_PER_SECOND = 20
+
+
+@dataclass
+class ChatActivity:
+    bot: Bot
+    action: str
+    # How many prompts of the chat are being answered, and whether the answers are shown (e.g. streamed) already.
+    waiting: int = 1
+    is_paused: Callable[[], bool] | None = None
+    next_at: float = 0.0
+
+
+class ChatActionTicker:
+    """Shows "typing..." in the chats waiting for an answer, with a single refresh schedule for all of them.
+
+    A chat is registered with `typing()` while its answer is being prepared. The action is sent right away, then
+    refreshed every `interval` seconds until the last prompt of the chat is answered, but only once per chat however
+    many prompts it's waiting for. Actions are sent no more often than `max_per_second` times per second overall: when
+    many chats are due at once, the rest are refreshed in the next seconds.
+    """
+
+    def __init__(self, interval: float, max_per_second: int) -> None:
+        self.interval = interval
+        self.max_per_second = max_per_second
+        self.sent = 0
+        self._chats: dict[int, ChatActivity] = {}
+        self._wake_up = asyncio.Event()
+        self._ticker: Task[None] | None = None
+
+    @property
+    def active_chats(self) -> int:
+        return len(self._chats)
+
+    @asynccontextmanager
+    async def typing(
+        self,
+        bot: Bot,
+        chat_id: int,
+        action: str = constants.ChatAction.TYPING,
+        is_paused: Callable[[], bool] | None = None,
+    ) -> AsyncIterator[None]:
+        """Show `action` in the chat until the block is left. Nothing is sent while `is_paused()` is true."""
+        if activity := self._chats.get(chat_id):
+            activity.waiting += 1
+            activity.action, activity.is_paused = action, is_paused
+        else:
+            self._chats[chat_id] = ChatActivity(bot=bot, action=action, is_paused=is_paused)
+            self._wake_up.set()
+        if self._ticker is None or self._ticker.done():
+            self._ticker = asyncio.create_task(self._tick())
+        try:
+            yield
+        finally:
+            activity = self._chats[chat_id]
+            activity.waiting -= 1
+            if not activity.waiting:
+                del self._chats[chat_id]
+                if not self._chats:
+                    # Nothing left to refresh: the ticker stops until a chat is registered again.
+                    self._wake_up.set()
+
+    async def _send(self, chat_id: int, activity: ChatActivity) -> None:
+        try:
+            await activity.bot.send_chat_action(chat_id=chat_id, action=activity.action)
+            self.sent += 1
+        except Exception as e:
+            logger.warning(f"Couldn't send the chat action to the chat {chat_id}: {str(e)[:240]}")
+
+    async def _tick(self) -> None:
+        while self._chats:
+            self._wake_up.clear()
+            now = time.monotonic()
+            active = {
+                chat_id: activity
+                for chat_id, activity in self._chats.items()
+                if not (activity.is_paused and activity.is_paused())
+            }
+            due = sorted((activity.next_at, chat_id) for chat_id, activity in active.items() if activity.next_at <= now)
+            batch = [(chat_id, active[chat_id]) for _, chat_id in due[: self.max_per_second]]
+            for _, activity in batch:
+                activity.next_at = now + self.interval
+            if batch:
+                await asyncio.gather(*(self._send(chat_id, activity) for chat_id, activity in batch))
+
+            if len(due) > len(batch):
+                # Over the limit: the chats left wait for the next second.
+                delay = max(0.0, now + 1 - time.monotonic())
+            else:
+                # Paused chats are checked again at the latest in `interval` seconds.
+                next_at = min((activity.next_at for activity in active.values()), default=now + self.interval)
+                delay = max(0.0, next_at - time.monotonic())
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake_up.wait(), timeout=delay)
+
+
+chat_action_ticker = ChatActionTicker(interval=CHAT_ACTION_REFRESH_INTERVAL, max_per_second=MAX_CHAT_ACTIONS_PER_SECOND)
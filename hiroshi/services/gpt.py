@@ -1,24 +1,330 @@
+import asyncio
+import time
+from asyncio import Task
+from enum import Enum
+from typing import Any, Awaitable, Callable
+
 import g4f
 from g4f.models import Model
-from g4f.providers.types import BaseProvider
+from g4f.models import default as default_model
+from g4f.providers.base_provider import AsyncGeneratorProvider
+from g4f.providers.types import BaseProvider, BaseRetryProvider
 from loguru import logger
 
 from hiroshi.config import gpt_settings
+from hiroshi.metrics import provider_request_duration, provider_retries
+from hiroshi.models import Chat
+from hiroshi.services.providers import MODELS_AND_PROVIDERS
+from hiroshi.services.response_cache import response_cache
+from hiroshi.services.scoreboard import scoreboard
+from hiroshi.tracing import tracer
 from hiroshi.utils import is_provider_active
 
-MODELS_AND_PROVIDERS: dict[str, tuple[str, str]] = {
-    "Default": ("gpt_35_long", "Default"),
-    "GPT-3.5 (Fastest provider)": ("gpt_35_long", "Default"),
-    "GPT-4 (Fastest provider)": ("gpt_4", "Default"),
-    "Bing (GPT-4)": ("gpt_4", "Bing"),
-    "ChatBase (GPT-3.5)": ("gpt-3.5-turbo", "ChatBase"),
-    "ChatgptAi (GPT-3.5)": ("gpt-3.5-turbo", "ChatgptAi"),
-    "FreeGpt (GPT-3.5)": ("gpt-3.5-turbo", "FreeGpt"),
-    "GptGo (GPT-3.5)": ("gpt-3.5-turbo", "GptGo"),
-    "You (GPT-3.5)": ("gpt-3.5-turbo", "You"),
-    "Llama (Llama 3 8B)": ("meta/meta-llama-3-8b-instruct", "Llama"),
-    "Llama (Llama 3 70B)": ("meta/meta-llama-3-70b-instruct", "Llama"),
-}
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """Stops asking a provider that keeps failing.
+
+    After `failure_threshold` consecutive failures (errors or timeouts) the circuit opens, and the provider is not
+    asked for `backoff` seconds. Then the circuit is half-open: a single request is let through to probe the provider.
+    If it succeeds, the circuit is closed again, otherwise it's opened for twice as long as before (but no longer than
+    `max_backoff` seconds).
+    """
+
+    def __init__(self, name: str, failure_threshold: int, backoff: float, max_backoff: float) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = CircuitState.CLOSED
+        self.consecutive_failures = 0
+        self.current_backoff = backoff
+        self.opened_at = 0.0
+        self._probing = False
+
+    @property
+    def is_available(self) -> bool:
+        if self.state is CircuitState.CLOSED:
+            return True
+        if self.state is CircuitState.OPEN:
+            return time.monotonic() >= self.opened_at + self.current_backoff
+        return not self._probing
+
+    def allow_request(self) -> bool:
+        if not self.is_available:
+            return False
+        if self.state is not CircuitState.CLOSED:
+            self.state = CircuitState.HALF_OPEN
+            self._probing = True
+            logger.info(f"Circuit breaker of the {self.name} provider is half-open: probing the provider...")
+        return True
+
+    def release(self) -> None:
+        """Let another request probe the provider: the one allowed has been cancelled."""
+        self._probing = False
+
+    def record_success(self) -> None:
+        if self.state is not CircuitState.CLOSED:
+            logger.info(f"Circuit breaker of the {self.name} provider closed: the provider has recovered.")
+        self.state = CircuitState.CLOSED
+        self.consecutive_failures = 0
+        self.current_backoff = self.backoff
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.state is CircuitState.HALF_OPEN:
+            self.current_backoff = min(self.current_backoff * 2, self.max_backoff)
+            self._open()
+        elif self.state is CircuitState.CLOSED and self.consecutive_failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self) -> None:
+        self.state = CircuitState.OPEN
+        self.opened_at = time.monotonic()
+        self._probing = False
+        logger.warning(
+            f"Circuit breaker of the {self.name} provider opened for {self.current_backoff:.0f} seconds after "
+            f"{self.consecutive_failures} consecutive failures."
+        )
+
+    def get_state(self) -> dict[str, Any]:
+        retry_in = self.opened_at + self.current_backoff - time.monotonic() if self.state is CircuitState.OPEN else 0
+        return {
+            "state": self.state.value,
+            "consecutive_failures": self.consecutive_failures,
+            "retry_in": round(max(retry_in, 0), 1),
+        }
+
+
+circuit_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(provider_name: str) -> CircuitBreaker:
+    if provider_name not in circuit_breakers:
+        circuit_breakers[provider_name] = CircuitBreaker(
+            name=provider_name,
+            failure_threshold=gpt_settings.circuit_breaker_threshold,
+            backoff=gpt_settings.circuit_breaker_backoff,
+            max_backoff=gpt_settings.circuit_breaker_max_backoff,
+        )
+    return circuit_breakers[provider_name]
+
+
+def get_circuit_breakers_state() -> dict[str, dict[str, Any]]:
+    """State of the circuit breakers of all the providers asked so far, for monitoring."""
+    return {name: breaker.get_state() for name, breaker in circuit_breakers.items()}
+
+
+def record_provider_call(
+    model_name: str, provider_name: str, latency: float, answered: bool, failed: bool = False
+) -> None:
+    scoreboard.record(model_name, provider_name, latency, answered=answered, failed=failed)
+    outcome = "error" if failed else "answer" if answered else "empty"
+    provider_request_duration.observe(latency, model=model_name, provider=provider_name, outcome=outcome)
+
+
+# Until a provider has answered this many times, its latency percentiles are not trusted for hedging.
+MIN_LATENCY_SAMPLES = 5
+
+
+def get_provider_name(provider: BaseProvider | type[BaseProvider]) -> str:
+    return provider.__name__ if isinstance(provider, type) else type(provider).__name__
+
+
+def get_routing_providers(provider: BaseProvider | None, model: Model) -> list[type[BaseProvider]]:
+    """Working providers of a retry provider (Default and "Fastest provider" options), the best ones first.
+
+    Providers with an open circuit breaker are skipped.
+    """
+    if not isinstance(provider, BaseRetryProvider):
+        return []
+    candidates = [
+        candidate
+        for candidate in provider.providers
+        if candidate.working and get_circuit_breaker(candidate.__name__).is_available
+    ]
+    return scoreboard.rank(model.name, candidates)
+
+
+def get_hedge_delay(model: Model, provider: type[BaseProvider]) -> float:
+    stats = scoreboard.get(model.name, get_provider_name(provider))
+    if stats and len(stats.latencies) >= MIN_LATENCY_SAMPLES:
+        return stats.get_latency_percentile(gpt_settings.hedge_percentile) or gpt_settings.hedge_delay
+    return gpt_settings.hedge_delay
+
+
+async def ask_provider(
+    provider: type[BaseProvider], messages: list[dict[str, str]], model: Model, timeout: int, proxy: str | None
+) -> str | None:
+    circuit_breaker = get_circuit_breaker(provider.__name__)
+    if not circuit_breaker.allow_request():
+        return None
+    started_at = time.monotonic()
+    try:
+        response = await asyncio.wait_for(
+            provider.create_async(model.name, messages, timeout=timeout, proxy=proxy), timeout=timeout
+        )
+    except asyncio.CancelledError:
+        circuit_breaker.release()
+        raise
+    except Exception as e:
+        circuit_breaker.record_failure()
+        record_provider_call(model.name, provider.__name__, time.monotonic() - started_at, answered=False, failed=True)
+        logger.warning(f"The {provider.__name__} provider failed to answer: {str(e)[:240]}")
+        return None
+    circuit_breaker.record_success()
+    record_provider_call(model.name, provider.__name__, time.monotonic() - started_at, answered=bool(response))
+    return str(response) if response else None
+
+
+async def get_routed_chat_response(
+    messages: list[dict[str, str]],
+    model: Model,
+    providers: list[type[BaseProvider]],
+    hedge: bool,
+    timeout: int = gpt_settings.timeout,
+    proxy: str | None = None,
+) -> str | None:
+    """Ask the providers one by one, the best ones first, until one of them answers.
+
+    The next provider is asked as soon as all the providers asked so far have failed. When hedging, it's also asked
+    once the last one asked has been answering for longer than the `hedge_percentile` percentile of its latency (or
+    `hedge_delay` seconds, if it's not known yet): the first non-empty answer wins and the requests still running are
+    cancelled. No more than `hedge_max_requests` providers are asked when hedging.
+    """
+    candidates = providers[: gpt_settings.hedge_max_requests] if hedge else providers
+    pending: set[Task[str | None]] = set()
+    try:
+        for index, provider in enumerate(candidates):
+            pending.add(asyncio.create_task(ask_provider(provider, messages, model, timeout, proxy)))
+            can_hedge = hedge and index < len(candidates) - 1
+            hedge_at = time.monotonic() + get_hedge_delay(model, provider)
+            while pending:
+                wait_for = max(hedge_at - time.monotonic(), 0) if can_hedge else None
+                done, pending = await asyncio.wait(pending, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+                if answers := [answer for task in done if (answer := task.result())]:
+                    return answers[0]
+                if not done or not pending:
+                    # Either it's time to hedge, or every provider asked so far has failed: the next one is asked now.
+                    break
+    finally:
+        for task in pending:
+            task.cancel()
+    return None
+
+
+def get_streaming_providers(provider: BaseProvider | None) -> list[type[AsyncGeneratorProvider]]:
+    if provider is None:
+        return []
+    candidates = provider.providers if isinstance(provider, BaseRetryProvider) else [provider]
+    return [
+        candidate
+        for candidate in candidates
+        if candidate.supports_stream
+        and candidate.working
+        and get_circuit_breaker(get_provider_name(candidate)).is_available
+        and isinstance(candidate, type)
+        and issubclass(candidate, AsyncGeneratorProvider)
+    ]
+
+
+async def stream_chat_response(
+    messages: list[dict[str, str]],
+    model: Model,
+    providers: list[type[AsyncGeneratorProvider]],
+    on_update: Callable[[str], Awaitable[None]],
+    timeout: int = gpt_settings.timeout,
+    proxy: str | None = None,
+) -> str | None:
+    """Stream the answer from the first provider that starts answering, reporting the text received so far.
+
+    The providers are iterated here rather than through g4f's retry provider: it may go on to the next provider after
+    one has streamed the answer already.
+    """
+    for provider in scoreboard.rank(model.name, providers):
+        circuit_breaker = get_circuit_breaker(provider.__name__)
+        if not circuit_breaker.allow_request():
+            continue
+        answer = ""
+        started_at = time.monotonic()
+        try:
+            async for chunk in provider.create_async_generator(
+                model.name, messages, stream=True, timeout=timeout, proxy=proxy
+            ):
+                if isinstance(chunk, str) and chunk:
+                    answer += chunk
+                    await on_update(answer)
+        except asyncio.CancelledError:
+            circuit_breaker.release()
+            raise
+        except Exception as e:
+            circuit_breaker.record_failure()
+            record_provider_call(
+                model.name, provider.__name__, time.monotonic() - started_at, answered=False, failed=True
+            )
+            logger.warning(f"The {provider.__name__} provider failed to stream an answer: {str(e)[:240]}")
+            if answer:
+                return None
+            continue
+        circuit_breaker.record_success()
+        record_provider_call(model.name, provider.__name__, time.monotonic() - started_at, answered=bool(answer))
+        if answer:
+            return answer
+    return None
+
+
+def is_provider_unavailable(provider: BaseProvider | None) -> bool:
+    """Whether the provider can't be asked: its circuit breaker is open or, for a retry provider, every one of its
+    providers is either not working or has an open circuit breaker (its own breaker is never tripped by them)."""
+    if provider is None:
+        return False
+    if isinstance(provider, BaseRetryProvider):
+        return not any(
+            candidate.working and get_circuit_breaker(candidate.__name__).is_available
+            for candidate in provider.providers
+        )
+    return not get_circuit_breaker(get_provider_name(provider)).is_available
+
+
+async def get_pinned_chat_response(
+    messages: list[dict[str, str]],
+    model: Model,
+    provider: BaseProvider | None,
+    timeout: int = gpt_settings.timeout,
+    proxy: str | None = None,
+) -> str | None:
+    provider_name = get_provider_name(provider) if provider else "Default"
+    circuit_breaker = get_circuit_breaker(provider_name)
+    if not circuit_breaker.allow_request():
+        raise CircuitOpenError(f"The {provider_name} provider is temporarily unavailable after repeated failures.")
+    started_at = time.monotonic()
+    try:
+        response = await asyncio.wait_for(
+            g4f.ChatCompletion.create_async(
+                model=model, messages=messages, provider=provider, timeout=timeout, proxy=proxy
+            ),
+            timeout=timeout,
+        )
+    except asyncio.CancelledError:
+        circuit_breaker.release()
+        raise
+    except Exception:
+        circuit_breaker.record_failure()
+        record_provider_call(model.name, provider_name, time.monotonic() - started_at, answered=False, failed=True)
+        raise
+    circuit_breaker.record_success()
+    record_provider_call(model.name, provider_name, time.monotonic() - started_at, answered=bool(response))
+    return str(response) if response else None
 
 
 async def get_chat_response(
@@ -27,11 +333,86 @@ async def get_chat_response(
     provider: BaseProvider | None,
     timeout: int = gpt_settings.timeout,
     proxy: str | None = None,
+    on_update: Callable[[str], Awaitable[None]] | None = None,
 ) -> str | None:
+    """Get the answer of the provider, from the response cache if the same request has been answered recently."""
+
+    provider_name = get_provider_name(provider) if provider else "Default"
+
+    async def fetch() -> str | None:
+        # A cache hit has no such span.
+        with tracer.span("fetch_chat_response"):
+            return await fetch_chat_response(
+                messages=messages, model=model, provider=provider, timeout=timeout, proxy=proxy, on_update=on_update
+            )
+
+    with tracer.span("get_chat_response", model=model.name, provider=provider_name, messages=len(messages)):
+        if not response_cache.enabled:
+            return await fetch()
+        key = response_cache.make_key(model.name, provider_name, messages)
+        return await response_cache.get_or_fetch(key, fetch)
+
+
+async def fetch_chat_response(
+    messages: list[dict[str, str]],
+    model: Model,
+    provider: BaseProvider | None,
+    timeout: int = gpt_settings.timeout,
+    proxy: str | None = None,
+    on_update: Callable[[str], Awaitable[None]] | None = None,
+) -> str | None:
+    """Ask the provider for the answer.
+
+    If `on_update` is set and the provider can stream, the answer is streamed and `on_update` is called with the text
+    received so far. Otherwise, or if streaming fails, the answer is requested as a whole. Retry providers are not
+    asked directly: their providers are asked one by one, best first according to the scoreboard.
+
+    A provider chosen by the user is not asked while its circuit breaker is open (for a retry provider, while all of its
+    providers' are): the providers of the default model are asked for it instead (if `circuit_breaker_fallback` is
+    set), or `CircuitOpenError` is raised right away.
+    """
+    if on_update and (streaming_providers := get_streaming_providers(provider)):
+        if answer := await stream_chat_response(
+            messages=messages,
+            model=model,
+            providers=streaming_providers,
+            on_update=on_update,
+            timeout=timeout,
+            proxy=proxy,
+        ):
+            return answer
+        logger.warning(f"Couldn't stream an answer from the {provider}. Requesting it as a whole...")
+
     for attempt in range(gpt_settings.retries):
-        response = await g4f.ChatCompletion.create_async(
-            model=model, messages=messages, provider=provider, timeout=timeout, proxy=proxy
-        )
+        if attempt:
+            provider_retries.inc()
+        routing_providers = get_routing_providers(provider, model)
+        routing_model = model
+        if not routing_providers and is_provider_unavailable(provider):
+            provider_name = get_provider_name(provider) if provider else "Default"
+            if gpt_settings.circuit_breaker_fallback and provider is not default_model.best_provider:
+                logger.warning(f"The {provider_name} provider is unavailable. Asking the default ones...")
+                # The default providers may not serve the model chosen, they're asked for the default one.
+                routing_model = default_model
+                routing_providers = get_routing_providers(default_model.best_provider, default_model)
+            if not routing_providers:
+                raise CircuitOpenError(
+                    f"The {provider_name} provider is temporarily unavailable after repeated failures."
+                )
+
+        if routing_providers:
+            response = await get_routed_chat_response(
+                messages=messages,
+                model=routing_model,
+                providers=routing_providers,
+                hedge=gpt_settings.hedge_requests,
+                timeout=timeout,
+                proxy=proxy,
+            )
+        else:
+            response = await get_pinned_chat_response(
+                messages=messages, model=model, provider=provider, timeout=timeout, proxy=proxy
+            )
         if response:
             return str(response)
         else:
@@ -42,5 +423,20 @@ async def get_chat_response(
     return None
 
 
+def get_option_latency(option: str) -> float | None:
+    """Current average latency of a provider option of the `/provider` menu (the best provider's one for retry
+    providers)."""
+    model_name, provider_name = MODELS_AND_PROVIDERS[option]
+    chat = Chat(id=0, model_name=model_name, provider_name=provider_name if provider_name != "Default" else None)
+    provider, model = chat.provider, chat.model
+    candidates = provider.providers if isinstance(provider, BaseRetryProvider) else [provider]
+    latencies = [
+        stats.latency_ewma
+        for candidate in candidates
+        if (stats := scoreboard.get(model.name, get_provider_name(candidate))) and stats.latency_ewma is not None
+    ]
+    return min(latencies, default=None)
+
+
 def retrieve_available_providers() -> list[str]:
     return [key for key, value in MODELS_AND_PROVIDERS.items() if is_provider_active(value) or "Default" in value]
@@ -0,0 +1,53 @@
+"""Loading the GPT providers without holding the bot's startup back.
+
+g4f and the tree of its providers take longer to import than the rest of the bot. Only `hiroshi.services.gpt` imports
+them, and nothing imports it at startup: it's imported in the background once the bot is connected to Telegram, and the
+handlers needing the providers wait for that (then import it) while the other ones are served right away.
+"""
+import asyncio
+import importlib
+import time
+from asyncio import Task
+
+from loguru import logger
+
+GPT_MODULE = "hiroshi.services.gpt"
+
+MODELS_AND_PROVIDERS: dict[str, tuple[str, str]] = {
+    "Default": ("gpt_35_long", "Default"),
+    "GPT-3.5 (Fastest provider)": ("gpt_35_long", "Default"),
+    "GPT-4 (Fastest provider)": ("gpt_4", "Default"),
+    "Bing (GPT-4)": ("gpt_4", "Bing"),
+    "ChatBase (GPT-3.5)": ("gpt-3.5-turbo", "ChatBase"),
+    "ChatgptAi (GPT-3.5)": ("gpt-3.5-turbo", "ChatgptAi"),
+    "FreeGpt (GPT-3.5)": ("gpt-3.5-turbo", "FreeGpt"),
+    "GptGo (GPT-3.5)": ("gpt-3.5-turbo", "GptGo"),
+    "You (GPT-3.5)": ("gpt-3.5-turbo", "You"),
+    "Llama (Llama 3 8B)": ("meta/meta-llama-3-8b-instruct", "Llama"),
+    "Llama (Llama 3 70B)": ("meta/meta-llama-3-70b-instruct", "Llama"),
+}
+
+
+class ProvidersLoader:
+    """Imports `GPT_MODULE` in a thread, so the event loop keeps serving updates meanwhile."""
+
+    def __init__(self) -> None:
+        self._loading: Task[None] | None = None
+
+    def start(self) -> None:
+        if self._loading is None:
+            self._loading = asyncio.create_task(self._load())
+
+    async def _load(self) -> None:
+        started_at = time.perf_counter()
+        await asyncio.to_thread(importlib.import_module, GPT_MODULE)
+        logger.info(f"GPT providers loaded in {time.perf_counter() - started_at:.2f} seconds.")
+
+    async def wait(self) -> None:
+        """Wait until the providers are loaded, starting to load them if it's not done yet."""
+        self.start()
+        assert self._loading
+        await asyncio.shield(self._loading)
+
+
+providers_loader = ProvidersLoader()
@@ -0,0 +1,289 @@
+import asyncio
+import bisect
+import itertools
+import math
+import time
+from asyncio import Future, Task
+from collections import Counter
+from contextlib import suppress
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Callable, Coroutine
+
+from loguru import logger
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from hiroshi.config import application_settings, telegram_settings
+from hiroshi.metrics import (
+    telegram_chat_actions_dropped,
+    telegram_flood_waits,
+    telegram_queue_wait,
+    telegram_requests_queued,
+)
+from hiroshi.services.chat_actions import CHAT_ACTION_REFRESH_INTERVAL
+
+JSONDict = dict[str, Any]
+APIResult = bool | JSONDict | list[JSONDict]
+ChatID = int | str
+
+# Private chats may get short bursts (e.g. an answer split into several messages) above their average rate.
+PRIVATE_CHAT_BURST = 3
+# A chat action sent later than that is of no use: the chat action ticker sends a fresh one by then.
+CHAT_ACTION_MAX_WAIT = CHAT_ACTION_REFRESH_INTERVAL
+# Beyond that number of chats, the buckets of the idle ones are forgotten.
+MAX_CHAT_BUCKETS = 1024
+
+
+class Priority(IntEnum):
+    """Order in which the waiting requests are sent, the lowest first."""
+
+    MESSAGE = 0
+    EDIT = 1
+    CHAT_ACTION = 2
+
+    @property
+    def is_chat_limited(self) -> bool:
+        """Whether the request takes a token of its chat's bucket. A streamed answer is edited every second or so, which
+        would drain the 20 messages a minute of a group in no time, so edits (like chat actions) only take one of the
+        overall bucket."""
+        return self is Priority.MESSAGE
+
+
+ENDPOINT_PRIORITIES = {"editMessageText": Priority.EDIT, "sendChatAction": Priority.CHAT_ACTION}
+
+
+class TokenBucket:
+    """`rate` tokens a second (none for no limit), up to `capacity` of them kept for bursts."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        # Telegram asked (with a RetryAfter error) to send nothing until then.
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def get_delay(self, now: float, consume: bool = True) -> float:
+        """Seconds to wait before a request can be sent: for a token (unless it doesn't `consume` any) and the end of
+        the block."""
+        blocked = max(0.0, self.blocked_until - now)
+        if not consume or not self.rate:
+            return blocked
+        self._refill(now)
+        return max(blocked, 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate)
+
+    def take(self) -> None:
+        if self.rate:
+            self.tokens -= 1
+
+    def is_idle(self, now: float) -> bool:
+        return not self.get_delay(now) and (not self.rate or self.tokens >= self.capacity)
+
+
+@dataclass(order=True)
+class QueuedRequest:
+    priority: Priority
+    sequence: int
+    chat_id: ChatID = field(compare=False)
+    queued_at: float = field(compare=False)
+    # Set to True when the request is to be sent, to False if it's dropped.
+    ready: "Future[bool]" = field(compare=False)
+
+    @property
+    def expires_at(self) -> float:
+        return self.queued_at + CHAT_ACTION_MAX_WAIT if self.priority is Priority.CHAT_ACTION else math.inf
+
+
+class OutboundRateLimiter(BaseRateLimiter[int]):
+    """Paces the Bot API requests sent to chats so that Telegram's flood limits are not hit.
+
+    A request waits for a token of the overall bucket (`max_rate` requests a second) and one of its chat's bucket
+    (`chat_max_rate` a second in private chats, `group_max_rate` a minute in groups; edits and chat actions only count
+    towards the overall limit, though they wait for the end of their chat's flood wait). The waiting requests are sent
+    by priority: messages first, then edits (streamed answers), then chat actions, which are dropped rather than sent
+    late. A request failing with a RetryAfter error blocks its chat as long as Telegram asks and is sent again, up to
+    `max_retries` times (or the `rate_limit_args` of the call). Requests not sent to a chat (`getUpdates`,
+    `setMyCommands`...) are not limited.
+    """
+
+    def __init__(self, max_rate: float, chat_max_rate: float, group_max_rate: float, max_retries: int) -> None:
+        self.chat_max_rate = chat_max_rate
+        self.group_max_rate = group_max_rate
+        self.max_retries = max_retries
+        self._overall = TokenBucket(rate=max_rate, capacity=max(max_rate, 1))
+        self._chats: dict[ChatID, TokenBucket] = {}
+        self._queue: list[QueuedRequest] = []
+        self._sequence = itertools.count()
+        self._wake_up = asyncio.Event()
+        self._dispatcher: Task[None] | None = None
+
+    async def initialize(self) -> None:
+        return None
+
+    async def shutdown(self) -> None:
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._dispatcher
+        # The bot is stopping: whatever is still waiting is sent right away.
+        for request in self._queue:
+            if not request.ready.done():
+                request.ready.set_result(True)
+        self._queue.clear()
+        self._update_queue_metrics()
+
+    def _get_bucket(self, chat_id: ChatID) -> TokenBucket:
+        if bucket := self._chats.get(chat_id):
+            return bucket
+        if len(self._chats) >= MAX_CHAT_BUCKETS:
+            now = time.monotonic()
+            waiting = {request.chat_id for request in self._queue}
+            for key, idle_bucket in list(self._chats.items()):
+                if key not in waiting and idle_bucket.is_idle(now):
+                    del self._chats[key]
+        # Group chats have negative IDs, or are given by their @username.
+        if isinstance(chat_id, str) or chat_id < 0:
+            bucket = TokenBucket(rate=self.group_max_rate / 60, capacity=self.group_max_rate)
+        else:
+            bucket = TokenBucket(rate=self.chat_max_rate, capacity=PRIVATE_CHAT_BURST)
+        self._chats[chat_id] = bucket
+        return bucket
+
+    def _update_queue_metrics(self) -> None:
+        counts = Counter(request.priority for request in self._queue)
+        for priority in Priority:
+            telegram_requests_queued.set(counts[priority], priority=priority.name.lower())
+
+    def _send(self, request: QueuedRequest, now: float) -> None:
+        self._overall.take()
+        if request.priority.is_chat_limited:
+            self._chats[request.chat_id].take()
+        self._queue.remove(request)
+        request.ready.set_result(True)
+        telegram_queue_wait.observe(now - request.queued_at, priority=request.priority.name.lower())
+        self._update_queue_metrics()
+
+    def _drop_expired(self, now: float) -> None:
+        """Forget the requests cancelled while waiting, drop the chat actions waiting for too long."""
+        for request in [request for request in self._queue if request.ready.done() or request.expires_at <= now]:
+            self._queue.remove(request)
+            if not request.ready.done():
+                request.ready.set_result(False)
+                telegram_chat_actions_dropped.inc()
+        self._update_queue_metrics()
+
+    def _pick(self, now: float) -> tuple[QueuedRequest | None, float]:
+        """The first request (by priority) its chat allows to send now, or the time until one is allowed or expires."""
+        delay = math.inf
+        for request in self._queue:
+            chat_delay = self._chats[request.chat_id].get_delay(now, consume=request.priority.is_chat_limited)
+            if not chat_delay:
+                return request, 0.0
+            delay = min(delay, chat_delay, request.expires_at - now)
+        return None, delay
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._wake_up.clear()
+            now = time.monotonic()
+            self._drop_expired(now)
+            delay = self._overall.get_delay(now)
+            if not delay:
+                request, delay = self._pick(now)
+                if request:
+                    self._send(request, now)
+                    continue
+            if self._queue:
+                # Chat actions expiring while the overall limit holds everything back are dropped in time.
+                delay = min(delay, min(request.expires_at for request in self._queue) - now)
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake_up.wait(), timeout=delay if self._queue else None)
+
+    async def _wait_turn(self, chat_id: ChatID, priority: Priority) -> bool:
+        """Wait until the request can be sent. False if it's dropped instead."""
+        bucket = self._get_bucket(chat_id)
+        now = time.monotonic()
+        consume = priority.is_chat_limited
+        if not self._queue and not self._overall.get_delay(now) and not bucket.get_delay(now, consume=consume):
+            self._overall.take()
+            if consume:
+                bucket.take()
+            return True
+
+        request = QueuedRequest(
+            priority=priority,
+            sequence=next(self._sequence),
+            chat_id=chat_id,
+            queued_at=now,
+            ready=asyncio.get_running_loop().create_future(),
+        )
+        bisect.insort(self._queue, request)
+        self._update_queue_metrics()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wake_up.set()
+        try:
+            return await request.ready
+        except asyncio.CancelledError:
+            if request in self._queue:
+                self._queue.remove(request)
+                self._update_queue_metrics()
+            raise
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, APIResult]],
+        args: Any,
+        kwargs: dict[str, Any],
+        endpoint: str,
+        data: dict[str, Any],
+        rate_limit_args: int | None,
+    ) -> APIResult:
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+        with suppress(ValueError, TypeError):
+            chat_id = int(chat_id)
+
+        priority = ENDPOINT_PRIORITIES.get(endpoint, Priority.MESSAGE)
+        max_retries = self.max_retries if rate_limit_args is None else rate_limit_args
+        attempt = 0
+        while True:
+            if not await self._wait_turn(chat_id=chat_id, priority=priority):
+                # `sendChatAction` returns True on success.
+                return True
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                telegram_flood_waits.inc(method=endpoint)
+                self._get_bucket(chat_id).blocked_until = time.monotonic() + e.retry_after
+                if priority is Priority.CHAT_ACTION:
+                    telegram_chat_actions_dropped.inc()
+                    return True
+                if attempt >= max_retries:
+                    raise
+                logger.warning(
+                    f"Telegram asked to wait {e.retry_after} seconds before sending to the chat {chat_id}. "
+                    f"Retrying {endpoint} then ({attempt + 1}/{max_retries})..."
+                )
+                attempt += 1
+
+
+def get_rate_limiter() -> OutboundRateLimiter | None:
+    """A rate limiter for a bot process, unless the outgoing rate limiting is disabled. With worker processes, the
+    overall limit is split between them and the main process."""
+    if not telegram_settings.rate_limit:
+        return None
+    processes = application_settings.workers + 1
+    return OutboundRateLimiter(
+        max_rate=telegram_settings.rate_limit / processes,
+        chat_max_rate=telegram_settings.chat_rate_limit,
+        group_max_rate=telegram_settings.group_rate_limit,
+        max_retries=telegram_settings.max_retries,
+    )
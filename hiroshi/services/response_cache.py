@@ -0,0 +1,145 @@
+import asyncio
+import hashlib
+import json
+import time
+from asyncio import Task
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from loguru import logger
+
+from hiroshi.config import gpt_settings
+from hiroshi.metrics import response_cache_requests
+from hiroshi.storage.abstract import Database
+from hiroshi.storage.database import inject_database
+
+
+class ResponseCache:
+    """Answers of the providers, reused for identical requests.
+
+    A request is identified by the model, the provider and the conversation (its system messages aside), with
+    whitespace and letter case ignored. With a `context_size`, only the last `context_size` messages of it count: chats
+    with different histories then get each other's answers to the same follow-up ("continue", "translate it"...).
+
+    Answers are kept in memory for up to `ttl` seconds (but no more than `max_size` of them at once, the least recently
+    used are evicted first) and, if `shared` is set, in the storage, so all the bot's replicas can reuse them.
+    Identical requests made while the first one is being answered wait for its answer instead of asking the provider
+    again. Empty answers are never cached.
+    """
+
+    def __init__(self, max_size: int, ttl: int, context_size: int, shared: bool = False) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.context_size = context_size
+        self.shared = shared
+        self.hits = 0
+        self.shared_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self._answers: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._fetching: dict[str, Task[str | None]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 and self.ttl > 0
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        requests = self.hits + self.shared_hits + self.coalesced + self.misses
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.shared_hits + self.coalesced) / requests, 4) if requests else 0.0,
+            "size": len(self._answers),
+        }
+
+    def make_key(self, model_name: str, provider_name: str, messages: list[dict[str, str]]) -> str:
+        context = [msg for msg in messages if msg["role"] != "system"]
+        if self.context_size:
+            context = context[-self.context_size :]
+        normalized = [(msg["role"], " ".join(msg["content"].split()).casefold()) for msg in context]
+        payload = json.dumps([model_name, provider_name, normalized], ensure_ascii=False)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _get_cached(self, key: str) -> str | None:
+        if cached := self._answers.get(key):
+            cached_at, answer = cached
+            if time.monotonic() - cached_at < self.ttl:
+                self._answers.move_to_end(key)
+                return answer
+            del self._answers[key]
+        return None
+
+    def _remember(self, key: str, answer: str) -> None:
+        self._answers[key] = (time.monotonic(), answer)
+        self._answers.move_to_end(key)
+        while len(self._answers) > self.max_size:
+            self._answers.popitem(last=False)
+
+    async def _fetch(self, key: str, fetch: Callable[[], Awaitable[str | None]]) -> str | None:
+        answer: str | None = None
+        if self.shared:
+            try:
+                answer = await get_shared_response(key=key)
+            except Exception as e:
+                logger.warning(f"Couldn't read the shared response cache: {str(e)[:240]}")
+            if answer:
+                self.shared_hits += 1
+                response_cache_requests.inc(outcome="shared_hit")
+                self._remember(key, answer)
+                return answer
+
+        self.misses += 1
+        response_cache_requests.inc(outcome="miss")
+        answer = await fetch()
+        if answer:
+            self._remember(key, answer)
+            if self.shared:
+                try:
+                    await save_shared_response(key=key, answer=answer, ttl=self.ttl)
+                except Exception as e:
+                    logger.warning(f"Couldn't update the shared response cache: {str(e)[:240]}")
+        return answer
+
+    async def get_or_fetch(self, key: str, fetch: Callable[[], Awaitable[str | None]]) -> str | None:
+        """Return the cached answer, or the one `fetch` gets (only one `fetch` per key is running at once)."""
+        if answer := self._get_cached(key):
+            self.hits += 1
+            response_cache_requests.inc(outcome="hit")
+            return answer
+
+        if key in self._fetching:
+            self.coalesced += 1
+            response_cache_requests.inc(outcome="coalesced")
+        else:
+            fetching = asyncio.create_task(self._fetch(key, fetch))
+            self._fetching[key] = fetching
+            fetching.add_done_callback(lambda _: self._fetching.pop(key, None))
+        return await asyncio.shield(self._fetching[key])
+
+    async def close(self) -> None:
+        logger.info(f"Response cache stats: {self.stats}")
+        for fetching in self._fetching.values():
+            fetching.cancel()
+        await asyncio.gather(*self._fetching.values(), return_exceptions=True)
+
+
+response_cache = ResponseCache(
+    max_size=gpt_settings.response_cache_size,
+    ttl=gpt_settings.response_cache_ttl,
+    context_size=gpt_settings.response_cache_messages,
+    shared=gpt_settings.response_cache_shared,
+)
+
+
+@inject_database
+async def get_shared_response(db: Database, key: str) -> str | None:
+    answer: str | None = await db.get_cached_response(key)
+    return answer
+
+
+@inject_database
+async def save_shared_response(db: Database, key: str, answer: str, ttl: int) -> None:
+    await db.save_cached_response(key, answer, ttl)
@@ -0,0 +1,155 @@
+import asyncio
+import time
+from asyncio import Task
+from collections import deque
+from contextlib import suppress
+from dataclasses import dataclass, field
+from typing import Any, Callable, Coroutine, Generic, Hashable, TypeVar
+
+from loguru import logger
+
+from hiroshi.metrics import prompt_queue_wait
+
+T = TypeVar("T")
+
+
+@dataclass
+class QueuedPrompt(Generic[T]):
+    chat_id: int
+    tag: float
+    merge_key: Hashable
+    payloads: list[T]
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class PromptScheduler(Generic[T]):
+    """Admission control and weighted fair queuing of the prompts sent to the providers.
+
+    No more than `max_in_flight` prompts are handled at once, the rest wait in per-chat queues. Queues are served in
+    the order of virtual finish tags: every prompt of a chat with weight `w` advances the chat's tag by `1 / w`, so a
+    chat with weight 3 gets three times as many turns as a chat with weight 1 when both are busy, and a chat flooding
+    the bot can't delay the others for long. A prompt is rejected when its chat already has `max_chat_queue_size`
+    prompts waiting or when `max_queue_size` prompts are waiting overall.
+
+    Prompts of a chat are handled one at a time, in the order they were sent. A prompt sent while the previous one with
+    the same `merge_key` (i.e. from the same user) is still waiting is merged into it: `handler` gets the payloads of
+    all the prompts merged and answers them with a single provider call.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[list[T]], Coroutine[Any, Any, None]],
+        max_in_flight: int,
+        max_queue_size: int,
+        max_chat_queue_size: int,
+    ) -> None:
+        self.handler = handler
+        self.max_in_flight = max_in_flight
+        self.max_queue_size = max_queue_size
+        self.max_chat_queue_size = max_chat_queue_size
+        self.in_flight = 0
+        self.queued = 0
+        self.shed = 0
+        self.merged = 0
+        self.wait_time_avg = 0.0
+        self.wait_time_max = 0.0
+        self._queues: dict[int, deque[QueuedPrompt[T]]] = {}
+        self._running_chats: set[int] = set()
+        self._finish_tags: dict[int, float] = {}
+        self._virtual_time = 0.0
+        self._tasks: set[Task[None]] = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "chats_queued": len(self._queues),
+            "shed": self.shed,
+            "merged": self.merged,
+            "wait_time_avg": round(self.wait_time_avg, 3),
+            "wait_time_max": round(self.wait_time_max, 3),
+        }
+
+    def submit(self, chat_id: int, payload: T, weight: float = 1, merge_key: Hashable = None) -> bool:
+        """Queue the prompt. Returns False (and doesn't queue it) if the prompt is rejected."""
+        chat_queue = self._queues.get(chat_id)
+        chat_queued = sum(len(prompt.payloads) for prompt in chat_queue) if chat_queue else 0
+        if self.queued >= self.max_queue_size or chat_queued >= self.max_chat_queue_size:
+            self.shed += 1
+            logger.warning(f"Prompt of the chat {chat_id} rejected: the queue is full. Queue stats: {self.stats}")
+            return False
+
+        self.queued += 1
+        if chat_queue and chat_queue[-1].merge_key == merge_key:
+            chat_queue[-1].payloads.append(payload)
+            self.merged += 1
+            return True
+
+        tag = max(self._virtual_time, self._finish_tags.get(chat_id, 0.0)) + 1 / weight
+        self._finish_tags[chat_id] = tag
+        self._queues.setdefault(chat_id, deque()).append(
+            QueuedPrompt(chat_id=chat_id, tag=tag, merge_key=merge_key, payloads=[payload])
+        )
+        self._dispatch()
+        return True
+
+    def _next_prompt(self) -> QueuedPrompt[T] | None:
+        ready_chat_ids = [chat_id for chat_id in self._queues if chat_id not in self._running_chats]
+        if not ready_chat_ids:
+            return None
+        chat_id = min(ready_chat_ids, key=lambda ready_chat_id: self._queues[ready_chat_id][0].tag)
+        chat_queue = self._queues[chat_id]
+        prompt = chat_queue.popleft()
+        if not chat_queue:
+            del self._queues[chat_id]
+        return prompt
+
+    def _dispatch(self) -> None:
+        while self.in_flight < self.max_in_flight and (prompt := self._next_prompt()):
+            self.queued -= len(prompt.payloads)
+            self.in_flight += 1
+            self._running_chats.add(prompt.chat_id)
+            self._virtual_time = prompt.tag
+
+            wait_time = time.monotonic() - prompt.enqueued_at
+            self.wait_time_avg += 0.1 * (wait_time - self.wait_time_avg)
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+            prompt_queue_wait.observe(wait_time)
+
+            task = asyncio.create_task(self._run(prompt))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        if not self._queues and not self.in_flight:
+            # Nobody is waiting: the tags start over, so the idle chats don't keep stale credits or debts.
+            self._finish_tags.clear()
+            self._virtual_time = 0.0
+            self._idle.set()
+        else:
+            self._idle.clear()
+
+    async def _run(self, prompt: QueuedPrompt[T]) -> None:
+        try:
+            await self.handler(prompt.payloads)
+        except Exception as e:
+            logger.error(f"Couldn't handle a prompt of the chat {prompt.chat_id}: {str(e)[:240]}")
+        finally:
+            self.in_flight -= 1
+            self._running_chats.discard(prompt.chat_id)
+            self._dispatch()
+
+    async def wait_idle(self, timeout: float) -> None:
+        """Wait until every prompt queued has been handled, but no longer than `timeout` seconds."""
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+
+    async def close(self) -> None:
+        logger.info(f"Prompt scheduler stats: {self.stats}")
+        self._queues.clear()
+        self.queued = 0
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
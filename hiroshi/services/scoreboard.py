@@ -0,0 +1,89 @@
+import math
+import random
+from typing import TYPE_CHECKING
+
+from loguru import logger
+from telegram.ext import ContextTypes
+
+from hiroshi.models import ProviderStats
+from hiroshi.storage.abstract import Database
+from hiroshi.storage.database import inject_database
+
+if TYPE_CHECKING:
+    from g4f.providers.types import BaseProvider
+
+
+class ProviderScoreboard:
+    """Latency and health of every (model, provider) pair the bot has asked, used to route requests.
+
+    Kept in memory and saved to the storage periodically: only the entries changed since the last save are written.
+    """
+
+    def __init__(self, exploration_rate: float = 0.1) -> None:
+        self.exploration_rate = exploration_rate
+        self._stats: dict[tuple[str, str], ProviderStats] = {}
+        self._changed: set[tuple[str, str]] = set()
+
+    def get(self, model_name: str, provider_name: str) -> ProviderStats | None:
+        return self._stats.get((model_name, provider_name))
+
+    def record(self, model_name: str, provider_name: str, latency: float, answered: bool, failed: bool = False) -> None:
+        key = (model_name, provider_name)
+        if key not in self._stats:
+            self._stats[key] = ProviderStats(model_name=model_name, provider_name=provider_name)
+        self._stats[key].record(latency=latency, answered=answered, failed=failed)
+        self._changed.add(key)
+
+    def get_score(self, model_name: str, provider_name: str) -> float:
+        if stats := self.get(model_name, provider_name):
+            return stats.score
+        return math.inf
+
+    def rank(self, model_name: str, providers: list[type["BaseProvider"]]) -> list[type["BaseProvider"]]:
+        """Sort the providers by their score, the best first.
+
+        Providers with no answers recorded go last, in random order. Now and then one of them is moved to the top,
+        so they get a chance to prove themselves.
+        """
+        candidates = random.sample(providers, len(providers))
+        ranked = sorted(candidates, key=lambda provider: self.get_score(model_name, provider.__name__))
+        unknown = [provider for provider in ranked if self.get_score(model_name, provider.__name__) == math.inf]
+        if unknown and random.random() < self.exploration_rate:
+            ranked.remove(unknown[0])
+            ranked.insert(0, unknown[0])
+        return ranked
+
+    async def load(self, db: Database) -> None:
+        for stats in await db.get_provider_stats():
+            self._stats[(stats.model_name, stats.provider_name)] = stats
+        logger.info(f"Provider scoreboard loaded: {len(self._stats)} entries.")
+
+    async def save(self, db: Database) -> None:
+        changed = [self._stats[key] for key in self._changed]
+        self._changed.clear()
+        try:
+            await db.save_provider_stats(changed)
+        except Exception:
+            self._changed.update((stats.model_name, stats.provider_name) for stats in changed)
+            raise
+
+
+scoreboard = ProviderScoreboard()
+
+
+@inject_database
+async def load_scoreboard(db: Database) -> None:
+    await scoreboard.load(db)
+
+
+@inject_database
+async def save_scoreboard(db: Database) -> None:
+    await scoreboard.save(db)
+
+
+@inject_database
+async def run_scoreboard_saver(db: Database, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await scoreboard.save(db)
+    except Exception as e:
+        logger.error(f"Couldn't save the provider scoreboard: {str(e)[:240]}")
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from asyncio import Task
+
+from loguru import logger
+from telegram import Message as TelegramMessage
+from telegram import Update, constants
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import ContextTypes
+
+from hiroshi.markdown import (
+    MARKDOWN_RESERVE,
+    MessageChunk,
+    get_message_length,
+    split_answer,
+    split_text,
+)
+from hiroshi.metrics import markdown_fallbacks
+from hiroshi.utils import (
+    get_telegram_user,
+    send_answer_chunk,
+    send_gpt_answer_message,
+    send_message,
+)
+
+
+class AnswerStreamer:
+    """Shows an answer while it is being received, in a single Telegram message edited as the text grows.
+
+    The first piece of text is sent right away. Further edits are made no more often than once per `edit_interval`
+    seconds and never block the stream: an edit in progress is not waited for, the next one just takes the latest
+    text. The text is sent as is while streaming, since unfinished Markdown can't be parsed, and the final edit is
+    Markdown-formatted.
+    """
+
+    def __init__(self, update: Update, context: ContextTypes.DEFAULT_TYPE, edit_interval: float) -> None:
+        self.telegram_update = update
+        self.context = context
+        self.edit_interval = edit_interval
+        self.text = ""
+        self.message: TelegramMessage | None = None
+        self._shown_text = ""
+        self._last_edit = 0.0
+        self._edit: Task[None] | None = None
+
+    @property
+    def started(self) -> bool:
+        return self.message is not None
+
+    @staticmethod
+    def _cut(text: str) -> str:
+        """The text or, once it's too long for a message, the part `split_answer` makes the first message of."""
+        limit = constants.MessageLimit.MAX_TEXT_LENGTH - MARKDOWN_RESERVE
+        if get_message_length(text) <= limit:
+            return text
+        first_part, *_ = split_text(text, limit) or [text[: limit // 2]]
+        return first_part.strip("\n") + "…"
+
+    async def _show(self) -> None:
+        text = self._cut(self.text)
+        if text == self._shown_text:
+            return
+        try:
+            if self.message:
+                await self.message.edit_text(text=text)
+            else:
+                self.message = await send_message(update=self.telegram_update, context=self.context, text=text)
+            self._shown_text = text
+        except TelegramError as e:
+            logger.warning(f"Couldn't show a part of the answer being streamed: {e}")
+        finally:
+            self._last_edit = time.monotonic()
+
+    async def update(self, text: str) -> None:
+        self.text = text
+        if self._edit and not self._edit.done():
+            return
+        if self.message and time.monotonic() - self._last_edit < self.edit_interval:
+            return
+        self._edit = asyncio.create_task(self._show())
+        if not self.message:
+            # The first piece of text is what the user waits for: it's sent before the stream goes on.
+            await self._edit
+
+    async def _finish_message(self, chunk: MessageChunk) -> None:
+        assert self.message
+        if chunk.markdown is not None:
+            try:
+                await self.message.edit_text(text=chunk.markdown, parse_mode=constants.ParseMode.MARKDOWN)
+                return
+            except BadRequest as e:
+                if "not modified" in str(e):
+                    return
+                markdown_fallbacks.inc()
+                telegram_user = get_telegram_user(update=self.telegram_update)
+                logger.error(
+                    f"{telegram_user.name} got a Telegram Bad Request error while receiving GPT answer: {e}. "
+                    f"Trying to show it in plain text mode."
+                )
+        if chunk.plain != self._shown_text:
+            await self.message.edit_text(text=chunk.plain)
+
+    async def finish(self, text: str) -> None:
+        """Show the whole answer: the message streamed becomes its first part, the other parts (if the answer is too
+        long for a message) are sent after it."""
+        if self._edit:
+            await self._edit
+        if not self.message:
+            await send_gpt_answer_message(gpt_answer=text, update=self.telegram_update, context=self.context)
+            return
+
+        first_chunk, *other_chunks = split_answer(text) or [MessageChunk(plain=text, markdown=None)]
+        await self._finish_message(first_chunk)
+        for chunk in other_chunks:
+            await send_answer_chunk(chunk=chunk, update=self.telegram_update, context=self.context, reply=False)
@@ -0,0 +1,85 @@
+import asyncio
+from asyncio import Task
+from contextlib import asynccontextmanager, suppress
+from typing import AsyncIterator, Awaitable, Callable
+
+from loguru import logger
+
+
+class ProviderActivity:
+    """Keeps track of the provider requests made on behalf of users at the moment."""
+
+    def __init__(self) -> None:
+        self.in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @asynccontextmanager
+    async def track(self) -> AsyncIterator[None]:
+        self.in_flight += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self._idle.set()
+
+    async def wait_idle(self, timeout: float) -> None:
+        """Wait until no user request is in flight, but no longer than `timeout` seconds."""
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+
+
+class SummaryScheduler:
+    """Runs history summarization in the background, off the reply path.
+
+    Requests are debounced per chat: a chat asked to be summarized again while its summarization is pending or running
+    gets a single extra run afterwards, never a concurrent one. Runs wait for users' provider requests to finish (but
+    no longer than `max_idle_wait` seconds), and no more than `concurrency` of them are made at once.
+    """
+
+    def __init__(
+        self,
+        summarize: Callable[..., Awaitable[bool]],
+        activity: ProviderActivity,
+        delay: float,
+        max_idle_wait: float = 60,
+        concurrency: int = 1,
+    ) -> None:
+        self.summarize = summarize
+        self.activity = activity
+        self.delay = delay
+        self.max_idle_wait = max_idle_wait
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks: dict[int, Task[None]] = {}
+        self._requested: set[int] = set()
+
+    def request(self, chat_id: int) -> None:
+        if chat_id in self._tasks:
+            self._requested.add(chat_id)
+            return
+        self._tasks[chat_id] = asyncio.create_task(self._run(chat_id))
+
+    async def _run(self, chat_id: int) -> None:
+        try:
+            while True:
+                await asyncio.sleep(self.delay)
+                await self.activity.wait_idle(timeout=self.max_idle_wait)
+                async with self._semaphore:
+                    # Requests made from now on may come too late for the history being read: they get another run.
+                    self._requested.discard(chat_id)
+                    if await self.summarize(chat_id=chat_id):
+                        logger.info(f"History of the chat {chat_id} successfully summarized.")
+                if chat_id not in self._requested:
+                    break
+        except Exception as e:
+            logger.error(f"Couldn't summarize history of the chat {chat_id}: {str(e)[:240]}")
+        finally:
+            self._requested.discard(chat_id)
+            self._tasks.pop(chat_id, None)
+
+    async def close(self) -> None:
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
@@ -0,0 +1,130 @@
+import asyncio
+import hmac
+import secrets
+import signal
+from json import JSONDecodeError
+
+from aiohttp import web
+from loguru import logger
+from telegram import Update
+from telegram.ext import Application
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+HEALTH_PATH = "/healthz"
+
+
+class WebhookServer:
+    """Embedded HTTP server receiving updates pushed by Telegram.
+
+    Requests to `path` must carry the secret token the webhook was registered with, otherwise they are rejected.
+    Accepted updates are put into the application's update queue, the same way polling does. `/healthz` answers 200
+    while the application is running and 503 otherwise.
+    """
+
+    def __init__(
+        self,
+        application: Application,  # type: ignore
+        path: str,
+        secret_token: str,
+        listen: str,
+        port: int,
+    ) -> None:
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self.listen = listen
+        self.port = port
+        self.updates_received = 0
+        self.updates_rejected = 0
+        self._runner: web.AppRunner | None = None
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get(HEALTH_PATH, self.handle_health)
+        return app
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        received_token = request.headers.get(SECRET_TOKEN_HEADER, "")
+        if not hmac.compare_digest(received_token.encode(), self.secret_token.encode()):
+            self.updates_rejected += 1
+            logger.warning(f"Webhook request from {request.remote} rejected: wrong secret token.")
+            return web.Response(status=403)
+
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except (JSONDecodeError, KeyError, TypeError, ValueError) as e:
+            self.updates_rejected += 1
+            logger.warning(f"Webhook request from {request.remote} rejected: malformed update: {str(e)[:240]}")
+            return web.Response(status=400)
+        if update is None:
+            self.updates_rejected += 1
+            return web.Response(status=400)
+
+        self.updates_received += 1
+        await self.application.update_queue.put(update)
+        return web.Response(status=200)
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        running = self.application.running
+        return web.json_response(
+            {
+                "status": "ok" if running else "stopped",
+                "updates_received": self.updates_received,
+                "updates_rejected": self.updates_rejected,
+            },
+            status=200 if running else 503,
+        )
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.create_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host=self.listen, port=self.port).start()
+        logger.info(f"Webhook server is listening on {self.listen}:{self.port}{self.path}")
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def serve_webhook(
+    application: Application,  # type: ignore
+    url: str,
+    path: str,
+    secret_token: str | None,
+    listen: str,
+    port: int,
+) -> None:
+    """Run the application receiving updates through the webhook until SIGINT or SIGTERM is received.
+
+    Mirrors the life cycle of `Application.run_polling`: `post_init`, `post_stop` and `post_shutdown` are called the
+    same way. Without `secret_token`, a random one is generated on every start.
+    """
+    secret_token = secret_token or secrets.token_urlsafe(32)
+    server = WebhookServer(application, path=path, secret_token=secret_token, listen=listen, port=port)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stop_signal, stop_event.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await server.start()
+        await application.bot.set_webhook(
+            url=f"{url.rstrip('/')}{path}", secret_token=secret_token, allowed_updates=Update.ALL_TYPES
+        )
+        await application.start()
+        await stop_event.wait()
+        logger.info("Stopping the webhook server...")
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import multiprocessing
+import signal
+from multiprocessing.process import BaseProcess
+from multiprocessing.queues import Queue
+from typing import Any, Callable, Coroutine
+
+from loguru import logger
+from telegram import Update
+from telegram.ext import Application, ApplicationBuilder, CallbackContext, ContextTypes
+
+from hiroshi.config import application_settings, telegram_settings
+from hiroshi.metrics import start_metrics_server
+from hiroshi.services.bot import (
+    handle_overload,
+    handle_provider_selection,
+    handle_reset,
+    prompt_scheduler,
+    schedule_prompt,
+)
+from hiroshi.services.chat import summary_scheduler
+from hiroshi.services.providers import providers_loader
+from hiroshi.services.rate_limiter import get_rate_limiter
+from hiroshi.services.response_cache import response_cache
+from hiroshi.services.scoreboard import (
+    load_scoreboard,
+    run_scoreboard_saver,
+    save_scoreboard,
+)
+from hiroshi.storage.database import close_database
+from hiroshi.tokenizer import load_ranks
+from hiroshi.tracing import TraceContext, tracer
+from hiroshi.utils import get_telegram_request
+
+# How long a worker being stopped waits for the prompts it has accepted to be answered.
+WORKER_DRAIN_TIMEOUT = 30
+# The updates dispatched to the workers other than prompts, by the name of their handler.
+WORKER_HANDLERS: dict[str, Callable[[Update, ContextTypes.DEFAULT_TYPE], Coroutine[Any, Any, None]]] = {
+    "reset": handle_reset,
+    "provider_selection": handle_provider_selection,
+}
+
+
+class WorkerPool:
+    """Processes answering the prompts, so the bot's work is spread over all the CPU cores.
+
+    The process running the `Application` only receives the updates and dispatches the prompts and the changes of the
+    chats (`/reset`, provider selection) to the workers. A chat is always served by the same worker (chosen by the chat
+    ID), so the prompts of a chat keep being answered one at a time and in order, and its history and settings are
+    only written by one process. Every worker has its own prompt scheduler, provider scoreboard and caches, and replies
+    through the Bot API by itself. The workers share the storage, so it must be Redis or SQLite.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._context = multiprocessing.get_context("spawn")
+        self._queues: list[Queue[str | None]] = [self._context.Queue() for _ in range(size)]
+        self._processes: list[BaseProcess | None] = [None] * size
+
+    def _start_worker(self, index: int) -> None:
+        process = self._context.Process(
+            target=run_worker, args=(index, self._queues[index]), name=f"hiroshi-worker-{index}", daemon=True
+        )
+        process.start()
+        self._processes[index] = process
+        logger.info(f"Worker {index} started (PID {process.pid}).")
+
+    def start(self) -> None:
+        for index in range(self.size):
+            self._start_worker(index)
+
+    def dispatch(self, chat_id: int, update: Update, handler: str = "prompt") -> None:
+        """Have the worker of the chat handle the update: schedule its prompt or run one of the `WORKER_HANDLERS`."""
+        index = chat_id % self.size
+        process = self._processes[index]
+        if process is None or not process.is_alive():
+            logger.error(f"Worker {index} is not running (exit code: {process and process.exitcode}). Restarting...")
+            self._start_worker(index)
+        # The trace of the update (if it's traced) is continued by the worker.
+        trace_context = tracer.get_trace_context()
+        payload = {
+            "update": update.to_dict(),
+            "handler": handler,
+            "trace": trace_context.to_dict() if trace_context else None,
+        }
+        self._queues[index].put_nowait(json.dumps(payload))
+
+    def close(self) -> None:
+        for queue in self._queues:
+            queue.put_nowait(None)
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(timeout=WORKER_DRAIN_TIMEOUT + 5)
+            if process.is_alive():
+                logger.warning(f"Worker {index} didn't stop in time. Terminating it...")
+                process.terminate()
+        logger.info("All workers stopped.")
+
+
+def run_worker(index: int, queue: "Queue[str | None]") -> None:
+    # The pool stops the workers itself: Ctrl+C in a terminal must not interrupt them halfway through.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_worker(index, queue))
+
+
+def build_worker_application() -> Application:  # type: ignore
+    builder = ApplicationBuilder().token(telegram_settings.token).request(get_telegram_request()).updater(None)
+    if rate_limiter := get_rate_limiter():
+        return builder.rate_limiter(rate_limiter).build()
+    return builder.build()
+
+
+async def serve_worker(index: int, queue: "Queue[str | None]") -> None:
+    application = build_worker_application()
+    await application.initialize()
+    await application.start()
+    providers_loader.start()
+    # The tokenizer's vocabulary is loaded in a thread rather than on the event loop by the first prompt.
+    await asyncio.to_thread(load_ranks)
+    await load_scoreboard()
+    # Every worker serves its own metrics, on the ports following the main process' one.
+    metrics_server = None
+    if application_settings.metrics_port:
+        metrics_server = await start_metrics_server(
+            listen=application_settings.metrics_listen, port=application_settings.metrics_port + index + 1
+        )
+    if application.job_queue and application_settings.provider_stats_save_interval > 0:
+        application.job_queue.run_repeating(
+            callback=run_scoreboard_saver,
+            interval=application_settings.provider_stats_save_interval,
+            first=application_settings.provider_stats_save_interval,
+        )
+    background_tasks: set[asyncio.Task[Any]] = set()
+    try:
+        while (payload := await asyncio.to_thread(queue.get)) is not None:
+            data = json.loads(payload)
+            update = Update.de_json(data["update"], application.bot)
+            if update is None:
+                continue
+            context: CallbackContext[Any, Any, Any, Any] = CallbackContext.from_update(update, application)
+            handler = data["handler"]
+            with tracer.continue_trace(f"dispatched_{handler}", TraceContext.parse(data["trace"]), worker=index):
+                if handler in WORKER_HANDLERS:
+                    task = asyncio.create_task(WORKER_HANDLERS[handler](update, context))
+                elif not schedule_prompt(update=update, context=context):
+                    task = asyncio.create_task(handle_overload(update=update, context=context))
+                else:
+                    continue
+                background_tasks.add(task)
+                task.add_done_callback(background_tasks.discard)
+        logger.info(f"Worker {index} is stopping: answering the prompts accepted...")
+        await prompt_scheduler.wait_idle(timeout=WORKER_DRAIN_TIMEOUT)
+        if background_tasks:
+            await asyncio.wait(background_tasks, timeout=WORKER_DRAIN_TIMEOUT)
+    finally:
+        await prompt_scheduler.close()
+        await summary_scheduler.close()
+        await response_cache.close()
+        await save_scoreboard()
+        await close_database()
+        await tracer.close()
+        await application.stop()
+        await application.shutdown()
+        if metrics_server:
+            await metrics_server.cleanup()
@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 
-from hiroshi.models import Chat, Message
+from hiroshi.models import Chat, Message, ProviderStats, SweepReport
 
 
 class Database(ABC):
@@ -23,3 +23,26 @@ class Database(ABC):
     @abstractmethod
     async def drop_messages(self, chat: Chat) -> None:
         ...
+
+    async def sweep(self) -> SweepReport:
+        """Delete expired messages and idle chats the storage doesn't get rid of by itself."""
+        return SweepReport()
+
+    async def get_provider_stats(self) -> list[ProviderStats]:
+        """Load the provider scoreboard saved by `save_provider_stats`."""
+        return []
+
+    async def save_provider_stats(self, stats: list[ProviderStats]) -> None:
+        """Save (or update) the scoreboard entries of the providers passed."""
+        return None
+
+    async def get_cached_response(self, key: str) -> str | None:
+        """Get the provider's answer saved by `save_cached_response`, shared by all the bot's replicas."""
+        return None
+
+    async def save_cached_response(self, key: str, answer: str, ttl: int) -> None:
+        """Save the provider's answer for `ttl` seconds, if the storage can share it between the bot's replicas."""
+        return None
+
+    async def close(self) -> None:
+        return None
@@ -0,0 +1,150 @@
+import asyncio
+import time
+from asyncio import Task
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from loguru import logger
+
+from hiroshi.config import gpt_settings
+from hiroshi.metrics import storage_cache_requests
+from hiroshi.models import Chat, Message, ProviderStats, SweepReport
+from hiroshi.storage.abstract import Database
+
+PendingWrite = Callable[[], Awaitable[None]]
+
+
+class CachedStorage(Database):
+    """Write-behind LRU cache in front of a real storage backend.
+
+    Hot chats are kept in memory for up to `ttl` seconds (but no more than `max_size` of them at once), so reads
+    are served without touching the backend. Writes are applied to the cached chat immediately and replayed to the
+    backend in the background, in order, one chat at a time.
+    """
+
+    def __init__(self, backend: Database, max_size: int, ttl: int) -> None:
+        self.backend = backend
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._chats: OrderedDict[int, tuple[float, Chat]] = OrderedDict()
+        self._loading: dict[int, Task[Chat]] = {}
+        self._pending: dict[int, list[PendingWrite]] = {}
+        self._flushers: dict[int, Task[None]] = {}
+        logger.info(f"Storage cache initialized (size: {max_size} chats, TTL: {ttl} seconds).")
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / requests, 4) if requests else 0.0,
+            "size": len(self._chats),
+            "pending_writes": sum(len(writes) for writes in self._pending.values()),
+        }
+
+    def _get_cached(self, chat_id: int) -> Chat | None:
+        if cached := self._chats.get(chat_id):
+            loaded_at, chat = cached
+            if time.monotonic() - loaded_at < self.ttl:
+                self._chats.move_to_end(chat_id)
+                return chat
+            del self._chats[chat_id]
+        return None
+
+    def _remember(self, chat: Chat) -> None:
+        self._chats[chat.id] = (time.monotonic(), chat)
+        self._chats.move_to_end(chat.id)
+        while len(self._chats) > self.max_size:
+            self._chats.popitem(last=False)
+
+    async def _load(self, chat_id: int) -> Chat:
+        # Pending writes must reach the backend before it can be trusted as a source of truth again.
+        if flusher := self._flushers.get(chat_id):
+            await asyncio.shield(flusher)
+        chat = await self.backend.get_or_create_chat(chat_id=chat_id)
+        self._remember(chat)
+        return chat
+
+    def _schedule_write(self, chat_id: int, write: PendingWrite) -> None:
+        self._pending.setdefault(chat_id, []).append(write)
+        if chat_id not in self._flushers:
+            self._flushers[chat_id] = asyncio.create_task(self._flush_chat(chat_id))
+
+    async def _flush_chat(self, chat_id: int) -> None:
+        while writes := self._pending.get(chat_id):
+            write = writes.pop(0)
+            try:
+                await write()
+            except Exception as e:
+                # The cached copy can't be trusted anymore: drop it and re-read the chat from the backend next time.
+                self._chats.pop(chat_id, None)
+                logger.error(f"Couldn't flush changes of the chat {chat_id} to the storage: {str(e)[:240]}")
+        self._pending.pop(chat_id, None)
+        self._flushers.pop(chat_id, None)
+
+    async def flush(self) -> None:
+        while self._flushers:
+            await asyncio.gather(*self._flushers.values())
+
+    async def get_or_create_chat(self, chat_id: int) -> Chat:
+        if chat := self._get_cached(chat_id):
+            self.hits += 1
+            storage_cache_requests.inc(outcome="hit")
+            return chat
+
+        self.misses += 1
+        storage_cache_requests.inc(outcome="miss")
+        if chat_id not in self._loading:
+            loading = asyncio.create_task(self._load(chat_id))
+            self._loading[chat_id] = loading
+            loading.add_done_callback(lambda _: self._loading.pop(chat_id, None))
+        return await asyncio.shield(self._loading[chat_id])
+
+    async def save_chat(self, chat: Chat) -> None:
+        self._remember(chat)
+        snapshot = chat.copy(deep=True)
+        self._schedule_write(chat.id, lambda: self.backend.save_chat(snapshot))
+
+    async def add_message(self, chat: Chat, message: Message, ttl: int | None = None) -> None:
+        cached_chat = await self.get_or_create_chat(chat_id=chat.id)
+        expire_at = time.time() + ttl if ttl else None
+        cached_chat.append_message(message.copy(update={"expire_at": expire_at}))
+        self._schedule_write(chat.id, lambda: self.backend.add_message(chat=cached_chat, message=message, ttl=ttl))
+
+    async def get_messages(self, chat: Chat) -> list[dict[str, str]]:
+        cached_chat = await self.get_or_create_chat(chat_id=chat.id)
+        current_time = time.time()
+        return [
+            msg.dict(exclude={"expire_at", "id", "tokens"})
+            for msg in cached_chat.messages
+            if msg.expire_at is None or msg.expire_at > current_time
+        ]
+
+    async def drop_messages(self, chat: Chat) -> None:
+        cached_chat = await self.get_or_create_chat(chat_id=chat.id)
+        cached_chat.replace_messages([Message(role="system", content=gpt_settings.assistant_prompt)])
+        snapshot = cached_chat.copy(deep=True)
+        self._schedule_write(chat.id, lambda: self.backend.drop_messages(chat=snapshot))
+
+    async def sweep(self) -> SweepReport:
+        return await self.backend.sweep()
+
+    async def get_provider_stats(self) -> list[ProviderStats]:
+        return await self.backend.get_provider_stats()
+
+    async def save_provider_stats(self, stats: list[ProviderStats]) -> None:
+        await self.backend.save_provider_stats(stats)
+
+    async def get_cached_response(self, key: str) -> str | None:
+        return await self.backend.get_cached_response(key)
+
+    async def save_cached_response(self, key: str, answer: str, ttl: int) -> None:
+        await self.backend.save_cached_response(key, answer, ttl)
+
+    async def close(self) -> None:
+        await self.flush()
+        logger.info(f"Storage cache stats: {self.stats}")
+        await self.backend.close()
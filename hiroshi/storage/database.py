@@ -4,7 +4,12 @@ from typing import Any, Callable
 
 from hiroshi.config import application_settings
 from hiroshi.storage.abstract import Database
+from hiroshi.storage.cache import CachedStorage
+from hiroshi.storage.journal import JournalStorage
 from hiroshi.storage.local import LocalStorage
+from hiroshi.storage.metered import MeteredStorage
+from hiroshi.storage.sqlite import SQLiteStorage
+from hiroshi.tracing import tracer
 
 if application_settings.redis:
     from hiroshi.storage.redis import RedisStorage
@@ -20,15 +25,50 @@ class DatabaseCache:
             if self._cache is not None:
                 return self._cache
 
+            backend: Database
             if application_settings.redis:
-                self._cache = await RedisStorage.create(
+                backend = await RedisStorage.create(
                     url=application_settings.redis, password=application_settings.redis_password
                 )
+            elif application_settings.sqlite:
+                backend = await SQLiteStorage.create(path=application_settings.sqlite)
+            elif application_settings.local_storage_engine == "journal":
+                backend = JournalStorage(
+                    application_settings.local_data_path,
+                    compact_after=application_settings.local_storage_compact_after,
+                    idle_chat_ttl=application_settings.storage_sweep_idle_chat_ttl,
+                    sweep_files_per_second=application_settings.storage_sweep_rate,
+                )
             else:
-                self._cache = LocalStorage(application_settings.local_data_path)
+                backend = LocalStorage(
+                    application_settings.local_data_path,
+                    idle_chat_ttl=application_settings.storage_sweep_idle_chat_ttl,
+                    sweep_files_per_second=application_settings.storage_sweep_rate,
+                )
+
+            backend = MeteredStorage(backend)
+
+            # Worker processes can't see each other's cached chats: in that mode every read goes to the storage.
+            if (
+                application_settings.storage_cache_size > 0
+                and application_settings.storage_cache_ttl > 0
+                and not application_settings.workers
+            ):
+                backend = CachedStorage(
+                    backend=backend,
+                    max_size=application_settings.storage_cache_size,
+                    ttl=application_settings.storage_cache_ttl,
+                )
 
+            self._cache = backend
             return self._cache
 
+    async def close(self) -> None:
+        async with self._lock:
+            if self._cache is not None:
+                await self._cache.close()
+            self._cache = None
+
     def clear_cache(self) -> None:
         self._cache = None
 
@@ -39,7 +79,12 @@ _db_provider = DatabaseCache()
 def inject_database(func: Callable[..., Any]) -> Callable[..., Any]:
     @wraps(func)
     async def wrapper(*args: Any, **kwargs: Any) -> Any:
-        db = await _db_provider.get_database()
-        return await func(db, *args, **kwargs)
+        with tracer.span(func.__name__):
+            db = await _db_provider.get_database()
+            return await func(db, *args, **kwargs)
 
     return wrapper
+
+
+async def close_database() -> None:
+    await _db_provider.close()
@@ -0,0 +1,287 @@
+import asyncio
+import json
+import os
+import pickle
+import time
+from typing import cast
+from weakref import WeakValueDictionary
+
+from loguru import logger
+
+from hiroshi.config import gpt_settings
+from hiroshi.models import Chat, Message, ProviderStats, SweepReport
+from hiroshi.storage.abstract import Database
+from hiroshi.storage.local import (
+    chat_is_idle,
+    read_provider_stats,
+    sweep_chat_files,
+    write_provider_stats,
+)
+
+
+class JournalStorage(Database):
+    """Local storage keeping every chat as a snapshot plus an append-only log of the messages added after it.
+
+    Snapshots are pickled chats (the same files `LocalStorage` uses) replaced atomically: written to a temporary file,
+    fsync'ed and renamed. New messages are appended to the `{chat_id}.log` file as JSON lines and fsync'ed. Once the
+    log grows beyond `compact_after` entries, it is folded into a fresh snapshot. All file I/O runs in worker threads,
+    so the event loop never waits for the disk.
+
+    Every snapshot has a generation number, pickled after the chat, and the log starts with the generation of the
+    snapshot it follows. A log left behind by a crash right after a snapshot was replaced belongs to an older
+    generation: it's discarded rather than replayed, since the new snapshot may have dropped its messages on purpose.
+    """
+
+    def __init__(
+        self,
+        storage_path: str,
+        compact_after: int = 50,
+        idle_chat_ttl: int | None = None,
+        sweep_files_per_second: int = 50,
+    ) -> None:
+        self.storage_path = storage_path
+        self.compact_after = compact_after
+        self.idle_chat_ttl = idle_chat_ttl
+        self.sweep_files_per_second = sweep_files_per_second
+        self._locks: WeakValueDictionary[int, asyncio.Lock] = WeakValueDictionary()
+        self._log_entries: dict[int, int] = {}
+        self._generations: dict[int, int] = {}
+        logger.info("Local journal storage initialized.")
+
+    def _get_lock(self, chat_id: int) -> asyncio.Lock:
+        if (lock := self._locks.get(chat_id)) is None:
+            lock = asyncio.Lock()
+            self._locks[chat_id] = lock
+        return lock
+
+    def _get_snapshot_filename(self, chat_id: int) -> str:
+        return os.path.join(self.storage_path, f"{chat_id}.pkl")
+
+    def _get_log_filename(self, chat_id: int) -> str:
+        return os.path.join(self.storage_path, f"{chat_id}.log")
+
+    @staticmethod
+    def _create_chat(chat_id: int) -> Chat:
+        return Chat(id=chat_id, messages=[Message(role="system", content=gpt_settings.assistant_prompt)])
+
+    def _fsync_directory(self) -> None:
+        if os.name != "posix":
+            return
+        directory = os.open(self.storage_path, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def _remove_log(self, chat_id: int) -> None:
+        try:
+            os.remove(self._get_log_filename(chat_id))
+        except FileNotFoundError:
+            pass
+        self._log_entries[chat_id] = 0
+
+    def _read_snapshot(self, chat_id: int) -> tuple[Chat, int] | None:
+        snapshot_filename = self._get_snapshot_filename(chat_id)
+        if not os.path.exists(snapshot_filename):
+            return None
+        with open(snapshot_filename, "rb") as f:
+            chat = cast(Chat, pickle.load(f))
+            try:
+                generation = cast(int, pickle.load(f))
+            except EOFError:
+                # Written by `LocalStorage`, or before the snapshots had a generation.
+                generation = 0
+        return chat, generation
+
+    def _get_generation(self, chat_id: int) -> int:
+        if chat_id not in self._generations:
+            try:
+                snapshot = self._read_snapshot(chat_id)
+            except Exception:
+                snapshot = None
+            self._generations[chat_id] = snapshot[1] if snapshot else 0
+        return self._generations[chat_id]
+
+    def _write_snapshot(self, chat: Chat) -> None:
+        generation = self._get_generation(chat.id) + 1
+        filename = self._get_snapshot_filename(chat.id)
+        temporary_filename = f"{filename}.tmp"
+        with open(temporary_filename, "wb") as f:
+            pickle.dump(chat, f)
+            pickle.dump(generation, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_filename, filename)
+        self._fsync_directory()
+        self._generations[chat.id] = generation
+
+        # A log left behind by a crash right here is of the previous generation, so it's discarded on the next read.
+        self._remove_log(chat.id)
+
+    def _read_log(self, chat_id: int) -> tuple[int, list[Message]]:
+        """The generation of the snapshot the log follows (0 for logs written before they had one) and its messages."""
+        generation, messages = 0, []
+        with open(self._get_log_filename(chat_id), "rb") as f:
+            for number, line in enumerate(f):
+                if number == 0:
+                    try:
+                        header = json.loads(line)
+                    except ValueError:
+                        header = None
+                    if isinstance(header, dict) and set(header) == {"generation"}:
+                        generation = int(header["generation"])
+                        continue
+                try:
+                    messages.append(Message.parse_raw(line))
+                except ValueError:
+                    logger.warning(f"Skipping a corrupted entry in the message log of the chat {chat_id}.")
+        return generation, messages
+
+    def _read_chat(self, chat_id: int) -> Chat | None:
+        if not (snapshot := self._read_snapshot(chat_id)):
+            return None
+        chat, generation = snapshot
+        self._generations[chat_id] = generation
+
+        try:
+            log_generation, log_messages = self._read_log(chat_id)
+        except FileNotFoundError:
+            log_generation, log_messages = generation, []
+        if log_generation != generation:
+            logger.warning(f"Discarding the message log of the chat {chat_id} left behind by an older snapshot.")
+            self._remove_log(chat_id)
+            return chat
+
+        known_message_ids = {message.id for message in chat.messages}
+        for message in log_messages:
+            if message.id not in known_message_ids:
+                chat.append_message(message)
+        self._log_entries[chat_id] = len(log_messages)
+        return chat
+
+    def _load_chat(self, chat_id: int) -> Chat | None:
+        chat = self._read_chat(chat_id)
+        if chat and self._log_entries[chat_id] >= self.compact_after:
+            self._compact(chat)
+        elif chat:
+            chat.drop_expired_messages()
+        return chat
+
+    def _compact(self, chat: Chat) -> None:
+        chat.drop_expired_messages()
+        self._write_snapshot(chat)
+
+    def _append_message(self, chat_id: int, message: Message) -> None:
+        # Reading the chat first learns its generation and discards a log of an older one.
+        if chat_id not in self._generations and not self._read_chat(chat_id):
+            self._write_snapshot(self._create_chat(chat_id))
+
+        with open(self._get_log_filename(chat_id), "a+b") as f:
+            if f.tell() == 0:
+                f.write(json.dumps({"generation": self._generations[chat_id]}).encode() + b"\n")
+            else:
+                # A crash in the middle of the previous append may have left an unterminated line behind.
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            f.write(message.json().encode() + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._log_entries[chat_id] = self._log_entries.get(chat_id, 0) + 1
+        if self._log_entries[chat_id] >= self.compact_after and (chat := self._read_chat(chat_id)):
+            self._compact(chat)
+
+    def _get_or_create_chat(self, chat_id: int) -> Chat:
+        try:
+            if chat := self._load_chat(chat_id):
+                return chat
+        except Exception as e:
+            logger.error(f"Couldn't get history for the chat {chat_id} due to exception: {str(e)[:240]}")
+        chat = self._create_chat(chat_id)
+        self._write_snapshot(chat)
+        return chat
+
+    def _get_files_stat(self, chat_id: int) -> tuple[int, float]:
+        size, modified_at = 0, 0.0
+        for filename in (self._get_snapshot_filename(chat_id), self._get_log_filename(chat_id)):
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                continue
+            size += stat.st_size
+            modified_at = max(modified_at, stat.st_mtime)
+        return size, modified_at
+
+    def _sweep_chat(self, chat_id: int) -> SweepReport:
+        size_before, modified_at = self._get_files_stat(chat_id)
+        if not (chat := self._read_chat(chat_id)):
+            return SweepReport()
+
+        if chat_is_idle(chat=chat, modified_at=modified_at, idle_chat_ttl=self.idle_chat_ttl):
+            for filename in (self._get_snapshot_filename(chat_id), self._get_log_filename(chat_id)):
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+            self._log_entries.pop(chat_id, None)
+            self._generations.pop(chat_id, None)
+            return SweepReport(
+                chats_checked=1, chats_deleted=1, messages_deleted=len(chat.messages), bytes_reclaimed=size_before
+            )
+
+        messages_before = len(chat.messages)
+        if not self._log_entries[chat_id] and not any(msg.is_expired for msg in chat.messages):
+            return SweepReport(chats_checked=1)
+
+        self._compact(chat)
+        size_after, _ = self._get_files_stat(chat_id)
+        return SweepReport(
+            chats_checked=1,
+            messages_deleted=messages_before - len(chat.messages),
+            bytes_reclaimed=size_before - size_after,
+        )
+
+    async def _sweep_chat_locked(self, chat_id: int) -> SweepReport:
+        async with self._get_lock(chat_id):
+            return await asyncio.to_thread(self._sweep_chat, chat_id)
+
+    async def sweep(self) -> SweepReport:
+        return await sweep_chat_files(
+            storage_path=self.storage_path,
+            files_per_second=self.sweep_files_per_second,
+            sweep_chat=self._sweep_chat_locked,
+        )
+
+    async def get_provider_stats(self) -> list[ProviderStats]:
+        return await asyncio.to_thread(read_provider_stats, self.storage_path)
+
+    async def save_provider_stats(self, stats: list[ProviderStats]) -> None:
+        await asyncio.to_thread(write_provider_stats, self.storage_path, [entry.copy(deep=True) for entry in stats])
+
+    async def save_chat(self, chat: Chat) -> None:
+        async with self._get_lock(chat.id):
+            await asyncio.to_thread(self._write_snapshot, chat.copy(deep=True))
+
+    async def get_or_create_chat(self, chat_id: int) -> Chat:
+        async with self._get_lock(chat_id):
+            return await asyncio.to_thread(self._get_or_create_chat, chat_id)
+
+    async def add_message(self, chat: Chat, message: Message, ttl: int | None = None) -> None:
+        expire_at = time.time() + ttl if ttl else None
+        message_with_ttl = message.copy(update={"expire_at": expire_at})
+        async with self._get_lock(chat.id):
+            await asyncio.to_thread(self._append_message, chat.id, message_with_ttl)
+
+    async def get_messages(self, chat: Chat) -> list[dict[str, str]]:
+        chat_refreshed = await self.get_or_create_chat(chat_id=chat.id)
+        current_time = time.time()
+        return [
+            msg.dict(exclude={"expire_at", "id", "tokens"})
+            for msg in chat_refreshed.messages
+            if msg.expire_at is None or msg.expire_at > current_time
+        ]
+
+    async def drop_messages(self, chat: Chat) -> None:
+        chat.replace_messages([Message(role="system", content=gpt_settings.assistant_prompt)])
+        await self.save_chat(chat=chat)
@@ -1,38 +1,103 @@
+import asyncio
+import json
 import os
 import pickle
 import time
-from typing import cast
+from typing import Awaitable, Callable, cast
+from weakref import WeakValueDictionary
 
 from loguru import logger
 
 from hiroshi.config import gpt_settings
-from hiroshi.models import Chat, Message
+from hiroshi.models import Chat, Message, ProviderStats, SweepReport
 from hiroshi.storage.abstract import Database
 
+PROVIDER_STATS_FILENAME = "provider_stats.json"
+
+
+def chat_is_idle(chat: Chat, modified_at: float, idle_chat_ttl: int | None) -> bool:
+    """Check if a chat has nothing but its initial prompt left and hasn't been touched for `idle_chat_ttl` seconds.
+    Chats with a provider or a model chosen (with /provider) are never idle: deleting them would lose the choice."""
+    current_time = time.time()
+    if not idle_chat_ttl or current_time - modified_at < idle_chat_ttl:
+        return False
+    defaults = Chat(id=chat.id)
+    if (chat.provider_name, chat.model_name) != (defaults.provider_name, defaults.model_name):
+        return False
+    return all(msg.role == "system" for msg in chat.messages if msg.expire_at is None or msg.expire_at > current_time)
+
+
+def list_chat_ids(storage_path: str) -> list[int]:
+    chat_ids = []
+    with os.scandir(storage_path) as entries:
+        for entry in entries:
+            name, extension = os.path.splitext(entry.name)
+            if extension == ".pkl" and name.lstrip("-").isdigit():
+                chat_ids.append(int(name))
+    return chat_ids
+
+
+async def sweep_chat_files(
+    storage_path: str, files_per_second: int, sweep_chat: Callable[[int], Awaitable[SweepReport]]
+) -> SweepReport:
+    """Walk through the chat files one by one, pausing between them so the sweep doesn't compete with live traffic."""
+    report = SweepReport()
+    for chat_id in await asyncio.to_thread(list_chat_ids, storage_path):
+        try:
+            report += await sweep_chat(chat_id)
+        except Exception as e:
+            logger.error(f"Couldn't sweep the chat {chat_id} due to exception: {str(e)[:240]}")
+        await asyncio.sleep(1 / files_per_second)
+    return report
+
+
+def read_provider_stats(storage_path: str) -> list[ProviderStats]:
+    try:
+        with open(os.path.join(storage_path, PROVIDER_STATS_FILENAME), "rb") as f:
+            return [ProviderStats.parse_obj(entry) for entry in json.load(f)]
+    except FileNotFoundError:
+        return []
+    except Exception as e:
+        logger.error(f"Couldn't read the provider scoreboard due to exception: {str(e)[:240]}")
+        return []
+
+
+def write_provider_stats(storage_path: str, stats: list[ProviderStats]) -> None:
+    """Merge the entries passed into the scoreboard file and replace it atomically."""
+    entries = {(entry.model_name, entry.provider_name): entry for entry in read_provider_stats(storage_path)}
+    entries.update({(entry.model_name, entry.provider_name): entry for entry in stats})
+    filename = os.path.join(storage_path, PROVIDER_STATS_FILENAME)
+    with open(f"{filename}.tmp", "w") as f:
+        json.dump([entry.dict() for entry in entries.values()], f)
+    os.replace(f"{filename}.tmp", filename)
+
 
 class LocalStorage(Database):
-    def __init__(self, storage_path: str):
+    """Keeps every chat pickled in its own file. The file I/O runs in worker threads, one operation at a time per chat,
+    so the event loop never waits for the disk."""
+
+    def __init__(self, storage_path: str, idle_chat_ttl: int | None = None, sweep_files_per_second: int = 50):
         self.storage_path = storage_path
+        self.idle_chat_ttl = idle_chat_ttl
+        self.sweep_files_per_second = sweep_files_per_second
+        self._locks: WeakValueDictionary[int, asyncio.Lock] = WeakValueDictionary()
         logger.info("Local storage initialized.")
 
+    def _get_lock(self, chat_id: int) -> asyncio.Lock:
+        if (lock := self._locks.get(chat_id)) is None:
+            lock = asyncio.Lock()
+            self._locks[chat_id] = lock
+        return lock
+
     def _get_storage_filename(self, chat_id: int) -> str:
         return os.path.join(self.storage_path, f"{chat_id}.pkl")
 
-    async def save_chat(self, chat: Chat) -> None:
+    def _write_chat(self, chat: Chat) -> None:
         filename = self._get_storage_filename(chat.id)
         with open(filename, "wb") as f:
             pickle.dump(chat, f)
 
-    async def create_chat(self, chat_id: int) -> Chat:
-        chat = Chat(id=chat_id)
-        initial_message = Message(role="system", content=gpt_settings.assistant_prompt)
-        chat.messages = [
-            initial_message,
-        ]
-        await self.save_chat(chat=chat)
-        return chat
-
-    async def get_chat(self, chat_id: int) -> Chat | None:
+    def _read_chat(self, chat_id: int) -> Chat | None:
         filename = self._get_storage_filename(chat_id)
         try:
             if os.path.exists(filename):
@@ -42,28 +107,55 @@ class LocalStorage(Database):
             logger.error(f"Couldn't get history for the chat {chat_id} due to exception: {str(e)[:240]}")
         return None
 
-    async def get_or_create_chat(self, chat_id: int) -> Chat:
-        if chat := await self.get_chat(chat_id=chat_id):
+    def _get_or_create_chat(self, chat_id: int) -> Chat:
+        if chat := self._read_chat(chat_id):
+            chat.drop_expired_messages()
             return chat
-        return await self.create_chat(chat_id=chat_id)
+        chat = Chat(id=chat_id)
+        chat.replace_messages([Message(role="system", content=gpt_settings.assistant_prompt)])
+        self._write_chat(chat)
+        return chat
+
+    def _append_message(self, chat_id: int, message: Message) -> None:
+        chat = self._get_or_create_chat(chat_id)
+        chat.append_message(message)
+        self._write_chat(chat)
+
+    async def save_chat(self, chat: Chat) -> None:
+        async with self._get_lock(chat.id):
+            await asyncio.to_thread(self._write_chat, chat.copy(deep=True))
+
+    async def create_chat(self, chat_id: int) -> Chat:
+        chat = Chat(id=chat_id)
+        initial_message = Message(role="system", content=gpt_settings.assistant_prompt)
+        chat.replace_messages([initial_message])
+        await self.save_chat(chat=chat)
+        return chat
+
+    async def get_chat(self, chat_id: int) -> Chat | None:
+        async with self._get_lock(chat_id):
+            return await asyncio.to_thread(self._read_chat, chat_id)
+
+    async def get_or_create_chat(self, chat_id: int) -> Chat:
+        async with self._get_lock(chat_id):
+            return await asyncio.to_thread(self._get_or_create_chat, chat_id)
 
     async def add_message(self, chat: Chat, message: Message, ttl: int | None = None) -> None:
-        user_refreshed = await self.get_or_create_chat(chat_id=chat.id)
         if ttl:
             expire_at = time.time() + ttl
         else:
             expire_at = None
 
-        message_with_ttl = Message(role=message.role, content=message.content, expire_at=expire_at)
-        user_refreshed.messages.append(message_with_ttl)
-        await self.save_chat(user_refreshed)
+        message_with_ttl = message.copy(update={"expire_at": expire_at})
+        async with self._get_lock(chat.id):
+            await asyncio.to_thread(self._append_message, chat.id, message_with_ttl)
 
     async def get_messages(self, chat: Chat) -> list[dict[str, str]]:
         user_refreshed = await self.get_or_create_chat(chat_id=chat.id)
         current_time = time.time()
 
         msgs = [
-            msg.dict(exclude={"expire_at", "id"})
+            msg.dict(exclude={"expire_at", "id", "tokens"})
             for msg in user_refreshed.messages
             if msg.expire_at is None or msg.expire_at > current_time
         ]
@@ -71,7 +163,49 @@ class LocalStorage(Database):
 
     async def drop_messages(self, chat: Chat) -> None:
         initial_message = Message(role="system", content=gpt_settings.assistant_prompt)
-        chat.messages = [
-            initial_message,
-        ]
+        chat.replace_messages([initial_message])
         await self.save_chat(chat=chat)
+
+    def _sweep_chat(self, chat_id: int) -> SweepReport:
+        filename = self._get_storage_filename(chat_id)
+        try:
+            size_before = os.path.getsize(filename)
+            modified_at = os.path.getmtime(filename)
+        except FileNotFoundError:
+            return SweepReport()
+
+        if not (chat := self._read_chat(chat_id)):
+            return SweepReport(chats_checked=1)
+
+        if chat_is_idle(chat=chat, modified_at=modified_at, idle_chat_ttl=self.idle_chat_ttl):
+            os.remove(filename)
+            return SweepReport(
+                chats_checked=1, chats_deleted=1, messages_deleted=len(chat.messages), bytes_reclaimed=size_before
+            )
+
+        if not (messages_deleted := chat.drop_expired_messages()):
+            return SweepReport(chats_checked=1)
+
+        self._write_chat(chat)
+        return SweepReport(
+            chats_checked=1,
+            messages_deleted=messages_deleted,
+            bytes_reclaimed=size_before - os.path.getsize(filename),
+        )
+
+    async def _sweep_chat_locked(self, chat_id: int) -> SweepReport:
+        async with self._get_lock(chat_id):
+            return await asyncio.to_thread(self._sweep_chat, chat_id)
+
+    async def get_provider_stats(self) -> list[ProviderStats]:
+        return await asyncio.to_thread(read_provider_stats, self.storage_path)
+
+    async def save_provider_stats(self, stats: list[ProviderStats]) -> None:
+        await asyncio.to_thread(write_provider_stats, self.storage_path, [entry.copy(deep=True) for entry in stats])
+
+    async def sweep(self) -> SweepReport:
+        return await sweep_chat_files(
+            storage_path=self.storage_path,
+            files_per_second=self.sweep_files_per_second,
+            sweep_chat=self._sweep_chat_locked,
+        )
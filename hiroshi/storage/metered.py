@@ -0,0 +1,54 @@
+from hiroshi.metrics import storage_operation_duration
+from hiroshi.models import Chat, Message, ProviderStats, SweepReport
+from hiroshi.storage.abstract import Database
+
+
+class MeteredStorage(Database):
+    """Measures how long the operations of a storage backend take (see `hiroshi_storage_operation_duration_seconds`)."""
+
+    def __init__(self, backend: Database) -> None:
+        self.backend = backend
+        self.backend_name = type(backend).__name__
+
+    async def get_or_create_chat(self, chat_id: int) -> Chat:
+        with storage_operation_duration.time(backend=self.backend_name, method="get_or_create_chat"):
+            return await self.backend.get_or_create_chat(chat_id=chat_id)
+
+    async def save_chat(self, chat: Chat) -> None:
+        with storage_operation_duration.time(backend=self.backend_name, method="save_chat"):
+            await self.backend.save_chat(chat)
+
+    async def add_message(self, chat: Chat, message: Message, ttl: int | None = None) -> None:
+        with storage_operation_duration.time(backend=self.backend_name, method="add_message"):
+            await self.backend.add_message(chat=chat, message=message, ttl=ttl)
+
+    async def get_messages(self, chat: Chat) -> list[dict[str, str]]:
+        with storage_operation_duration.time(backend=self.backend_name, method="get_messages"):
+            return await self.backend.get_messages(chat=chat)
+
+    async def drop_messages(self, chat: Chat) -> None:
+        with storage_operation_duration.time(backend=self.backend_name, method="drop_messages"):
+            await self.backend.drop_messages(chat=chat)
+
+    async def sweep(self) -> SweepReport:
+        with storage_operation_duration.time(backend=self.backend_name, method="sweep"):
+            return await self.backend.sweep()
+
+    async def get_provider_stats(self) -> list[ProviderStats]:
+        with storage_operation_duration.time(backend=self.backend_name, method="get_provider_stats"):
+            return await self.backend.get_provider_stats()
+
+    async def save_provider_stats(self, stats: list[ProviderStats]) -> None:
+        with storage_operation_duration.time(backend=self.backend_name, method="save_provider_stats"):
+            await self.backend.save_provider_stats(stats)
+
+    async def get_cached_response(self, key: str) -> str | None:
+        with storage_operation_duration.time(backend=self.backend_name, method="get_cached_response"):
+            return await self.backend.get_cached_response(key)
+
+    async def save_cached_response(self, key: str, answer: str, ttl: int) -> None:
+        with storage_operation_duration.time(backend=self.backend_name, method="save_cached_response"):
+            await self.backend.save_cached_response(key, answer, ttl)
+
+    async def close(self) -> None:
+        await self.backend.close()
@@ -1,12 +1,69 @@
+import time
 from urllib.parse import urlparse
 
 from loguru import logger
 from redis.asyncio import Redis, from_url
 
 from hiroshi.config import gpt_settings
-from hiroshi.models import Chat, Message
+from hiroshi.models import Chat, Message, ProviderStats
 from hiroshi.storage.abstract import Database
 
+LAYOUT_VERSION = 2
+LAYOUT_VERSION_KEY = "hiroshi:storage:layout"
+LAYOUT_MIGRATION_LOCK_KEY = "hiroshi:storage:migration"
+LEGACY_MESSAGE_KEYS_PATTERN = "chat:*:message:*"
+PROVIDER_STATS_KEY = "hiroshi:provider_stats"
+RESPONSE_CACHE_KEY_PREFIX = "hiroshi:response_cache:"
+
+# Every chat is stored as three keys:
+#   chat:{id}           - chat settings (JSON, without messages);
+#   chat:{id}:messages  - sorted set of messages (JSON) ordered by the message ID;
+#   chat:{id}:expiry    - the same messages scored by their expiration timestamp (+inf for the eternal ones).
+# The script below drops expired messages and returns the chat with all its messages in a single round-trip.
+GET_CHAT_SCRIPT = """
+local chat = redis.call('GET', KEYS[1])
+if not chat then
+    return nil
+end
+local expired = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1])
+if #expired > 0 then
+    for i = 1, #expired, 1000 do
+        redis.call('ZREM', KEYS[2], unpack(expired, i, math.min(i + 999, #expired)))
+    end
+    redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', ARGV[1])
+end
+return {chat, redis.call('ZRANGE', KEYS[2], 0, -1)}
+"""
+
+# Saves the chat settings (if ARGV[1] is not empty), optionally resets the history (if ARGV[2] is "1") and adds
+# messages passed as (message, ID score, expiry score) triples. The history keys expire together with the most
+# long-living message.
+SAVE_CHAT_SCRIPT = """
+if ARGV[1] ~= '' then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+if ARGV[2] == '1' then
+    redis.call('DEL', KEYS[2], KEYS[3])
+end
+for i = 3, #ARGV, 3 do
+    redis.call('ZADD', KEYS[2], ARGV[i + 1], ARGV[i])
+    redis.call('ZADD', KEYS[3], ARGV[i + 2], ARGV[i])
+end
+local last_expiration = redis.call('ZRANGE', KEYS[3], -1, -1, 'WITHSCORES')[2]
+if not last_expiration then
+    return 0
+end
+if last_expiration == 'inf' then
+    redis.call('PERSIST', KEYS[2])
+    redis.call('PERSIST', KEYS[3])
+else
+    local expire_at = math.floor(tonumber(last_expiration) * 1000) + 1
+    redis.call('PEXPIREAT', KEYS[2], expire_at)
+    redis.call('PEXPIREAT', KEYS[3], expire_at)
+end
+return 1
+"""
+
 
 class RedisStorage(Database):
     def __init__(self, url: str, password: str | None = None, db: int = 1) -> None:
@@ -20,11 +77,81 @@ class RedisStorage(Database):
     async def create(cls, url: str, password: str | None = None, db: int = 1) -> "RedisStorage":
         instance = cls(url, password, db)
         await instance.connect()
+        await instance.migrate_legacy_layout()
         return instance
 
     async def connect(self) -> None:
         redis_dsn = self._combine_redis_dsn(base_dsn=self.url, password=self.password)
         self.redis = await from_url(redis_dsn)
+        self._get_chat_script = self.redis.register_script(GET_CHAT_SCRIPT)
+        self._save_chat_script = self.redis.register_script(SAVE_CHAT_SCRIPT)
+
+    @staticmethod
+    def _chat_key(chat_id: int) -> str:
+        return f"chat:{chat_id}"
+
+    @staticmethod
+    def _messages_key(chat_id: int) -> str:
+        return f"chat:{chat_id}:messages"
+
+    @staticmethod
+    def _expiry_key(chat_id: int) -> str:
+        return f"chat:{chat_id}:expiry"
+
+    @staticmethod
+    def _message_score(message: Message) -> int:
+        # Sorted set scores are doubles: nanosecond IDs don't fit into their 53-bit mantissa, microseconds do.
+        return message.id // 1000
+
+    @staticmethod
+    def _expiry_score(message: Message) -> float:
+        return message.expire_at if message.expire_at is not None else float("inf")
+
+    async def migrate_legacy_layout(self) -> None:
+        """Move messages stored as separate `chat:{id}:message:{message_id}` keys into per-chat sorted sets."""
+        if int(await self.redis.get(LAYOUT_VERSION_KEY) or 0) >= LAYOUT_VERSION:
+            return
+        if not await self.redis.set(LAYOUT_MIGRATION_LOCK_KEY, 1, nx=True, ex=600):
+            logger.info("Redis storage layout migration is already running in another process.")
+            return
+
+        migrated = 0
+        logger.info("Migrating Redis storage to the sorted set layout...")
+        try:
+            batch: list[bytes] = []
+            async for key in self.redis.scan_iter(match=LEGACY_MESSAGE_KEYS_PATTERN, count=1000):
+                batch.append(key)
+                if len(batch) >= 1000:
+                    migrated += await self._migrate_legacy_keys(batch)
+                    batch = []
+            if batch:
+                migrated += await self._migrate_legacy_keys(batch)
+            await self.redis.set(LAYOUT_VERSION_KEY, LAYOUT_VERSION)
+        finally:
+            await self.redis.delete(LAYOUT_MIGRATION_LOCK_KEY)
+        logger.info(f"Redis storage layout migration finished: {migrated} messages moved.")
+
+    async def _migrate_legacy_keys(self, keys: list[bytes]) -> int:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.get(key)
+                pipe.pttl(key)
+            results = await pipe.execute()
+
+        now = time.time()
+        messages_by_chat: dict[int, list[Message]] = {}
+        for key, message_data, pttl in zip(keys, results[::2], results[1::2]):
+            if not message_data:
+                continue
+            chat_id = int(key.decode().split(":")[1])
+            message = Message.parse_raw(message_data)
+            message.expire_at = now + pttl / 1000 if pttl > 0 else None
+            messages_by_chat.setdefault(chat_id, []).append(message)
+
+        for chat_id, messages in messages_by_chat.items():
+            await self._save(chat_id=chat_id, messages=messages)
+        await self.redis.delete(*keys)
+        return sum(len(messages) for messages in messages_by_chat.values())
 
     def _combine_redis_dsn(self, base_dsn: str, password: str | None) -> str:
         if not password:
@@ -45,40 +172,39 @@ class RedisStorage(Database):
 
         raise ValueError("Incorrect Redis DSN string provided.")
 
-    async def save_chat(self, chat: Chat) -> None:
-        chat_key = f"chat:{chat.id}"
-        chat_data = chat.json()
-        await self.redis.set(chat_key, chat_data)
+    async def _save(
+        self, chat_id: int, messages: list[Message], chat: Chat | None = None, reset_history: bool = False
+    ) -> None:
+        args: list[str | int | float] = [chat.json(exclude={"messages"}) if chat else "", int(reset_history)]
+        for message in messages:
+            args.extend((message.json(), self._message_score(message), self._expiry_score(message)))
 
-        for message in chat.messages:
-            message_key = f"chat:{chat.id}:message:{message.id}"
-            message_data = message.json()
-            await self.redis.set(message_key, message_data)
-            await self.redis.expire(message_key, gpt_settings.messages_ttl)
+        await self._save_chat_script(
+            keys=[self._chat_key(chat_id), self._messages_key(chat_id), self._expiry_key(chat_id)], args=args
+        )
+
+    async def save_chat(self, chat: Chat) -> None:
+        await self._save(chat_id=chat.id, messages=chat.messages, chat=chat, reset_history=True)
 
     async def create_chat(self, chat_id: int) -> Chat:
         chat = Chat(id=chat_id)
         initial_message = Message(role="system", content=gpt_settings.assistant_prompt)
-        chat.messages.append(initial_message)
-        chat_key = f"chat:{chat_id}"
 
-        await self.redis.set(chat_key, chat.json())
-        await self.add_message(chat=chat, message=initial_message)
+        await self._save(chat_id=chat_id, messages=[initial_message], chat=chat, reset_history=True)
+        chat.append_message(initial_message)
         return chat
 
     async def get_chat(self, chat_id: int) -> Chat | None:
-        chat_key = f"chat:{chat_id}"
-        chat_data = await self.redis.get(chat_key)
+        chat_data = await self._get_chat_script(
+            keys=[self._chat_key(chat_id), self._messages_key(chat_id), self._expiry_key(chat_id)],
+            args=[time.time()],
+        )
         if not chat_data:
             return None
 
-        chat = Chat.parse_raw(chat_data)
-        message_keys_pattern = f"chat:{chat.id}:message:*"
-        message_keys = await self.redis.keys(message_keys_pattern)
-        chat_messages = [Message.parse_raw(await self.redis.get(message_key)) for message_key in message_keys]
-
-        chat.messages = sorted(chat_messages, key=lambda msg: msg.id)
-
+        chat_raw, messages_raw = chat_data
+        chat = Chat.parse_raw(chat_raw)
+        chat.replace_messages([Message.parse_raw(message_raw) for message_raw in messages_raw])
         return chat
 
     async def get_or_create_chat(self, chat_id: int) -> Chat:
@@ -87,27 +213,43 @@ class RedisStorage(Database):
         return await self.create_chat(chat_id=chat_id)
 
     async def add_message(self, chat: Chat, message: Message, ttl: int | None = None) -> None:
-        message_to_save = Message(role=message.role, content=message.content)
-        message_key = f"chat:{chat.id}:message:{message.id}"
-
-        await self.redis.set(name=message_key, value=message_to_save.json(exclude={"expire_at"}))
-        if ttl:
-            await self.redis.expire(name=message_key, time=ttl)
+        expire_at = time.time() + ttl if ttl else None
+        message_to_save = message.copy(update={"expire_at": expire_at})
+        await self._save(chat_id=chat.id, messages=[message_to_save])
 
     async def get_messages(self, chat: Chat) -> list[dict[str, str]]:
         chat_refreshed = await self.get_or_create_chat(chat_id=chat.id)
-        return [msg.dict(exclude={"expire_at", "id"}) for msg in chat_refreshed.messages]
+        current_time = time.time()
+        return [
+            msg.dict(exclude={"expire_at", "id", "tokens"})
+            for msg in chat_refreshed.messages
+            if msg.expire_at is None or msg.expire_at > current_time
+        ]
 
     async def drop_messages(self, chat: Chat) -> None:
-        message_keys_pattern = f"chat:{chat.id}:message:*"
-        message_keys = await self.redis.keys(message_keys_pattern)
+        initial_message = Message(
+            role="system", content=gpt_settings.assistant_prompt, expire_at=time.time() + gpt_settings.messages_ttl
+        )
+        chat.replace_messages([initial_message])
+        await self._save(chat_id=chat.id, messages=[initial_message], reset_history=True)
+
+    async def get_provider_stats(self) -> list[ProviderStats]:
+        stats_raw = await self.redis.hvals(PROVIDER_STATS_KEY)  # type: ignore[misc]
+        return [ProviderStats.parse_raw(entry) for entry in stats_raw]
+
+    async def save_provider_stats(self, stats: list[ProviderStats]) -> None:
+        if stats:
+            await self.redis.hset(  # type: ignore[misc]
+                PROVIDER_STATS_KEY,
+                mapping={f"{entry.model_name}:{entry.provider_name}": entry.json() for entry in stats},
+            )
 
-        for message_key in message_keys:
-            await self.redis.delete(message_key)
+    async def get_cached_response(self, key: str) -> str | None:
+        answer = await self.redis.get(f"{RESPONSE_CACHE_KEY_PREFIX}{key}")
+        return answer.decode() if isinstance(answer, bytes) else answer
 
-        initial_message = Message(role="system", content=gpt_settings.assistant_prompt)
-        chat.messages.append(initial_message)
-        await self.add_message(chat=chat, message=initial_message, ttl=gpt_settings.messages_ttl)
+    async def save_cached_response(self, key: str, answer: str, ttl: int) -> None:
+        await self.redis.set(f"{RESPONSE_CACHE_KEY_PREFIX}{key}", answer, ex=ttl)
 
     async def close(self) -> None:
         await self.redis.close()
@@ -0,0 +1,226 @@
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+from loguru import logger
+
+from hiroshi.config import gpt_settings
+from hiroshi.models import Chat, Message, ProviderStats, SweepReport
+from hiroshi.storage.abstract import Database
+
+T = TypeVar("T")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    id INTEGER PRIMARY KEY,
+    provider_name TEXT,
+    model_name TEXT NOT NULL,
+    summary_message_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    expire_at REAL,
+    tokens INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (chat_id, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS provider_stats (
+    model_name TEXT NOT NULL,
+    provider_name TEXT NOT NULL,
+    stats TEXT NOT NULL,
+    PRIMARY KEY (model_name, provider_name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS messages_expire_at ON messages (expire_at) WHERE expire_at IS NOT NULL;
+"""
+# Columns added after the schema was first released, so databases created before have to be migrated.
+ADDED_COLUMNS = (
+    ("messages", "tokens", "INTEGER NOT NULL DEFAULT 0"),
+    ("chats", "summary_message_id", "INTEGER"),
+)
+INSERT_MESSAGE = (
+    "INSERT OR REPLACE INTO messages (chat_id, id, role, content, expire_at, tokens) VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+
+class SQLiteStorage(Database):
+    """Storage backed by a single SQLite database file in WAL mode.
+
+    The connection lives in a dedicated thread and every query runs there, so the event loop never waits for the disk.
+    """
+
+    def __init__(self, path: str, purge_interval: int = 600) -> None:
+        self.path = path
+        self.purge_interval = purge_interval
+        self._connection: sqlite3.Connection
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-storage")
+        self._last_purge = 0.0
+        logger.info("SQLite storage initialized.")
+
+    @classmethod
+    async def create(cls, path: str, purge_interval: int = 600) -> "SQLiteStorage":
+        instance = cls(path, purge_interval)
+        await instance.connect()
+        return instance
+
+    async def _run(self, func: Callable[..., T], *args: Any) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def connect(self) -> None:
+        await self._run(self._connect)
+        await self.delete_expired_messages()
+
+    def _connect(self) -> None:
+        self._connection = sqlite3.connect(self.path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA busy_timeout=5000")
+        self._connection.executescript(SCHEMA)
+        for table, column, definition in ADDED_COLUMNS:
+            columns = {row[1] for row in self._connection.execute(f"PRAGMA table_info({table})")}
+            if column not in columns:
+                self._connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    @staticmethod
+    def _message_row(chat_id: int, message: Message) -> tuple[int, int, str, str, float | None, int]:
+        return chat_id, message.id, message.role, message.content, message.expire_at, message.tokens
+
+    def _insert_chat(self, chat: Chat) -> None:
+        self._connection.execute(
+            "INSERT INTO chats (id, provider_name, model_name, summary_message_id) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET provider_name = excluded.provider_name, model_name = excluded.model_name, "
+            "summary_message_id = excluded.summary_message_id",
+            (chat.id, chat.provider_name, chat.model_name, chat.summary_message_id),
+        )
+
+    def _replace_messages(self, chat_id: int, messages: list[Message]) -> None:
+        self._connection.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+        self._connection.executemany(
+            INSERT_MESSAGE,
+            [self._message_row(chat_id, message) for message in messages],
+        )
+
+    def _save_chat(self, chat: Chat) -> None:
+        with self._connection:
+            self._insert_chat(chat)
+            self._replace_messages(chat.id, chat.messages)
+
+    def _drop_messages(self, chat_id: int, initial_message: Message) -> None:
+        with self._connection:
+            self._replace_messages(chat_id, [initial_message])
+
+    def _get_chat(self, chat_id: int) -> Chat | None:
+        chat_row = self._connection.execute(
+            "SELECT provider_name, model_name, summary_message_id FROM chats WHERE id = ?", (chat_id,)
+        ).fetchone()
+        if not chat_row:
+            return None
+
+        provider_name, model_name, summary_message_id = chat_row
+        message_rows = self._connection.execute(
+            "SELECT id, role, content, expire_at, tokens FROM messages "
+            "WHERE chat_id = ? AND (expire_at IS NULL OR expire_at > ?) ORDER BY id",
+            (chat_id, time.time()),
+        ).fetchall()
+        messages = [
+            Message(id=message_id, role=role, content=content, expire_at=expire_at, tokens=tokens)
+            for message_id, role, content, expire_at, tokens in message_rows
+        ]
+        return Chat(
+            id=chat_id,
+            provider_name=provider_name,
+            model_name=model_name,
+            messages=messages,
+            summary_message_id=summary_message_id,
+        )
+
+    def _get_or_create_chat(self, chat_id: int) -> Chat:
+        if chat := self._get_chat(chat_id):
+            return chat
+        chat = Chat(id=chat_id, messages=[Message(role="system", content=gpt_settings.assistant_prompt)])
+        self._save_chat(chat)
+        return chat
+
+    def _add_message(self, chat_id: int, message: Message) -> None:
+        with self._connection:
+            chat_created = self._connection.execute(
+                "INSERT OR IGNORE INTO chats (id, model_name) VALUES (?, ?)", (chat_id, Chat(id=chat_id).model_name)
+            ).rowcount
+            if chat_created:
+                # The initial prompt must precede the message being added.
+                initial_message = Message(id=message.id - 1, role="system", content=gpt_settings.assistant_prompt)
+                self._replace_messages(chat_id, [initial_message])
+            self._connection.execute(INSERT_MESSAGE, self._message_row(chat_id, message))
+
+        if time.time() - self._last_purge >= self.purge_interval:
+            self._delete_expired_messages()
+
+    def _get_messages(self, chat_id: int) -> list[dict[str, str]]:
+        rows = self._connection.execute(
+            "SELECT role, content FROM messages WHERE chat_id = ? AND (expire_at IS NULL OR expire_at > ?) ORDER BY id",
+            (chat_id, time.time()),
+        ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def _delete_expired_messages(self) -> int:
+        self._last_purge = time.time()
+        with self._connection:
+            return self._connection.execute("DELETE FROM messages WHERE expire_at <= ?", (self._last_purge,)).rowcount
+
+    def _get_provider_stats(self) -> list[ProviderStats]:
+        rows = self._connection.execute("SELECT stats FROM provider_stats").fetchall()
+        return [ProviderStats.parse_raw(stats) for stats, in rows]
+
+    def _save_provider_stats(self, stats: list[ProviderStats]) -> None:
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO provider_stats (model_name, provider_name, stats) VALUES (?, ?, ?)",
+                [(entry.model_name, entry.provider_name, entry.json()) for entry in stats],
+            )
+
+    async def delete_expired_messages(self) -> int:
+        deleted = await self._run(self._delete_expired_messages)
+        if deleted:
+            logger.info(f"SQLite storage: {deleted} expired messages deleted.")
+        return deleted
+
+    async def sweep(self) -> SweepReport:
+        return SweepReport(messages_deleted=await self.delete_expired_messages())
+
+    async def save_chat(self, chat: Chat) -> None:
+        await self._run(self._save_chat, chat.copy(deep=True))
+
+    async def get_chat(self, chat_id: int) -> Chat | None:
+        return await self._run(self._get_chat, chat_id)
+
+    async def get_or_create_chat(self, chat_id: int) -> Chat:
+        return await self._run(self._get_or_create_chat, chat_id)
+
+    async def add_message(self, chat: Chat, message: Message, ttl: int | None = None) -> None:
+        expire_at = time.time() + ttl if ttl else None
+        message_with_ttl = message.copy(update={"expire_at": expire_at})
+        await self._run(self._add_message, chat.id, message_with_ttl)
+
+    async def get_messages(self, chat: Chat) -> list[dict[str, str]]:
+        if messages := await self._run(self._get_messages, chat.id):
+            return messages
+        chat_refreshed = await self.get_or_create_chat(chat_id=chat.id)
+        return [msg.dict(exclude={"expire_at", "id", "tokens"}) for msg in chat_refreshed.messages]
+
+    async def drop_messages(self, chat: Chat) -> None:
+        initial_message = Message(role="system", content=gpt_settings.assistant_prompt)
+        chat.replace_messages([initial_message])
+        await self._run(self._drop_messages, chat.id, initial_message)
+
+    async def get_provider_stats(self) -> list[ProviderStats]:
+        return await self._run(self._get_provider_stats)
+
+    async def save_provider_stats(self, stats: list[ProviderStats]) -> None:
+        await self._run(self._save_provider_stats, [entry.copy(deep=True) for entry in stats])
+
+    async def close(self) -> None:
+        await self._run(self._connection.close)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,11 @@
+from hiroshi.tokenizer.bpe import count_tokens, load_ranks
+
+# Every message in a chat completion request costs a few tokens on top of its content: the role and the separators.
+TOKENS_PER_MESSAGE = 4
+
+
+def count_message_tokens(content: str) -> int:
+    return count_tokens(content) + TOKENS_PER_MESSAGE
+
+
+__all__ = ["TOKENS_PER_MESSAGE", "count_message_tokens", "count_tokens", "load_ranks"]
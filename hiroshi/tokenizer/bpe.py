@@ -0,0 +1,59 @@
+import base64
+import gzip
+import os
+import re
+import threading
+from functools import lru_cache
+
+VOCABULARY_PATH = os.path.join(os.path.dirname(__file__), "cl100k_base.tiktoken.gz")
+
+# The cl100k_base pre-tokenization pattern, with the \p{L} and \p{N} classes the standard `re` module lacks expressed
+# through \w: letters are [^\W\d_], numbers are \d.
+PRE_TOKENIZATION_PATTERN = re.compile(
+    r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)"""
+    r"""|(?:[^\r\n\w]|_)?[^\W\d_]+"""
+    r"""|\d{1,3}"""
+    r"""| ?(?:[^\s\w]|_)+[\r\n]*"""
+    r"""|\s*[\r\n]+"""
+    r"""|\s+(?!\S)"""
+    r"""|\s+"""
+)
+
+_ranks: dict[bytes, int] | None = None
+_ranks_lock = threading.Lock()
+
+
+def load_ranks() -> dict[bytes, int]:
+    """Load the BPE merge ranks shipped with the package (tiktoken's cl100k_base file format)."""
+    global _ranks
+    with _ranks_lock:
+        if _ranks is None:
+            with gzip.open(VOCABULARY_PATH, "rb") as f:
+                _ranks = {
+                    base64.b64decode(token): int(rank) for token, rank in (line.split() for line in f if line.strip())
+                }
+        return _ranks
+
+
+@lru_cache(maxsize=65536)
+def count_piece_tokens(piece: bytes) -> int:
+    ranks = load_ranks()
+    if piece in ranks:
+        return 1
+
+    parts = [bytes((byte,)) for byte in piece]
+    while len(parts) > 1:
+        best_rank, best_index = None, -1
+        for index in range(len(parts) - 1):
+            rank = ranks.get(parts[index] + parts[index + 1])
+            if rank is not None and (best_rank is None or rank < best_rank):
+                best_rank, best_index = rank, index
+        if best_rank is None:
+            break
+        parts[best_index] += parts.pop(best_index + 1)
+    return len(parts)
+
+
+def count_tokens(text: str) -> int:
+    """Count the number of tokens the text takes in the cl100k_base encoding (used by GPT-3.5 and GPT-4)."""
+    return sum(count_piece_tokens(piece.encode()) for piece in PRE_TOKENIZATION_PATTERN.findall(text))
@@ -0,0 +1,281 @@
+import asyncio
+import json
+import os
+import random
+import time
+from asyncio import Task
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import wraps
+from typing import Any, Callable, Iterator
+
+import httpx
+from loguru import logger
+
+from hiroshi.config import application_settings
+
+# How long finished spans are buffered before being exported.
+EXPORT_INTERVAL = 2
+# Spans are exported right away once this many are buffered.
+EXPORT_BATCH_SIZE = 200
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    name: str
+    started_at_ns: int
+    duration: float = 0.0
+    attributes: dict[str, Any] = field(default_factory=dict)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.started_at_ns / 1e9,
+            "duration": round(self.duration, 6),
+            "attributes": self.attributes,
+        }
+
+    def otlp(self) -> dict[str, Any]:
+        otlp_span: dict[str, Any] = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.started_at_ns),
+            "endTimeUnixNano": str(self.started_at_ns + int(self.duration * 1e9)),
+            "attributes": [
+                {"key": key, "value": {"stringValue": str(value)}} for key, value in self.attributes.items()
+            ],
+        }
+        if self.parent_id:
+            otlp_span["parentSpanId"] = self.parent_id
+        return otlp_span
+
+
+@dataclass
+class TraceContext:
+    """What a span needs to know about the trace it belongs to. Can be passed to another process as a dict."""
+
+    trace_id: str
+    sampled: bool
+    span_id: str | None = None
+    # The span in progress and the spans of the current segment (the part of the trace made in one task), finished so
+    # far. Both are local to the process.
+    span: Span | None = field(default=None, repr=False, compare=False)
+    segment: list[Span] | None = field(default=None, repr=False, compare=False)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"trace_id": self.trace_id, "sampled": self.sampled, "span_id": self.span_id}
+
+    @classmethod
+    def parse(cls, data: dict[str, Any] | None) -> "TraceContext | None":
+        if not data:
+            return None
+        return cls(trace_id=data["trace_id"], sampled=data["sampled"], span_id=data.get("span_id"))
+
+
+class SpanExporter:
+    """Writes finished spans to a JSON lines file and/or posts them to an OTLP/HTTP (JSON) collector, in batches."""
+
+    def __init__(self, file_path: str | None, otlp_endpoint: str | None, service_name: str = "hiroshi") -> None:
+        self.file_path = file_path
+        self.otlp_endpoint = otlp_endpoint
+        self.service_name = service_name
+        self._buffer: list[Span] = []
+        self._flusher: Task[None] | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.file_path or self.otlp_endpoint)
+
+    def export(self, span: Span) -> None:
+        self._buffer.append(span)
+        if len(self._buffer) >= EXPORT_BATCH_SIZE or not self._flusher or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later(0 if len(self._buffer) >= EXPORT_BATCH_SIZE else 1))
+
+    async def _flush_later(self, delay_factor: int) -> None:
+        await asyncio.sleep(EXPORT_INTERVAL * delay_factor)
+        await self.flush()
+
+    def _write_file(self, spans: list[Span]) -> None:
+        assert self.file_path
+        with open(self.file_path, "a") as spans_file:
+            spans_file.writelines(json.dumps(span.to_dict(), ensure_ascii=False) + "\n" for span in spans)
+
+    async def _post_otlp(self, spans: list[Span]) -> None:
+        assert self.otlp_endpoint
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {"key": "service.name", "value": {"stringValue": self.service_name}},
+                            {"key": "process.pid", "value": {"stringValue": str(os.getpid())}},
+                        ]
+                    },
+                    "scopeSpans": [{"scope": {"name": "hiroshi"}, "spans": [span.otlp() for span in spans]}],
+                }
+            ]
+        }
+        async with httpx.AsyncClient(timeout=10) as client:
+            response = await client.post(self.otlp_endpoint, json=payload)
+            response.raise_for_status()
+
+    async def flush(self) -> None:
+        spans, self._buffer = self._buffer, []
+        if not spans:
+            return
+        try:
+            if self.file_path:
+                await asyncio.to_thread(self._write_file, spans)
+            if self.otlp_endpoint:
+                await self._post_otlp(spans)
+        except Exception as e:
+            logger.warning(f"Couldn't export {len(spans)} trace spans: {str(e)[:240]}")
+
+
+class Tracer:
+    """Lightweight tracing of the work done for every Telegram update.
+
+    A trace is started for every update and its ID follows the work the update causes, across tasks and worker
+    processes. Every trace is recorded (it's cheap), but only `sample_rate` of them are exported. A segment of a trace
+    (the part made by one task) longer than `slow_threshold` seconds is logged with a breakdown of its spans.
+    """
+
+    def __init__(self, sample_rate: float, slow_threshold: float, exporter: SpanExporter) -> None:
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.exporter = exporter
+        self._context: ContextVar[TraceContext | None] = ContextVar("trace_context", default=None)
+
+    @property
+    def enabled(self) -> bool:
+        return (self.exporter.enabled and self.sample_rate > 0) or self.slow_threshold > 0
+
+    def get_trace_context(self) -> TraceContext | None:
+        return self._context.get()
+
+    @contextmanager
+    def start_trace(self, name: str, **attributes: Any) -> Iterator[None]:
+        """Start a new trace with a root span, unless one is in progress already (then it's just a span)."""
+        if not self.enabled or self._context.get():
+            with self.span(name, **attributes):
+                yield
+            return
+        trace_context = TraceContext(trace_id=os.urandom(16).hex(), sampled=random.random() < self.sample_rate)
+        with self.continue_trace(name, trace_context, **attributes):
+            yield
+
+    @contextmanager
+    def continue_trace(self, name: str, trace_context: TraceContext | None, **attributes: Any) -> Iterator[None]:
+        """Start a new segment of the trace (from another task or process) with a span named `name`."""
+        if not self.enabled or trace_context is None:
+            yield
+            return
+        token = self._context.set(
+            TraceContext(trace_id=trace_context.trace_id, sampled=trace_context.sampled, span_id=trace_context.span_id)
+        )
+        try:
+            with self.span(name, **attributes):
+                yield
+        finally:
+            self._context.reset(token)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[None]:
+        parent = self._context.get()
+        if parent is None:
+            yield
+            return
+
+        segment_root = parent.segment is None
+        segment = [] if parent.segment is None else parent.segment
+        current = Span(
+            trace_id=parent.trace_id,
+            span_id=os.urandom(8).hex(),
+            parent_id=parent.span_id,
+            name=name,
+            started_at_ns=time.time_ns(),
+            attributes=attributes,
+        )
+        token = self._context.set(
+            TraceContext(
+                trace_id=parent.trace_id,
+                sampled=parent.sampled,
+                span_id=current.span_id,
+                span=current,
+                segment=segment,
+            )
+        )
+        started_at = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            current.attributes["error"] = type(e).__name__
+            raise
+        finally:
+            current.duration = time.perf_counter() - started_at
+            self._context.reset(token)
+            segment.append(current)
+            if parent.sampled and self.exporter.enabled:
+                self.exporter.export(current)
+            if segment_root and self.slow_threshold and current.duration >= self.slow_threshold:
+                self.log_breakdown(current, segment)
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        """Set an attribute of the span in progress, if there is one."""
+        trace_context = self._context.get()
+        if trace_context and trace_context.span:
+            trace_context.span.attributes[key] = value
+
+    @staticmethod
+    def log_breakdown(root: Span, segment: list[Span]) -> None:
+        children: dict[str | None, list[Span]] = {}
+        for span in segment:
+            children.setdefault(span.parent_id, []).append(span)
+
+        lines: list[str] = []
+
+        def describe(span: Span, depth: int) -> None:
+            attributes = ", ".join(f"{key}={value}" for key, value in span.attributes.items())
+            lines.append(f"{'  ' * depth}{span.name}: {span.duration:.3f}s{f' ({attributes})' if attributes else ''}")
+            for child in sorted(children.get(span.span_id, []), key=lambda child_span: child_span.started_at_ns):
+                describe(child, depth + 1)
+
+        describe(root, 0)
+        breakdown = "\n".join(lines)
+        logger.warning(f"Slow request ({root.duration:.3f}s, trace {root.trace_id}):\n{breakdown}")
+
+    def traced(self, name: str | None = None) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+        """Decorator wrapping every call of an async function in a span."""
+
+        def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+            span_name = name or func.__name__
+
+            @wraps(func)
+            async def wrapper(*args: Any, **kwargs: Any) -> Any:
+                with self.span(span_name):
+                    return await func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    async def close(self) -> None:
+        await self.exporter.flush()
+
+
+tracer = Tracer(
+    sample_rate=application_settings.tracing_sample_rate,
+    slow_threshold=application_settings.tracing_slow_threshold,
+    exporter=SpanExporter(
+        file_path=application_settings.tracing_file, otlp_endpoint=application_settings.tracing_otlp_endpoint
+    ),
+)
@@ -1,9 +1,8 @@
-import io
+import time
 from functools import wraps
 from typing import Any, Callable
 
 import httpx
-from g4f.Provider import ProviderUtils
 from loguru import logger
 from telegram import Chat as TelegramChat
 from telegram import Message as TelegramMessage
@@ -12,8 +11,14 @@ from telegram import User as TelegramUser
 from telegram import constants
 from telegram.error import BadRequest
 from telegram.ext import ContextTypes
+from telegram.request import HTTPXRequest
 
 from hiroshi.config import application_settings, gpt_settings, telegram_settings
+from hiroshi.markdown import MessageChunk, split_answer
+from hiroshi.metrics import markdown_fallbacks, telegram_request_duration
+from hiroshi.storage.abstract import Database
+from hiroshi.storage.database import inject_database
+from hiroshi.tracing import tracer
 
 GROUP_CHAT_TYPES = [constants.ChatType.GROUP, constants.ChatType.SUPERGROUP]
 PERSONAL_CHAT_TYPES = [constants.ChatType.SENDER, constants.ChatType.PRIVATE]
@@ -53,6 +58,26 @@ def get_prompt_with_replied_message(update: Update, initial_prompt: str) -> str:
     return prompt
 
 
+class MeteredHTTPXRequest(HTTPXRequest):
+    """Bot API requests measured by `hiroshi_telegram_request_duration_seconds`."""
+
+    async def do_request(self, url: str, method: str, *args: Any, **kwargs: Any) -> tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        started_at = time.perf_counter()
+        status = "error"
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        finally:
+            telegram_request_duration.observe(time.perf_counter() - started_at, method=api_method, status=status)
+
+
+def get_telegram_request() -> MeteredHTTPXRequest:
+    # Same pool size as the one `ApplicationBuilder` gives the default request.
+    return MeteredHTTPXRequest(connection_pool_size=256, proxy=telegram_settings.proxy)
+
+
 async def send_message(
     update: Update, context: ContextTypes.DEFAULT_TYPE, reply: bool = True, **kwargs: Any
 ) -> TelegramMessage:
@@ -66,39 +91,34 @@ async def send_message(
     return await context.bot.send_message(chat_id=telegram_chat.id, **kwargs)
 
 
-async def send_gpt_answer_message(gpt_answer: str, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    telegram_user = get_telegram_user(update=update)
-    telegram_chat = get_telegram_chat(update=update)
-    try:
-        await send_message(update=update, context=context, text=gpt_answer, parse_mode=constants.ParseMode.MARKDOWN)
-    except BadRequest as e:
-        # Trying to handle an exception connected with markdown parsing: just re-sending the message in a text mode.
-        logger.error(
-            f"{telegram_user.name} got a Telegram Bad Request error while receiving GPT answer: {e}. "
-            f"Trying to re-send it in plain text mode."
-        )
-        await send_message(update=update, context=context, text=gpt_answer)
-
-        if "```" in gpt_answer:
-            logger.info(
-                f"{telegram_user.name} got and answer containing some code, but face with a markdown parse error. "
-                f"Additionally sending answer as an attachment..."
+async def send_answer_chunk(
+    chunk: MessageChunk, update: Update, context: ContextTypes.DEFAULT_TYPE, reply: bool = True
+) -> TelegramMessage:
+    """Send a part of the answer as Markdown, or in plain text if it can't be (or Telegram still rejects it)."""
+    if chunk.markdown is not None:
+        try:
+            return await send_message(
+                update=update,
+                context=context,
+                text=chunk.markdown,
+                parse_mode=constants.ParseMode.MARKDOWN,
+                reply=reply,
             )
-            file = io.BytesIO()
-            file.write(gpt_answer.encode())
-            file.seek(0)
-            explain_message_text = (
-                "Oops! 😯It looks like your answer contains some code, but Telegram can't display it properly. "
-                "I'll additionally add your answer to the markdown file. 👇"
+        except BadRequest as e:
+            markdown_fallbacks.inc()
+            telegram_user = get_telegram_user(update=update)
+            logger.error(
+                f"{telegram_user.name} got a Telegram Bad Request error while receiving GPT answer: {e}. "
+                f"Trying to re-send it in plain text mode."
             )
+    return await send_message(update=update, context=context, text=chunk.plain, reply=reply)
 
-            explain_message = await send_message(update=update, context=context, text=explain_message_text, reply=False)
-            await context.bot.send_document(
-                chat_id=telegram_chat.id,
-                reply_to_message_id=explain_message.message_id,
-                document=file,
-                filename="answer.md",
-            )
+
+@tracer.traced()
+async def send_gpt_answer_message(gpt_answer: str, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send the answer, split into as many messages as needed. Only the first one replies to the prompt."""
+    for index, chunk in enumerate(split_answer(gpt_answer)):
+        await send_answer_chunk(chunk=chunk, update=update, context=context, reply=index == 0)
 
 
 def user_is_allowed(tg_user: TelegramUser) -> bool:
@@ -156,6 +176,41 @@ def check_user_allow_to_apply_settings(func: Callable[..., Any]) -> Callable[...
     return wrapper
 
 
+async def user_is_allowed_to_interact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Check the user and the chat against the access settings, telling the ones rejected why."""
+    telegram_user = get_telegram_user(update=update)
+    user_name = telegram_user.name or f"{telegram_user.first_name} ({telegram_user.id})"
+
+    if telegram_user.is_bot and not telegram_settings.allow_bots:
+        logger.warning(f"Bots are not allowed. {user_name}'s request ignored.")
+        return False
+
+    if update.inline_query:
+        if not user_is_allowed(tg_user=telegram_user):
+            logger.warning(f"{user_name} (id={telegram_user.id}) is not allowed to work with me. Inline ignored.")
+            return False
+        return True
+
+    telegram_chat = get_telegram_chat(update=update)
+
+    if telegram_chat.type in PERSONAL_CHAT_TYPES and not user_is_allowed(tg_user=telegram_user):
+        logger.warning(f"{user_name} (id={telegram_user.id}) is not allowed to work with me. Request rejected.")
+        await send_message(update=update, context=context, text=telegram_settings.message_for_disallowed_users)
+        return False
+
+    if telegram_chat.type in GROUP_CHAT_TYPES and not group_is_allowed(tg_chat=telegram_chat):
+        message = (
+            f"The group {telegram_chat.effective_name} (id: {telegram_chat.id}, link: {telegram_chat.link}) "
+            f"does not exist in the whitelist. Leaving it..."
+        )
+        logger.warning(message)
+        await context.bot.send_message(chat_id=telegram_chat.id, text=message, disable_web_page_preview=True)
+        await telegram_chat.leave()
+        return False
+
+    return True
+
+
 def check_user_allowance(func: Callable[..., Any]) -> Callable[..., Any]:
     """Decorator controlling access to the chatbot.
 
@@ -177,38 +232,13 @@ def check_user_allowance(func: Callable[..., Any]) -> Callable[..., Any]:
     async def wrapper(*args: Any, **kwargs: Any) -> Any:
         update: Update = kwargs.get("update") or args[1]
         context: ContextTypes.DEFAULT_TYPE = kwargs.get("context") or args[2]
-        telegram_user = get_telegram_user(update=update)
-        user_name = telegram_user.name or f"{telegram_user.first_name} ({telegram_user.id})"
-
-        if telegram_user.is_bot and not telegram_settings.allow_bots:
-            logger.warning(f"Bots are not allowed. {user_name}'s request ignored.")
-            return None
-
-        if update.inline_query:
-            if not user_is_allowed(tg_user=telegram_user):
-                logger.warning(f"{user_name} (id={telegram_user.id}) is not allowed to work with me. Inline ignored.")
+        with tracer.start_trace("telegram_update", handler=func.__name__, update_id=update.update_id):
+            with tracer.span("check_user_allowance"):
+                allowed = await user_is_allowed_to_interact(update=update, context=context)
+            if not allowed:
                 return None
             return await func(*args, **kwargs)
 
-        telegram_chat = get_telegram_chat(update=update)
-
-        if telegram_chat.type in PERSONAL_CHAT_TYPES and not user_is_allowed(tg_user=telegram_user):
-            logger.warning(f"{user_name} (id={telegram_user.id}) is not allowed to work with me. Request rejected.")
-            await send_message(update=update, context=context, text=telegram_settings.message_for_disallowed_users)
-            return None
-
-        if telegram_chat.type in GROUP_CHAT_TYPES and not group_is_allowed(tg_chat=telegram_chat):
-            message = (
-                f"The group {telegram_chat.effective_name} (id: {telegram_chat.id}, link: {telegram_chat.link}) "
-                f"does not exist in the whitelist. Leaving it..."
-            )
-            logger.warning(message)
-            await context.bot.send_message(chat_id=telegram_chat.id, text=message, disable_web_page_preview=True)
-            await telegram_chat.leave()
-            return None
-
-        return await func(*args, **kwargs)
-
     return wrapper
 
 
@@ -244,7 +274,12 @@ def handle_gpt_exceptions(func: Callable[..., Any]) -> Callable[..., Any]:
 
 
 def log_application_settings() -> None:
-    storage = "<red>REDIS</red>" if application_settings.redis else "<blue>LOCAL</blue>"
+    if application_settings.redis:
+        storage = "<red>REDIS</red>"
+    elif application_settings.sqlite:
+        storage = "<blue>SQLITE</blue>"
+    else:
+        storage = f"<blue>LOCAL ({application_settings.local_storage_engine.upper()})</blue>"
 
     logger_info = "<red>DISABLED</red>."
 
@@ -255,16 +290,76 @@ def log_application_settings() -> None:
             f"MONITORING_URL=<blue>{application_settings.monitoring_url}</blue>"
         )
 
+    if (
+        application_settings.storage_cache_size > 0
+        and application_settings.storage_cache_ttl > 0
+        and not application_settings.workers
+    ):
+        storage_cache = (
+            f"<blue>{application_settings.storage_cache_size}</blue> chats, "
+            f"TTL <blue>{application_settings.storage_cache_ttl}</blue> seconds"
+        )
+    else:
+        storage_cache = "<red>DISABLED</red>"
+
+    if gpt_settings.response_cache_size > 0 and gpt_settings.response_cache_ttl > 0:
+        response_cache = (
+            f"<blue>{gpt_settings.response_cache_size}</blue> answers, "
+            f"TTL <blue>{gpt_settings.response_cache_ttl}</blue> seconds"
+            f"{', <blue>SHARED</blue>' if gpt_settings.response_cache_shared else ''}"
+        )
+    else:
+        response_cache = "<red>DISABLED</red>"
+
+    if telegram_settings.webhook_url:
+        updates_mode = (
+            f"<blue>WEBHOOK</blue> ({telegram_settings.webhook_url.rstrip('/')}{telegram_settings.webhook_path}, "
+            f"listening on {telegram_settings.webhook_listen}:{telegram_settings.webhook_port})"
+        )
+    else:
+        updates_mode = "<blue>POLLING</blue>"
+
+    tracing = "<red>DISABLED</red>"
+    if tracer.enabled:
+        exported_to = " and ".join(
+            filter(None, (application_settings.tracing_file, application_settings.tracing_otlp_endpoint))
+        )
+        slow_threshold = application_settings.tracing_slow_threshold
+        tracing = (
+            f"<blue>{application_settings.tracing_sample_rate:.0%}</blue> of the updates exported to "
+            f"<blue>{exported_to or 'NOWHERE'}</blue>, slow requests logged: "
+            f"<blue>{f'after {slow_threshold} seconds' if slow_threshold else 'NEVER'}</blue>"
+        )
+
+    rate_limit = "<red>DISABLED</red>"
+    if telegram_settings.rate_limit:
+        rate_limit = (
+            f"<blue>{telegram_settings.rate_limit:g}</blue> requests a second overall, "
+            f"<blue>{telegram_settings.chat_rate_limit:g}</blue> a second per chat, "
+            f"<blue>{telegram_settings.group_rate_limit:g}</blue> a minute per group"
+        )
+
+    workers = ""
+    if application_settings.workers:
+        workers = f" by each of <blue>{application_settings.workers}</blue> worker processes"
+
     messages = (
         f"Application is initialized using {storage} storage.",
+        f"Storage cache: {storage_cache}",
+        f"Response cache: {response_cache}",
         f"Bot name is <blue>{telegram_settings.bot_name}</blue>",
         f"Initial assistant prompt: <blue>{gpt_settings.assistant_prompt}</blue>",
         f"Proxy is <blue>{telegram_settings.proxy or 'UNSET'}</blue>",
+        f"Updates are received by {updates_mode}",
         f"Messages TTL: <blue>{gpt_settings.max_conversation_age_minutes} minutes</blue>",
         f"Maximum conversation history size: <blue>{gpt_settings.max_history_tokens}</blue> tokens",
+        f"Prompts answered at once: <blue>{application_settings.prompt_concurrency}</blue>{workers}",
+        f"Outgoing rate limit: {rate_limit}",
+        f"Streaming answers: {'<blue>ENABLED</blue>' if telegram_settings.stream_answers else '<red>DISABLED</red>'}",
         f"Users whitelist: <blue>{telegram_settings.users_whitelist or 'UNSET'}</blue>",
         f"Groups whitelist: <blue>{telegram_settings.groups_whitelist or 'UNSET'}</blue>",
         f"Groups admins: <blue>{telegram_settings.group_admins or 'UNSET'}</blue>",
+        f"Tracing: {tracing}",
         f"Uptime checker: {logger_info}",
     )
     for message in messages:
@@ -295,7 +390,22 @@ async def run_monitoring(context: ContextTypes.DEFAULT_TYPE) -> None:
             logger.error(f"Uptime Checker failed. status_code({result.status_code}) msg: {result.text}")
 
 
+@inject_database
+async def run_storage_sweeper(db: Database, context: ContextTypes.DEFAULT_TYPE) -> None:
+    started_at = time.monotonic()
+    report = await db.sweep()
+    if not report.messages_deleted and not report.chats_deleted:
+        return
+    logger.info(
+        f"Storage sweep finished in {time.monotonic() - started_at:.1f} seconds: {report.chats_checked} chats "
+        f"checked, {report.chats_deleted} idle chats and {report.messages_deleted} expired messages deleted, "
+        f"{report.bytes_reclaimed} bytes reclaimed."
+    )
+
+
 def is_provider_active(model_and_provider_names: tuple[str, str]) -> bool:
+    from g4f.Provider import ProviderUtils
+
     _, provider_name = model_and_provider_names
     if provider_name == "Llama":
         return True  # TODO: Temporary solution, because Llama is turned off accidentally on the gpt4free side
@@ -1,6 +1,6 @@
 import asyncio
 from asyncio import Task
-from typing import Any, Coroutine
+from typing import TYPE_CHECKING, Any, Coroutine
 
 from loguru import logger
 from telegram import (
@@ -18,29 +18,53 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
+from telegram.request import BaseRequest
 
+from hiroshi import metrics
 from hiroshi.config import application_settings, telegram_settings
 from hiroshi.services.bot import (
     handle_available_providers_options,
-    handle_prompt,
+    handle_overload,
     handle_provider_selection,
     handle_reset,
+    prompt_scheduler,
+    schedule_prompt,
 )
+from hiroshi.services.chat import summary_scheduler
+from hiroshi.services.providers import providers_loader
+from hiroshi.services.rate_limiter import get_rate_limiter
+from hiroshi.services.response_cache import response_cache
+from hiroshi.services.scoreboard import (
+    load_scoreboard,
+    run_scoreboard_saver,
+    save_scoreboard,
+)
+from hiroshi.services.workers import WorkerPool
+from hiroshi.storage.database import close_database
+from hiroshi.tokenizer import load_ranks
+from hiroshi.tracing import tracer
 from hiroshi.utils import (
     GROUP_CHAT_TYPES,
     check_user_allow_to_apply_settings,
     check_user_allowance,
     get_telegram_chat,
     get_telegram_message,
+    get_telegram_request,
     log_application_settings,
     run_monitoring,
+    run_storage_sweeper,
     user_interacts_with_bot,
 )
 
+if TYPE_CHECKING:
+    from aiohttp import web
+
 
 class HiroshiBot:
     def __init__(self) -> None:
         self.background_tasks: set[Task[Any]] = set()
+        self.metrics_server: "web.AppRunner | None" = None
+        self.worker_pool = WorkerPool(size=application_settings.workers) if application_settings.workers else None
         self.commands = [
             BotCommand(command="about", description="About this bot"),
             BotCommand(command="help", description="Show the help message"),
@@ -55,6 +79,7 @@ class HiroshiBot:
             ),
             BotCommand(command="provider", description="Select GPT provider"),
         ]
+        metrics.background_tasks.set_function(lambda: len(self.background_tasks))
 
     def create_task(self, task: Coroutine[Any, Any, Any]) -> None:
         task_scheduled = asyncio.create_task(task)
@@ -83,7 +108,11 @@ class HiroshiBot:
     @check_user_allowance
     @check_user_allow_to_apply_settings
     async def reset(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        self.create_task(task=handle_reset(update=update, context=context))
+        # With workers, the chat's worker resets it: it's the only process writing the chat.
+        if self.worker_pool:
+            self.worker_pool.dispatch(chat_id=get_telegram_chat(update=update).id, update=update, handler="reset")
+        else:
+            self.create_task(task=handle_reset(update=update, context=context))
 
     @check_user_allowance
     async def prompt(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -101,11 +130,17 @@ class HiroshiBot:
             and not user_interacts_with_bot(update=update, context=context)
         ):
             return None
-        self.create_task(task=handle_prompt(update=update, context=context))
+        self.schedule_prompt(update=update, context=context)
 
     @check_user_allowance
     async def ask(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        self.create_task(task=handle_prompt(update=update, context=context))
+        self.schedule_prompt(update=update, context=context)
+
+    def schedule_prompt(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if self.worker_pool:
+            self.worker_pool.dispatch(chat_id=get_telegram_chat(update=update).id, update=update)
+        elif not schedule_prompt(update=update, context=context):
+            self.create_task(task=handle_overload(update=update, context=context))
 
     @check_user_allowance
     @check_user_allow_to_apply_settings
@@ -117,7 +152,11 @@ class HiroshiBot:
 
     @check_user_allow_to_apply_settings
     async def select_provider(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        self.create_task(task=handle_provider_selection(update=update, context=context))
+        if self.worker_pool:
+            chat_id = get_telegram_chat(update=update).id
+            self.worker_pool.dispatch(chat_id=chat_id, update=update, handler="provider_selection")
+        else:
+            self.create_task(task=handle_provider_selection(update=update, context=context))
 
     @check_user_allowance
     async def inline_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -140,20 +179,47 @@ class HiroshiBot:
         logger.error(f"Error occurred while handling an update: {str(context.error)[:240]}")
 
     async def post_init(self, application: Application) -> None:  # type: ignore
+        # The providers are loaded in the background: the commands not needing them are served meanwhile.
+        providers_loader.start()
+        # So is the tokenizer's vocabulary: decoding it on the first message would hold every chat back meanwhile.
+        self.create_task(asyncio.to_thread(load_ranks))
         await application.bot.set_my_commands(self.commands)
+        await load_scoreboard()
+        if application_settings.metrics_port:
+            self.metrics_server = await metrics.start_metrics_server(
+                listen=application_settings.metrics_listen, port=application_settings.metrics_port
+            )
+        if self.worker_pool:
+            self.worker_pool.start()
 
-    def run(self) -> None:
+    async def post_shutdown(self, application: Application) -> None:  # type: ignore
+        if self.worker_pool:
+            await asyncio.to_thread(self.worker_pool.close)
+        await prompt_scheduler.close()
+        await summary_scheduler.close()
+        await response_cache.close()
+        await save_scoreboard()
+        await close_database()
+        await tracer.close()
+        if self.metrics_server:
+            await self.metrics_server.cleanup()
+
+    def build_application(self, request: BaseRequest | None = None) -> Application:  # type: ignore
+        """Build the application with all the handlers and jobs registered. The Bot API is called through `request` if
+        it's set (the load test harness sets a stub one)."""
+        builder = (
+            ApplicationBuilder()
+            .token(telegram_settings.token)
+            .request(request or get_telegram_request())
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+        )
         if telegram_settings.proxy:
-            app = (
-                ApplicationBuilder()
-                .token(telegram_settings.token)
-                .proxy(telegram_settings.proxy)
-                .get_updates_proxy(telegram_settings.proxy)
-                .post_init(self.post_init)
-                .build()
-            )
+            builder = builder.get_updates_proxy(telegram_settings.proxy)
+        if rate_limiter := get_rate_limiter():
+            app: Application = builder.rate_limiter(rate_limiter).build()  # type: ignore
         else:
-            app = ApplicationBuilder().token(telegram_settings.token).post_init(self.post_init).build()
+            app = builder.build()
 
         if telegram_settings.show_about:
             app.add_handler(CommandHandler("about", self.about))
@@ -178,8 +244,38 @@ class HiroshiBot:
             app.job_queue.run_repeating(
                 callback=run_monitoring, interval=application_settings.monitoring_frequency_call, first=0.0
             )
+            if application_settings.storage_sweep_interval > 0:
+                app.job_queue.run_repeating(
+                    callback=run_storage_sweeper,
+                    interval=application_settings.storage_sweep_interval,
+                    first=application_settings.storage_sweep_interval,
+                )
 
-        app.run_polling()
+            if application_settings.provider_stats_save_interval > 0:
+                app.job_queue.run_repeating(
+                    callback=run_scoreboard_saver,
+                    interval=application_settings.provider_stats_save_interval,
+                    first=application_settings.provider_stats_save_interval,
+                )
+        return app
+
+    def run(self) -> None:
+        app = self.build_application()
+        if telegram_settings.webhook_url:
+            from hiroshi.services.webhook import serve_webhook
+
+            asyncio.run(
+                serve_webhook(
+                    application=app,
+                    url=telegram_settings.webhook_url,
+                    path=telegram_settings.webhook_path,
+                    secret_token=telegram_settings.webhook_secret_token,
+                    listen=telegram_settings.webhook_listen,
+                    port=telegram_settings.webhook_port,
+                )
+            )
+        else:
+            app.run_polling()
 
 
 if __name__ == "__main__":
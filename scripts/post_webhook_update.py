@@ -0,0 +1,104 @@
+"""Post sample Telegram updates to the bot's webhook, the way Telegram does.
+
+Lets the webhook mode be exercised locally, without registering the webhook on Telegram's side. The bot must be
+running with `WEBHOOK_URL` (any value) and `WEBHOOK_SECRET_TOKEN` set; the same secret token is passed here. Answers
+are still sent through the Telegram Bot API, so use the IDs of a real chat to see them.
+
+Usage:
+    python -m scripts.post_webhook_update --secret-token <token> --chat-id <id> --text "Hello!" [--count 10]
+    python -m scripts.post_webhook_update --update update.json --secret-token <token>
+    python -m scripts.post_webhook_update --health
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Any
+
+from aiohttp import ClientSession
+
+from hiroshi.services.webhook import HEALTH_PATH, SECRET_TOKEN_HEADER
+
+
+def make_text_update(update_id: int, chat_id: int, user_id: int, chat_type: str, text: str) -> dict[str, Any]:
+    user = {"id": user_id, "is_bot": False, "first_name": "Webhook", "username": f"webhook_user_{user_id}"}
+    chat: dict[str, Any] = {"id": chat_id, "type": chat_type}
+    if chat_type == "private":
+        chat.update(first_name=user["first_name"], username=user["username"])
+    else:
+        chat.update(title="Webhook test group")
+    message = {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": user, "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+async def post_updates(url: str, secret_token: str, updates: list[dict[str, Any]], concurrency: int) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+
+    async def post(session: ClientSession, update: dict[str, Any]) -> None:
+        async with semaphore:
+            started_at = time.perf_counter()
+            async with session.post(url, json=update, headers={SECRET_TOKEN_HEADER: secret_token}) as response:
+                latencies.append(time.perf_counter() - started_at)
+                print(f"Update {update['update_id']}: HTTP {response.status}")
+
+    async with ClientSession() as session:
+        await asyncio.gather(*(post(session, update) for update in updates))
+    if latencies:
+        latencies.sort()
+        print(
+            f"{len(latencies)} updates posted. Latency: median {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+            f"max {latencies[-1] * 1000:.1f} ms"
+        )
+
+
+async def check_health(base_url: str) -> None:
+    async with ClientSession() as session:
+        async with session.get(f"{base_url}{HEALTH_PATH}") as response:
+            print(f"HTTP {response.status}: {await response.text()}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8080", help="Address the webhook server listens on")
+    parser.add_argument("--path", default="/telegram", help="WEBHOOK_PATH of the bot")
+    parser.add_argument("--secret-token", default="", help="WEBHOOK_SECRET_TOKEN of the bot")
+    parser.add_argument("--health", action="store_true", help="Only query the health endpoint")
+    parser.add_argument("--update", help="JSON file with an Update (or a list of them) to post as is")
+    parser.add_argument("--chat-id", type=int, default=1, help="Chat of the generated message updates")
+    parser.add_argument("--user-id", type=int, help="Sender of the generated message updates (the chat ID if unset)")
+    parser.add_argument("--chat-type", default="private", choices=("private", "group", "supergroup"))
+    parser.add_argument("--text", default="Hello!", help="Text of the generated message updates")
+    parser.add_argument("--count", type=int, default=1, help="Number of message updates to generate")
+    parser.add_argument("--concurrency", type=int, default=10, help="Number of updates posted at once")
+    args = parser.parse_args()
+
+    base_url = args.base_url.rstrip("/")
+    if args.health:
+        asyncio.run(check_health(base_url))
+        return
+
+    if args.update:
+        with open(args.update) as update_file:
+            loaded = json.load(update_file)
+        updates = loaded if isinstance(loaded, list) else [loaded]
+    else:
+        first_update_id = random.randint(1, 2**30)
+        updates = [
+            make_text_update(
+                update_id=first_update_id + index,
+                chat_id=args.chat_id,
+                user_id=args.user_id or args.chat_id,
+                chat_type=args.chat_type,
+                text=args.text,
+            )
+            for index in range(args.count)
+        ]
+    asyncio.run(post_updates(f"{base_url}{args.path}", args.secret_token, updates, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
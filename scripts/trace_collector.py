@@ -0,0 +1,111 @@
+"""A stand-in for an OpenTelemetry collector, printing the traces the bot exports.
+
+Accepts the spans the bot posts (OTLP/HTTP with JSON encoding) and prints every trace once it has been quiet for a
+moment, as a tree of spans with their durations. Run the bot with `TRACING_OTLP_ENDPOINT` pointing here.
+
+Usage:
+    python -m scripts.trace_collector [--port 4318] [--output spans.jsonl]
+    TRACING_OTLP_ENDPOINT=http://127.0.0.1:4318/v1/traces python main.py
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Any
+
+from aiohttp import web
+
+TRACES_PATH = "/v1/traces"
+# A trace is printed when no span of it has been received for this long.
+TRACE_QUIET_PERIOD = 5
+
+
+def get_start(span: dict[str, Any]) -> int:
+    return int(span["startTimeUnixNano"])
+
+
+class TraceCollector:
+    def __init__(self, output: str | None) -> None:
+        self.output = output
+        self._traces: dict[str, list[dict[str, Any]]] = {}
+        self._last_received: dict[str, float] = {}
+
+    async def handle_traces(self, request: web.Request) -> web.Response:
+        try:
+            payload = await request.json()
+        except json.JSONDecodeError:
+            return web.json_response({"error": "malformed JSON"}, status=400)
+        spans = [
+            span
+            for resource_spans in payload.get("resourceSpans", [])
+            for scope_spans in resource_spans.get("scopeSpans", [])
+            for span in scope_spans.get("spans", [])
+        ]
+        for span in spans:
+            self._traces.setdefault(span["traceId"], []).append(span)
+            self._last_received[span["traceId"]] = time.monotonic()
+        if self.output:
+            with open(self.output, "a") as output_file:
+                output_file.writelines(json.dumps(span) + "\n" for span in spans)
+        return web.json_response({})
+
+    def print_trace(self, trace_id: str, spans: list[dict[str, Any]]) -> None:
+        children: dict[str | None, list[dict[str, Any]]] = {}
+        span_ids = {span["spanId"] for span in spans}
+        for span in spans:
+            # Spans whose parent hasn't been received (e.g. it was not sampled in time) are shown as roots.
+            parent_id = span.get("parentSpanId") if span.get("parentSpanId") in span_ids else None
+            children.setdefault(parent_id, []).append(span)
+
+        def describe(span: dict[str, Any], depth: int) -> None:
+            duration = (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1e9
+            attributes = ", ".join(
+                f"{attribute['key']}={attribute['value'].get('stringValue')}"
+                for attribute in span.get("attributes", [])
+            )
+            print(f"  {'  ' * depth}{span['name']}: {duration:.3f}s{f' ({attributes})' if attributes else ''}")
+            for child in sorted(children.get(span["spanId"], []), key=get_start):
+                describe(child, depth + 1)
+
+        print(f"Trace {trace_id} ({len(spans)} spans):")
+        for root in sorted(children.get(None, []), key=get_start):
+            describe(root, 0)
+
+    async def print_quiet_traces(self) -> None:
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            for trace_id, last_received in list(self._last_received.items()):
+                if now - last_received >= TRACE_QUIET_PERIOD:
+                    del self._last_received[trace_id]
+                    self.print_trace(trace_id, self._traces.pop(trace_id))
+
+
+async def serve(listen: str, port: int, output: str | None) -> None:
+    collector = TraceCollector(output=output)
+    app = web.Application()
+    app.router.add_post(TRACES_PATH, collector.handle_traces)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host=listen, port=port).start()
+    print(f"Collecting traces on http://{listen}:{port}{TRACES_PATH}")
+    try:
+        await collector.print_quiet_traces()
+    finally:
+        await runner.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--listen", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=4318, help="Port to listen on")
+    parser.add_argument("--output", help="JSON lines file to append the received spans to")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.listen, args.port, args.output))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()